@@ -21,5 +21,5 @@ echo "Web server started."
 # Perform config test, triggers also registration
 /usr/local/bin/opensubmit-exec configtest
 
-# Run "opensubmit-exec run" every minute
-cron -f
+# Keep fetching and running jobs, logging goes directly to Docker stdout / stderr
+exec /usr/local/bin/opensubmit-exec daemon
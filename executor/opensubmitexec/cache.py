@@ -0,0 +1,267 @@
+'''
+    On-disk cache for validator downloads.
+'''
+
+from contextlib import contextmanager
+from urllib.error import HTTPError
+import hashlib
+import fcntl
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from .connection import urlopen
+from .filesystem import unpack_if_needed, copy_tree
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+
+class ValidatorCache():
+    '''
+    Validator packages are the same for all submissions of an assignment,
+    so they are kept on disk and only downloaded again when the server
+    reports a change.
+
+    Files are stored under their SHA-256 content hash. An index maps
+    each download URL to the ETag and Last-Modified information from the
+    server, and to the content hash. Both are sent with the next download
+    request for the URL, so that the server can answer with 304 (Not Modified).
+
+    Validator archives are additionally kept unpacked, as template
+    directory per content hash.
+
+    The cache is shared by all jobs on this machine. When its size exceeds the
+    configured limit, the least recently used files are removed.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.directory = config.get("Execution", "cache_dir")
+        self.max_size = config.getfloat("Execution", "cache_size") * 1024 * 1024
+        self.hardlink = config.getboolean("Execution", "hardlink_validators")
+        os.makedirs(self.directory, exist_ok=True)
+        self.index_file = os.path.join(self.directory, 'index.json')
+
+    @contextmanager
+    def _locked_index(self):
+        '''
+        Gives exclusive access to the index dictionary, for all processes.
+        Changes are saved when leaving the context.
+        '''
+        with open(os.path.join(self.directory, 'index.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.index_file) as f:
+                    index = json.load(f)
+            except (IOError, ValueError):
+                index = {}
+            yield index
+            with open(self.index_file + '.new', 'w') as f:
+                json.dump(index, f)
+            os.replace(self.index_file + '.new', self.index_file)
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.directory, content_hash + '.blob')
+
+    def fetch_unpacked(self, url, directory):
+        '''
+        Store the content of the validator archive from the given URL
+        in the given directory.
+
+        Each validator version is only unpacked once, into a template
+        directory in the cache. Jobs get copies of the template files,
+        or hardlinks if configured.
+
+        Returns the same values as unpack_if_needed(), plus the path of the
+        validator file in the directory if it is not an archive.
+        '''
+        result = []
+
+        def materialize(entry):
+            template, single_dir = self._template(entry)
+            if template:
+                copy_tree(template, directory, self.hardlink)
+                result.extend([single_dir, True, None])
+            else:
+                fullpath = os.path.join(directory, 'download.validator')
+                shutil.copy(self._blob_path(entry['hash']), fullpath)
+                result.extend([None, False, fullpath])
+        self._use(url, materialize)
+        return tuple(result)
+
+    def _use(self, url, action, attempts=3):
+        '''
+        Make sure that the cached file for the URL is up-to-date,
+        and call action with its index entry.
+
+        The index lock is only held for the index updates, so that jobs
+        can copy or unpack validators in parallel. If the files are
+        evicted by another job meanwhile, the download is repeated.
+
+        Returns True if the file was downloaded, and False if the
+        cached version was used.
+        '''
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        with self._locked_index() as index:
+            entry = index.get(key)
+        if entry and not os.path.exists(self._blob_path(entry['hash'])):
+            entry = None
+
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        try:
+            response = urlopen(self.config, url, headers=headers)
+        except HTTPError as e:
+            if e.code != 304 or not entry:
+                raise
+            logger.debug("Using cached validator for %s" % url)
+            downloaded = False
+        else:
+            logger.debug("Fetching validator from %s" % url)
+            with response:
+                entry = {'etag': response.info()['ETag'],
+                         'last_modified': response.info()['Last-Modified'],
+                         'hash': self._store(response)}
+            downloaded = True
+
+        blob = self._blob_path(entry['hash'])
+        with self._locked_index() as index:
+            if not os.path.exists(blob):
+                # Evicted meanwhile by another job
+                index.pop(key, None)
+                evicted = True
+            else:
+                evicted = False
+                # Mark as recently used, so that other jobs evict it last
+                os.utime(blob)
+                index[key] = entry
+                self._evict(index, keep=entry['hash'])
+        if not evicted:
+            try:
+                action(entry)
+            except FileNotFoundError:
+                if attempts <= 1:
+                    raise
+                # Evicted or replaced by another job while in use
+                evicted = True
+        if evicted:
+            return self._use(url, action, attempts - 1)
+        return downloaded
+
+    def _template(self, entry):
+        '''
+        Returns the template directory with the unpacked validator archive,
+        and the single directory name reported by unpack_if_needed().
+        The template is created if needed. Jobs may do this at the same
+        time, the first finished template is kept.
+
+        Returns None as directory if the validator is not an archive.
+        '''
+        blob = self._blob_path(entry['hash'])
+        template = self._template_path(entry['hash'])
+        meta_file = template + '.json'
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if not meta['archive']:
+                return None, None
+            if self._unchanged(template, meta['files']):
+                return template, meta['single_dir']
+            # Somebody modified the files, e.g. through a hardlink
+            logger.warning("Validator template {0} was modified, unpacking it again.".format(template))
+            shutil.rmtree(template, ignore_errors=True)
+        except (IOError, ValueError):
+            pass
+        shutil.rmtree(template, ignore_errors=True)
+
+        meta = {'archive': zipfile.is_zipfile(blob) or tarfile.is_tarfile(blob)}
+        if meta['archive']:
+            logger.debug("Unpacking validator {0} into template directory".format(entry['hash']))
+            tmp = tempfile.mkdtemp(dir=self.directory)
+            single_dir, did_unpack = unpack_if_needed(tmp + os.sep, blob)
+            meta['single_dir'] = single_dir
+            meta['files'] = {}
+            for root, dirs, files in os.walk(tmp):
+                for fname in files:
+                    stat = os.stat(os.path.join(root, fname))
+                    relpath = os.path.relpath(os.path.join(root, fname), tmp)
+                    meta['files'][relpath] = [stat.st_size, stat.st_mtime_ns]
+            meta['size'] = sum(size for size, mtime in meta['files'].values())
+            try:
+                os.rename(tmp, template)
+            except OSError:
+                # Created by another job meanwhile
+                shutil.rmtree(tmp, ignore_errors=True)
+                return self._template(entry)
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, delete=False) as f:
+            json.dump(meta, f)
+        os.replace(f.name, meta_file)
+        return self._template(entry)
+
+    def _unchanged(self, template, files):
+        '''
+        Check the template files against the recorded sizes and modification times.
+        '''
+        for relpath, (size, mtime) in files.items():
+            try:
+                stat = os.stat(os.path.join(template, relpath))
+            except OSError:
+                return False
+            if stat.st_size != size or stat.st_mtime_ns != mtime:
+                return False
+        return True
+
+    def _template_path(self, content_hash):
+        return os.path.join(self.directory, content_hash + '.template')
+
+    def _store(self, response):
+        '''
+        Save the response body in the cache and return its content hash.
+        '''
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as tmp:
+            for chunk in iter(lambda: response.read(64 * 1024), b''):
+                digest.update(chunk)
+                tmp.write(chunk)
+        content_hash = digest.hexdigest()
+        os.replace(tmp.name, self._blob_path(content_hash))
+        return content_hash
+
+    def _evict(self, index, keep):
+        '''
+        Remove least recently used files until the cache fits into its size limit.
+        '''
+        blobs = []
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.blob'):
+                content_hash = fname[:-len('.blob')]
+                stat = os.stat(os.path.join(self.directory, fname))
+                size = stat.st_size
+                # Unpacked templates count as well
+                try:
+                    with open(self._template_path(content_hash) + '.json') as f:
+                        size += json.load(f).get('size', 0)
+                except (IOError, ValueError):
+                    pass
+                blobs.append((stat.st_mtime, size, content_hash))
+        total = sum(size for mtime, size, content_hash in blobs)
+        for mtime, size, content_hash in sorted(blobs):
+            if total <= self.max_size:
+                break
+            if content_hash == keep:
+                continue
+            logger.debug("Removing validator {0} from cache".format(content_hash))
+            os.remove(self._blob_path(content_hash))
+            shutil.rmtree(self._template_path(content_hash), ignore_errors=True)
+            if os.path.exists(self._template_path(content_hash) + '.json'):
+                os.remove(self._template_path(content_hash) + '.json')
+            total -= size
+            for key in [key for key, entry in index.items() if entry['hash'] == content_hash]:
+                del index[key]
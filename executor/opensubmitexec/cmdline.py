@@ -1,29 +1,99 @@
 # Administration script functionality on the production system
 
 import sys
+import time
+import signal
+import threading
 
 from . import CONFIG_FILE_DEFAULT
-from .server import fetch_job, fake_fetch_job, send_hostinfo
+from .server import fetch_job, fetch_jobs, fake_fetch_job, send_hostinfo
 from .running import kill_longrunning
 from .locking import ScriptLock, break_lock
+from .scheduler import SlotScheduler, run_job
+from .outbox import ResultOutbox
 from .config import read_config, has_config, create_config, check_config
 
+import logging
+logger = logging.getLogger('opensubmitexec')
+
 
 def download_and_run(config):
     '''
     Main operation of the executor.
 
+    Results from earlier runs that could not be delivered
+    are sent first.
+
     Returns True when a job was downloaded and executed.
     Returns False when no job could be downloaded.
     '''
+    ResultOutbox(config).replay()
     job = fetch_job(config)
     if job:
-        job._run_validate()
+        run_job(job)
         return True
     else:
         return False
 
 
+def run_daemon(config, stop_event=None):
+    '''
+    Resident operation of the executor.
+
+    Jobs are fetched back-to-back as long as the server has work
+    for us and a job slot is free. One request asks for as many
+    jobs as there are free slots. Each empty answer doubles the waiting
+    time before the next poll, within the configured range
+    of 'poll_min' and 'poll_max' seconds.
+
+    The server is asked to wait up to 'long_poll' seconds for new work
+    before answering. The time spent in such a request counts
+    as waiting time. Older servers answer immediately, which ends up
+    in plain polling.
+
+    Results that could not be delivered to the server are sent
+    again on startup and between the polls.
+
+    Returns when the given threading.Event is set and all
+    running jobs are finished.
+    '''
+    if not stop_event:
+        stop_event = threading.Event()
+    outbox = ResultOutbox(config)
+    poll_min = config.getfloat("Execution", "poll_min")
+    poll_max = config.getfloat("Execution", "poll_max")
+    long_poll = config.getint("Execution", "long_poll")
+    delay = poll_min
+    scheduler = SlotScheduler(config)
+    logger.info("Running as daemon with {0} job slot(s), polling every {1} to {2} seconds.".format(
+        scheduler.slots, poll_min, poll_max))
+    while not stop_event.is_set():
+        if scheduler.free_slots() == 0:
+            scheduler.wait(poll_min)
+            continue
+        started = time.time()
+        try:
+            outbox.replay()
+            jobs = fetch_jobs(config, scheduler.free_slots(), long_poll)
+        except Exception as e:
+            # Never let a single broken job or server hiccup
+            # kill the resident executor
+            logger.error("Error while fetching jobs: " + str(e))
+            jobs = []
+        if jobs:
+            for job in jobs:
+                scheduler.start(job)
+            delay = poll_min
+        else:
+            remaining = delay - (time.time() - started)
+            if remaining > 0:
+                stop_event.wait(remaining)
+            delay = min(delay * 2, poll_max)
+    logger.info("Waiting for running jobs to finish ...")
+    scheduler.join()
+    logger.info("Daemon stopped.")
+
+
 def copy_and_run(config, src_dir):
     '''
     Local-only operation of the executor.
@@ -60,13 +130,14 @@ def console_script():
         installed by setuptools.
     '''
     if len(sys.argv) == 1:
-        print("opensubmit-exec [configcreate <server_url>|configtest|run|test <dir>|unlock|help] [-c config_file]")
+        print("opensubmit-exec [configcreate <server_url>|configtest|run|daemon|test <dir>|unlock|help] [-c config_file]")
         return 0
 
     if "help" in sys.argv[1]:
         print("configcreate <server_url>:  Create initial config file for the OpenSubmit executor.")
         print("configtest:                 Check config file for correct installation of the OpenSubmit executor.")
         print("run:                        Fetch and run code to be tested from the OpenSubmit web server. Suitable for crontab.")
+        print("daemon:                     Keep running, and fetch and run code to be tested as soon as it is available.")
         print("test <dir>:                 Run test script from a local folder for testing purposes.")
         print("unlock:                     Break the script lock, because of crashed script.")
         print("help:                       Print this help")
@@ -112,6 +183,21 @@ def console_script():
         break_lock(config)
         return 0
 
+    if "daemon" in sys.argv[1]:
+        config = read_config(config_fname)
+        kill_longrunning(config)
+        stop_event = threading.Event()
+
+        def stop_daemon(signum, frame):
+            logger.info("Received signal {0}, finishing current job and stopping.".format(signum))
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, stop_daemon)
+        signal.signal(signal.SIGINT, stop_daemon)
+        with ScriptLock(config):
+            run_daemon(config, stop_event)
+        return 0
+
     if "run" in sys.argv[1]:
         config = read_config(config_fname)
         # Perform additional precautions for unattended mode in cron
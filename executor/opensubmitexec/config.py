@@ -24,6 +24,14 @@ DEFAULT_SETTINGS = {
         'compile_cmd': 'make',
         'directory': '/tmp/',                    # Base directory for temporary directories
         'pidfile': '/tmp/executor.lock',         # Lock file for script lock
+        'cache_dir': '/tmp/validator_cache/',    # Cache directory for validator downloads
+        'cache_size': '500',                     # Cache size limit in MB, 0 disables the cache
+        'hardlink_validators': 'False',          # Hardlink validator files instead of copying them
+        'outbox_dir': '/tmp/executor_outbox/',   # Results waiting for delivery to the server
+        'slots': '1',                            # Number of jobs running in parallel
+        'poll_min': '1',                         # Daemon mode: Fastest polling interval
+        'poll_max': '30',                        # Daemon mode: Slowest polling interval
+        'long_poll': '0',                        # Daemon mode: Server-side waiting time for jobs
         # Execution environment for validation scripts
         'script_runner': '/usr/bin/env python3'
     },
@@ -31,7 +39,10 @@ DEFAULT_SETTINGS = {
         'url': 'http://localhost:8000',          # OpenSubmit web server
         # Shared secret with OpenSubmit web server
         'secret': '49846zut93purfh977TTTiuhgalkjfnk89',
-        'uuid': uuid.getnode()
+        'uuid': uuid.getnode(),
+        'connect_timeout': '10',                 # Waiting time for new connections, in seconds
+        'read_timeout': '60',                    # Waiting time for answer data, in seconds
+        'retries': '3'                           # Repetitions for failed requests
     },
     'Logging': {
         'format': '%%(asctime)-15s (%%(process)d): %%(message)s',
@@ -58,6 +69,14 @@ secret={secret}
 # UUID of this executor
 uuid={uuid}
 
+# Connections to the server are kept open and reused.
+# Timeouts (in seconds) for establishing a connection and for waiting
+# on data from the server. Failed requests are repeated a few times,
+# with random waiting times in between.
+connect_timeout={connect_timeout}
+read_timeout={read_timeout}
+retries={retries}
+
 [Execution]
 
 # Place where downloaded archives are extracted, compiled and validated
@@ -73,6 +92,28 @@ cleanup={cleanup}
 # Script interpreter to be used for the validation scripts
 script_runner={script_runner}
 
+# Validator downloads are cached in this directory, so that they are only
+# fetched again when the assignment gets a new validator. When the cache
+# exceeds cache_size megabytes, the least recently used validators are removed.
+# A cache_size of 0 disables the cache.
+cache_dir={cache_dir}
+cache_size={cache_size}
+
+# Validator archives are unpacked only once into the cache. Jobs get copies
+# of the unpacked files, which are cheap on copy-on-write file systems.
+# Hardlinks are even cheaper, but student code could then modify the cached
+# validator files, which is only detected for later jobs.
+hardlink_validators={hardlink_validators}
+
+# Job results are stored in this directory until the server accepted them.
+# Undelivered results are sent again by 'opensubmit-exec daemon' and on
+# the next 'opensubmit-exec run', so they survive server outages and restarts.
+outbox_dir={outbox_dir}
+
+# Number of jobs being executed in parallel by 'opensubmit-exec daemon'.
+# Validators can still demand to run alone on the machine.
+slots={slots}
+
 # Validators can decide to run alone on the machine.
 # In this case, the following lock file is used.
 pidfile={pidfile}
@@ -89,6 +130,18 @@ message_size={message_size}
 # Customize the compilation command to be executed
 compile_cmd={compile_cmd}
 
+# Polling interval range (in seconds) for 'opensubmit-exec daemon'.
+# Jobs are fetched back-to-back as long as the server has work.
+# On every empty answer, the waiting time is doubled, starting
+# from poll_min and going up to poll_max.
+poll_min={poll_min}
+poll_max={poll_max}
+
+# Maximum time (in seconds) the server may hold back an empty answer
+# to 'opensubmit-exec daemon', in case that new work shows up meanwhile.
+# Set to 0 for plain polling. Older servers always answer immediately.
+long_poll={long_poll}
+
 [Logging]
 
 # Logging format, as described in the Python logging module documentation
@@ -0,0 +1,215 @@
+'''
+    Persistent HTTP connections to the OpenSubmit server.
+
+    All server communication of the executor goes through urlopen() from
+    this module. It behaves like the urllib version, but keeps the connections
+    open for the next request, and retries failed requests a few times.
+'''
+
+from urllib.parse import urlsplit, urljoin, urlencode
+from urllib.error import HTTPError, URLError
+import http.client
+import io
+import os
+import random
+import threading
+import time
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+# Number of idle connections kept per server
+MAX_IDLE = 4
+# Base and maximum waiting time between retries, in seconds
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 10
+# Trailing data that is read to keep a connection usable
+DRAIN_LIMIT = 64 * 1024
+
+_lock = threading.Lock()
+_idle = {}
+_pid = None
+
+
+def _get_connection(key, connect_timeout):
+    '''
+    Returns an idle connection for the given (scheme, host, port)
+    key, or a new one. Forked job processes never get the
+    connections of their parent.
+    '''
+    global _pid, _idle
+    with _lock:
+        if _pid != os.getpid():
+            _pid = os.getpid()
+            _idle = {}
+        if _idle.get(key):
+            return _idle[key].pop()
+    scheme, host, port = key
+    if scheme == 'https':
+        return http.client.HTTPSConnection(host, port, timeout=connect_timeout)
+    else:
+        return http.client.HTTPConnection(host, port, timeout=connect_timeout)
+
+
+def _put_connection(key, conn):
+    '''
+    Hands a connection back for the next request.
+    '''
+    with _lock:
+        if _pid == os.getpid() and len(_idle.setdefault(key, [])) < MAX_IDLE:
+            _idle[key].append(conn)
+            return
+    conn.close()
+
+
+def close_connections():
+    '''
+    Closes all idle connections.
+    '''
+    with _lock:
+        for conns in _idle.values():
+            for conn in conns:
+                conn.close()
+        _idle.clear()
+
+
+class Response():
+    '''
+    The answer for a request, with the interface of urllib responses.
+    The connection is handed back when the body was read completely.
+    '''
+
+    def __init__(self, url, key, conn, response):
+        self.url = url
+        self.code = self.status = response.status
+        self.headers = response.msg
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+    def info(self):
+        return self.headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn:
+            # Small leftovers, such as TAR padding, are consumed
+            # to keep the connection
+            if not self._response.isclosed():
+                self._response.read(DRAIN_LIMIT)
+            self._release()
+
+    def _release(self):
+        if not self._conn:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            _put_connection(self._key, self._conn)
+        else:
+            self._conn.close()
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _retry_allowed(method, error, reused):
+    '''
+    Decide if a failed request can be sent again.
+    GET requests are always repeatable. Other requests are only
+    repeated when the server cannot have seen them.
+    '''
+    if method == 'GET' or isinstance(error, ConnectionRefusedError):
+        return True
+    # The server closed an idle connection before we sent the request
+    return reused and isinstance(error, (http.client.RemoteDisconnected,
+                                         BrokenPipeError, ConnectionResetError))
+
+
+def _send(config, method, url, body, headers, timeout):
+    '''
+    Sends a request and returns the Response object,
+    with retries and backoff for network problems.
+    '''
+    parts = urlsplit(url)
+    key = (parts.scheme, parts.hostname, parts.port)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    retries = config.getint("Server", "retries")
+    connect_timeout = config.getfloat("Server", "connect_timeout")
+    if timeout is None:
+        timeout = config.getfloat("Server", "read_timeout")
+
+    attempt = 0
+    while True:
+        conn = _get_connection(key, connect_timeout)
+        reused = conn.sock is not None
+        try:
+            if not reused:
+                conn.connect()
+            conn.sock.settimeout(timeout)
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            if attempt >= retries or not _retry_allowed(method, e, reused):
+                raise URLError(e)
+            attempt += 1
+            # Full jitter, so that several executors do not come back at once
+            delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** attempt))
+            logger.debug("Request to {0} failed ({1}), retrying in {2:.1f} seconds".format(url, e, delay))
+            time.sleep(delay)
+            continue
+        return Response(url, key, conn, response)
+
+
+def urlopen(config, url, data=None, headers={}, timeout=None):
+    '''
+    Fetch the given URL, with a POST request if data is given.
+    Data is a dictionary or a list of pairs, sent form-encoded,
+    or bytes that are sent as they are.
+
+    The timeout (in seconds) applies to the wait for each piece of the
+    answer, the default is taken from the configuration.
+
+    Like in urllib, error answers raise a HTTPError, and network
+    problems raise a URLError.
+    '''
+    headers = dict(headers)
+    if data is None:
+        method, body = 'GET', None
+    elif isinstance(data, bytes):
+        method, body = 'POST', data
+    else:
+        method = 'POST'
+        body = urlencode(data).encode("utf-8", errors="ignore")
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+    for redirect in range(5):
+        response = _send(config, method, url, body, headers, timeout)
+        if response.code < 300:
+            return response
+        # Error pages are read completely to keep the connection
+        content = response.read()
+        response.close()
+        location = response.headers['Location']
+        if method == 'GET' and location and response.code in (301, 302, 303, 307, 308):
+            url = urljoin(url, location)
+            continue
+        raise HTTPError(url, response.code, response._response.reason,
+                        response.headers, io.BytesIO(content))
+    raise URLError("Too many redirects for " + url)
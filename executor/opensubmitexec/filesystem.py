@@ -7,12 +7,16 @@ import tarfile
 import os
 import tempfile
 import shutil
+import fcntl
 
 from .exceptions import JobException
 
 import logging
 logger = logging.getLogger('opensubmitexec')
 
+# ioctl request code for copy-on-write file cloning on Linux
+FICLONE = 0x40049409
+
 
 def unpack_if_needed(destination_path, fpath):
     '''
@@ -111,6 +115,36 @@ def unpack_if_needed(destination_path, fpath):
     return single_dir, did_unpack
 
 
+def copy_tree(src_dir, dst_dir, hardlink=False):
+    '''
+    Re-create all files from src_dir in dst_dir, overwriting existing ones.
+
+    Files are hardlinked if demanded, otherwise cloned on file systems
+    that support copy-on-write (such as btrfs or XFS), and copied as last resort.
+    '''
+    for root, dirs, files in os.walk(src_dir):
+        target_root = os.path.join(dst_dir, os.path.relpath(root, src_dir))
+        os.makedirs(target_root, exist_ok=True)
+        for fname in files:
+            src = os.path.join(root, fname)
+            dst = os.path.join(target_root, fname)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if hardlink:
+                try:
+                    os.link(src, dst)
+                    continue
+                except OSError:
+                    # e.g. different file system
+                    pass
+            with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                except OSError:
+                    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+            shutil.copystat(src, dst)
+
+
 def remove_working_directory(directory, config):
     if config.getboolean("Execution", "cleanup") is True:
         shutil.rmtree(directory, ignore_errors=True)
@@ -135,12 +169,15 @@ def create_working_dir(config, prefix):
     return finalpath
 
 
-def prepare_working_directory(job, submission_path, validator_path):
+def prepare_working_directory(job, submission_path, validator_path=None, validator_cache=None):
     '''
     Based on two downloaded files in the working directory,
     the student submission and the validation package,
     the working directory is prepared.
 
+    Without validator path, the validation package is taken from the
+    given validator cache instead, which delivers it already unpacked.
+
     We unpack student submission first, so that teacher files overwrite
     them in case.
 
@@ -161,7 +198,6 @@ def prepare_working_directory(job, submission_path, validator_path):
         raise JobException(info_student=info_student, info_tutor=info_tutor)
 
     submission_fname = os.path.basename(submission_path)
-    validator_fname = os.path.basename(validator_path)
 
     # Un-archive student submission
     single_dir, did_unpack = unpack_if_needed(job.working_dir, submission_path)
@@ -182,20 +218,25 @@ def prepare_working_directory(job, submission_path, validator_path):
             "The submission archive contains only one directory. Changing working directory.")
         # Set new working directory
         job.working_dir = job.working_dir + single_dir + os.sep
-        # Move validator package there
-        shutil.move(validator_path, job.working_dir)
-        validator_path = job.working_dir + validator_fname
+        if validator_path:
+            # Move validator package there
+            shutil.move(validator_path, job.working_dir)
+            validator_path = job.working_dir + os.path.basename(validator_path)
         # Re-scan for list of student files
         job.student_files = os.listdir(job.working_dir)
 
-    # The working directory now only contains the student data and the downloaded
-    # validator package.
-    # Update the file list accordingly.
-    job.student_files.remove(validator_fname)
-    logger.debug("Student files: {0}".format(job.student_files))
-
-    # Unpack validator package
-    single_dir, did_unpack = unpack_if_needed(job.working_dir, validator_path)
+    if validator_path:
+        # The working directory now only contains the student data and the downloaded
+        # validator package.
+        # Update the file list accordingly.
+        job.student_files.remove(os.path.basename(validator_path))
+        logger.debug("Student files: {0}".format(job.student_files))
+        # Unpack validator package
+        single_dir, did_unpack = unpack_if_needed(job.working_dir, validator_path)
+    else:
+        logger.debug("Student files: {0}".format(job.student_files))
+        single_dir, did_unpack, validator_path = validator_cache.fetch_unpacked(
+            job.validator_url, job.working_dir)
     if single_dir:
         info_student = "Internal error with the validator. Please contact your course responsible."
         info_tutor = "Error: Directories are not allowed in the validator archive."
@@ -4,7 +4,7 @@ import importlib
 
 from .config import read_config
 from .exceptions import *
-from .server import send_post
+from .outbox import ResultOutbox
 from .filesystem import remove_working_directory
 
 import logging
@@ -23,6 +23,8 @@ class InternalJob():
     _online = None
     # Action requested by the server (legacy)
     action = None
+    # Share of the executor host, see locking.SlotLock
+    _slot_lock = None
 
     submission_url = None
     validator_url = None
@@ -139,6 +141,15 @@ class InternalJob():
         # Clean the file system, since we can't do anything else
         remove_working_directory(self.working_dir, self._config)
 
+    def _make_exclusive(self):
+        '''
+        Wait until no other job runs on this executor host.
+        '''
+        if self._slot_lock:
+            self._slot_lock.make_exclusive()
+        else:
+            logger.debug("Job runs without slot lock, so it is already alone.")
+
     def _send_result(self, info_student, info_tutor, error_code):
         post_data = [("SubmissionFileId", self.file_id),
                      ("Message", info_student),
@@ -152,5 +163,6 @@ class InternalJob():
         logger.info(
             'Sending result to OpenSubmit Server: ' + str(post_data))
         if self._online:
-            send_post(self._config, "/jobs/", post_data)
+            # Undelivered results are sent again later by the daemon
+            ResultOutbox(self._config).send(post_data)
         self.result_sent = True
@@ -169,7 +169,7 @@ class Job(InternalJob):
         """
         logger.debug("Spawning program for interaction ...")
         if exclusive:
-            kill_longrunning(self.config)
+            self._make_exclusive()
 
         return RunningProgram(self, name, arguments, timeout)
 
@@ -190,7 +190,7 @@ class Job(InternalJob):
         """
         logger.debug("Running program ...")
         if exclusive:
-            kill_longrunning(self.config)
+            self._make_exclusive()
 
         prog = RunningProgram(self, name, arguments, timeout)
         return prog.expect_end()
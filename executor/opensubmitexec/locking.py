@@ -3,6 +3,8 @@
 '''
 
 from twisted.python.lockfile import FilesystemLock
+from contextlib import contextmanager
+import fcntl
 import os
 
 import logging
@@ -43,3 +45,62 @@ class ScriptLock():
         '''
         logger.debug("Releasing script lock")
         self.flock.unlock()
+
+
+class SlotLock():
+    '''
+    Host-wide lock held by every running job.
+
+    All jobs hold it in shared mode, so that they can run in parallel.
+    A validator asking for exclusive execution converts it into an
+    exclusive lock. This waits for all other jobs to finish, and keeps
+    new jobs from starting until the exclusive job is done.
+    '''
+    config = None
+    slots = None
+    exclusive = False
+
+    def __init__(self, config):
+        self.config = config
+
+    @contextmanager
+    def _gate(self):
+        '''
+        Serializes lock acquisition, so that a pending exclusive
+        request is not starved by newly starting jobs.
+        '''
+        with open(self.config.get("Execution", "pidfile") + '.gate', 'a') as gate:
+            fcntl.flock(gate, fcntl.LOCK_EX)
+            yield
+
+    def __enter__(self):
+        '''
+        Be a context manager.
+        '''
+        self.slots = open(self.config.get("Execution", "pidfile") + '.slots', 'a')
+        with self._gate():
+            fcntl.flock(self.slots, fcntl.LOCK_SH)
+        return self
+
+    def make_exclusive(self):
+        '''
+        Wait until this job is the only one running on the machine.
+        '''
+        if self.exclusive:
+            return
+        logger.info("Waiting for exclusive use of this machine")
+        # Drop the shared lock before queueing up, otherwise two jobs
+        # asking for exclusive execution would wait for each other
+        fcntl.flock(self.slots, fcntl.LOCK_UN)
+        with self._gate():
+            fcntl.flock(self.slots, fcntl.LOCK_EX)
+        self.exclusive = True
+        logger.debug("Got exclusive use of this machine")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''
+        Be a context manager.
+        '''
+        # Closing the file releases the lock
+        self.slots.close()
+        self.exclusive = False
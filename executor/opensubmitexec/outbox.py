@@ -0,0 +1,194 @@
+'''
+    On-disk outbox for job results.
+'''
+
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+import fcntl
+import json
+import os
+import random
+import tempfile
+import time
+
+from .connection import urlopen
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+# Base and maximum waiting time between delivery attempts, in seconds
+RETRY_BACKOFF = 5
+RETRY_BACKOFF_MAX = 600
+
+
+class ResultOutbox():
+    '''
+    Job results are written to disk before they are sent to the server,
+    and only removed after the server accepted them. Results that could
+    not be delivered are sent again by replay(), with growing waiting
+    times in between.
+
+    Each result is one file in the outbox directory. The sender holds a
+    lock on the file, so that parallel replays never deliver a result twice.
+    Replays send all due results in one bulk upload, if the server supports it.
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.directory = config.get("Execution", "outbox_dir")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def send(self, post_data):
+        '''
+        Journal the result POST data, and try to deliver it.
+
+        Returns True if the result is delivered.
+        '''
+        entry = {'post_data': post_data,
+                 'attempts': 0,
+                 'next_try': 0}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            self._write(f, entry)
+        fname = os.path.join(self.directory, '%017.6f-%u.json' % (time.time(), os.getpid()))
+        os.replace(tmp, fname)
+        return self._deliver(fname)
+
+    def replay(self):
+        '''
+        Try to deliver all results from the outbox that are due,
+        oldest first. Several results are sent in one bulk upload.
+
+        Returns the number of results still waiting for delivery.
+        '''
+        batch = []
+        try:
+            for fname in sorted(os.listdir(self.directory)):
+                if fname.endswith('.json'):
+                    item = self._open(os.path.join(self.directory, fname), due_only=True)
+                    if item:
+                        batch.append(item)
+            if len(batch) < 2 or not self._send_bulk(batch):
+                for f, fname, entry in batch:
+                    self._send(f, fname, entry)
+        finally:
+            for f, fname, entry in batch:
+                f.close()
+        return len([fname for fname in os.listdir(self.directory) if fname.endswith('.json')])
+
+    def _write(self, f, entry):
+        f.seek(0)
+        f.truncate()
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+
+    def _open(self, fname, due_only=False):
+        '''
+        Open and lock the given outbox file.
+
+        Returns the open file, its name and its content, or None if the
+        result is gone, not due, or sent by somebody else right now.
+        '''
+        try:
+            f = open(fname, 'r+')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            if os.fstat(f.fileno()).st_nlink == 0:
+                # Delivered by somebody else meanwhile
+                raise FileNotFoundError
+            entry = json.load(f)
+            if due_only and entry['next_try'] > time.time():
+                raise BlockingIOError
+        except (BlockingIOError, FileNotFoundError):
+            f.close()
+            return None
+        return f, fname, entry
+
+    def _deliver(self, fname):
+        '''
+        Send the result from the given outbox file.
+
+        Returns True if the file is gone.
+        '''
+        item = self._open(fname)
+        if not item:
+            return not os.path.exists(fname)
+        f, fname, entry = item
+        with f:
+            return self._send(f, fname, entry)
+
+    def _send(self, f, fname, entry):
+        '''
+        Send the result from the given locked outbox file.
+        On success, or if the server rejects it for good, the file is removed.
+
+        Returns True if the file is gone.
+        '''
+        try:
+            url = self.config.get("Server", "url") + "/jobs/"
+            post_data = [tuple(item) for item in entry['post_data']]
+            with urlopen(self.config, url, post_data) as response:
+                response.read()
+        except HTTPError as e:
+            if e.code < 500:
+                logger.error("Server rejected result {0}, dropping it: {1}".format(fname, e))
+                os.remove(fname)
+                return True
+            self._postpone(f, fname, entry, e)
+            return False
+        except URLError as e:
+            self._postpone(f, fname, entry, e)
+            return False
+        logger.debug("Delivered result {0}".format(fname))
+        os.remove(fname)
+        return True
+
+    def _send_bulk(self, batch):
+        '''
+        Send the results from the given locked outbox files in one request.
+
+        Returns False if the server does not offer bulk uploads or rejects
+        the request, so that the results must be sent one by one.
+        '''
+        url = "%s/jobs/results/?%s" % (self.config.get("Server", "url"),
+                                       urlencode([("Secret", self.config.get("Server", "secret")),
+                                                  ("UUID", self.config.get("Server", "uuid"))]))
+        lines = []
+        for f, fname, entry in batch:
+            result = {key: value for key, value in entry['post_data']
+                      if key not in ('Secret', 'UUID')}
+            lines.append(json.dumps(result))
+        try:
+            with urlopen(self.config, url, '\n'.join(lines).encode('utf-8'),
+                         headers={'Content-Type': 'application/x-ndjson'}) as response:
+                response.read()
+        except HTTPError as e:
+            if e.code < 500:
+                logger.debug("Bulk result upload not possible ({0}), sending results one by one.".format(e))
+                return False
+            error = e
+        except URLError as e:
+            error = e
+        else:
+            logger.debug("Delivered {0} results in one upload".format(len(batch)))
+            for f, fname, entry in batch:
+                os.remove(fname)
+            return True
+        for f, fname, entry in batch:
+            self._postpone(f, fname, entry, error)
+        return True
+
+    def _postpone(self, f, fname, entry, error):
+        '''
+        Schedule the next delivery attempt for the given locked outbox file.
+        '''
+        entry['attempts'] += 1
+        delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF * 2 ** entry['attempts'])
+        delay = random.uniform(delay / 2, delay)
+        entry['next_try'] = time.time() + delay
+        self._write(f, entry)
+        logger.warning("Could not deliver result {0} ({1}), trying again in {2:.0f} seconds.".format(
+            fname, error, delay))
@@ -0,0 +1,76 @@
+'''
+    Parallel execution of jobs on one executor host.
+'''
+
+import multiprocessing
+from multiprocessing.connection import wait
+
+from .locking import SlotLock
+
+import logging
+logger = logging.getLogger('opensubmitexec')
+
+
+def run_job(job):
+    '''
+    Execute a fetched job while holding its share of the host.
+    '''
+    with SlotLock(job._config) as slot_lock:
+        job._slot_lock = slot_lock
+        job._run_validate()
+
+
+class SlotScheduler():
+    '''
+    Runs fetched jobs in child processes, one per job slot.
+
+    The number of slots is configured in the 'slots' setting of
+    the [Execution] section. Each job runs in its own process, so
+    that validators cannot interfere through the interpreter state.
+    '''
+    slots = None
+    running = None
+
+    def __init__(self, config):
+        self.slots = max(1, config.getint("Execution", "slots"))
+        self.running = []
+        # Jobs are prepared in the parent, so they must be inherited
+        self._context = multiprocessing.get_context('fork')
+
+    def _reap(self):
+        for proc in [proc for proc in self.running if not proc.is_alive()]:
+            proc.join()
+            logger.debug("Job process {0} finished with exit code {1}.".format(proc.pid, proc.exitcode))
+            self.running.remove(proc)
+
+    def free_slots(self):
+        '''
+        Returns the number of jobs that can be started right now.
+        '''
+        self._reap()
+        return self.slots - len(self.running)
+
+    def start(self, job):
+        '''
+        Run the given job in a free slot.
+        '''
+        assert(self.free_slots() > 0)
+        proc = self._context.Process(target=run_job, args=(job,))
+        proc.start()
+        logger.debug("Started job process {0} for submission {1}.".format(proc.pid, job.sub_id))
+        self.running.append(proc)
+
+    def wait(self, timeout=None):
+        '''
+        Block until some job finishes, or the timeout (in seconds) expires.
+        '''
+        if self.running:
+            wait([proc.sentinel for proc in self.running], timeout)
+        self._reap()
+
+    def join(self):
+        '''
+        Block until all running jobs are finished.
+        '''
+        while self.running:
+            self.wait()
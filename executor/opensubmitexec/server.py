@@ -7,35 +7,59 @@ import os
 import shutil
 import os.path
 import glob
+import hashlib
 import json
+import tarfile
 
 from .exceptions import *
 from .filesystem import *
 from .hostinfo import ipaddress, all_host_infos
+from .cache import ValidatorCache
 
-from urllib.request import urlopen, urlretrieve
+from .connection import urlopen
 from urllib.error import HTTPError, URLError
-from urllib.parse import urlencode
 
 import logging
 logger = logging.getLogger('opensubmitexec')
 
 
-def fetch(url, fullpath):
+def fetch(config, url, fullpath):
     '''
     Fetch data from an URL and save it under the given target name.
     '''
     logger.debug("Fetching %s from %s" % (fullpath, url))
 
     try:
-        tmpfile, headers = urlretrieve(url)
-        if os.path.exists(fullpath):
-            os.remove(fullpath)
-        shutil.move(tmpfile, fullpath)
+        with urlopen(config, url) as response:
+            receive_file(response, fullpath)
     except Exception as e:
         logger.error("Error during fetching: " + str(e))
         raise
 
+
+def receive_file(payload, fullpath, size=None, checksum=None):
+    '''
+    Copy the data from the payload file object to the given target name,
+    in chunks of fixed size.
+
+    If given, the number of bytes and the SHA-256 hex digest of
+    the data are checked at the end.
+    '''
+    digest = hashlib.sha256()
+    received = 0
+    with open(fullpath, 'wb') as target:
+        for chunk in iter(lambda: payload.read(64 * 1024), b''):
+            digest.update(chunk)
+            target.write(chunk)
+            received += len(chunk)
+    if size is not None and received != int(size):
+        raise JobException(info_student="Internal error while receiving your submission on the test machine.",
+                           info_tutor="Submission download incomplete, got %u of %s bytes." % (received, size))
+    if checksum is not None and digest.hexdigest() != checksum:
+        raise JobException(info_student="Internal error while receiving your submission on the test machine.",
+                           info_tutor="Submission download corrupted, checksum mismatch.")
+
+
 def send_post(config, urlpath, post_data):
     '''
     Send POST data to an OpenSubmit server url path,
@@ -43,11 +67,10 @@ def send_post(config, urlpath, post_data):
     '''
     server = config.get("Server", "url")
     logger.debug("Sending executor payload to " + server)
-    post_data = urlencode(post_data)
-    post_data = post_data.encode("utf-8", errors="ignore")
     url = server + urlpath
     try:
-        urlopen(url, post_data)
+        with urlopen(config, url, post_data) as response:
+            response.read()
     except Exception as e:
         logger.error('Error while sending data to server: ' + str(e))
 
@@ -86,86 +109,158 @@ def compatible_api_version(server_version):
         return False
 
 
-def fetch_job(config):
+def fetch_job(config, wait=0):
     '''
     Fetch any available work from the OpenSubmit server and
     return an according job object.
 
+    With a positive wait time (in seconds), the server may hold back
+    the answer until some work shows up (long polling).
+
     Returns None if no work is available.
 
+    Errors are reported by this function directly.
+    '''
+    jobs = fetch_jobs(config, 0, wait)
+    if jobs:
+        return jobs[0]
+    else:
+        return None
+
+
+def fetch_jobs(config, count, wait=0):
+    '''
+    Fetch up to count jobs from the OpenSubmit server in one request,
+    and return a list of according job objects.
+
+    The server delivers them as TAR archive, with a manifest of the
+    job descriptions as first member. Older servers ignore the count and
+    deliver a single job, with the description in the HTTP headers.
+    A count of zero always asks for the latter.
+
+    With a positive wait time (in seconds), the server may hold back
+    the answer until some work shows up (long polling).
+
+    Returns an empty list if no work is available.
+
     Errors are reported by this function directly.
     '''
     url = "%s/jobs/?Secret=%s&UUID=%s" % (config.get("Server", "url"),
                                           config.get("Server", "secret"),
                                           config.get("Server", "uuid"))
+    if wait > 0:
+        url += "&Wait=%u" % wait
+    if count > 0:
+        url += "&Count=%u" % count
 
     try:
         # Fetch information from server
-        result = urlopen(url)
+        # The server may take the waiting time before answering
+        result = urlopen(config, url, timeout=config.getfloat("Server", "read_timeout") + wait)
+    except HTTPError as e:
+        if e.code == 404:
+            logger.debug("Nothing to do.")
+        return []
+    except URLError as e:
+        logger.error("Error while contacting {0}: {1}".format(url, str(e)))
+        return []
+
+    with result:
         headers = result.info()
         logger.debug("Raw job data: " + str(result.headers).replace('\n', ', '))
         if not compatible_api_version(headers["APIVersion"]):
             # No proper reporting possible, so only logging.
             logger.error("Incompatible API version. Please update OpenSubmit.")
-            return None
+            return []
 
         if headers["Action"] == "get_config":
             # The server does not know us,
             # so it demands registration before hand.
             logger.info("Machine unknown on server, sending registration ...")
             send_hostinfo(config)
-            return None
-
-        # Create job object with information we got
-        from .job import Job
-        job = Job(config)
-
-        job.submitter_name = headers['SubmitterName']
-        job.author_names = headers['AuthorNames']
-        job.submitter_studyprogram = headers['SubmitterStudyProgram']
-        job.course = headers['Course']
-        job.assignment = headers['Assignment']
-        job.action = headers["Action"]
-        job.file_id = headers["SubmissionFileId"]
-        job.sub_id = headers["SubmissionId"]
-        job.file_name = headers["SubmissionOriginalFilename"]
-        job.submitter_student_id = headers["SubmitterStudentId"]
-        if "Timeout" in headers:
-            job.timeout = int(headers["Timeout"])
-        if "PostRunValidation" in headers:
-            # Ignore server-given host + port and use the configured one instead
-            # This fixes problems with the arbitrary Django LiveServer port choice
-            # It would be better to return relative URLs only for this property,
-            # but this is a Bernhard-incompatible API change
-            from urllib.parse import urlparse
-            relative_path = urlparse(headers["PostRunValidation"]).path
-            job.validator_url = config.get("Server", "url") + relative_path
-        job.working_dir = create_working_dir(config, job.sub_id)
+            return []
 
-        # Store submission in working directory
-        submission_fname = job.working_dir + job.file_name
-        with open(submission_fname, 'wb') as target:
-            target.write(result.read())
-        assert(os.path.exists(submission_fname))
+        if "JobCount" not in headers:
+            job = create_job(config, headers, result)
+            return [job] if job else []
 
-        # Store validator package in working directory
-        validator_fname = job.working_dir + 'download.validator'
-        fetch(job.validator_url, validator_fname)
+        jobs = []
+        with tarfile.open(fileobj=result, mode='r|') as archive:
+            manifest = None
+            for member in archive:
+                data = archive.extractfile(member)
+                if member.name == 'manifest.json':
+                    manifest = {desc['File']: desc for desc in json.loads(data.read().decode('utf-8'))}
+                else:
+                    job = create_job(config, manifest[member.name], data)
+                    if job:
+                        jobs.append(job)
+        return jobs
+
+
+def create_job(config, desc, payload):
+    '''
+    Create a job object from the job description of the server,
+    either given as HTTP headers or as manifest entry.
+    The submission file is read from the payload file object.
 
-        try:
+    Returns None if the submission or the validator could not be
+    received, or if the working directory could not be prepared.
+    The failure is reported to the server as job result.
+    '''
+    from .job import Job
+    job = Job(config)
+
+    job.submitter_name = desc['SubmitterName']
+    job.author_names = desc['AuthorNames']
+    job.submitter_studyprogram = desc['SubmitterStudyProgram']
+    job.course = desc['Course']
+    job.assignment = desc['Assignment']
+    job.action = desc["Action"]
+    job.file_id = desc["SubmissionFileId"]
+    job.sub_id = desc["SubmissionId"]
+    job.file_name = desc["SubmissionOriginalFilename"]
+    job.submitter_student_id = desc["SubmitterStudentId"]
+    if "Timeout" in desc:
+        job.timeout = int(desc["Timeout"])
+    if "PostRunValidation" in desc:
+        # Ignore server-given host + port and use the configured one instead
+        # This fixes problems with the arbitrary Django LiveServer port choice
+        # It would be better to return relative URLs only for this property,
+        # but this is a Bernhard-incompatible API change
+        from urllib.parse import urlparse
+        relative_path = urlparse(desc["PostRunValidation"]).path
+        job.validator_url = config.get("Server", "url") + relative_path
+    job.working_dir = create_working_dir(config, job.sub_id)
+
+    submission_fname = job.working_dir + job.file_name
+    try:
+        # Store submission in working directory
+        # Older servers send no size and checksum information
+        receive_file(payload, submission_fname,
+                     desc.get("SubmissionSize", desc.get("Content-Length")),
+                     desc.get("SubmissionChecksum"))
+        if config.getfloat("Execution", "cache_size") > 0:
+            # Validator package comes unpacked from the cache
+            prepare_working_directory(job, submission_fname,
+                                      validator_cache=ValidatorCache(config))
+        else:
+            # Store validator package in working directory
+            validator_fname = job.working_dir + 'download.validator'
+            fetch(config, job.validator_url, validator_fname)
             prepare_working_directory(job, submission_fname, validator_fname)
-        except JobException as e:
-            job.send_fail_result(e.info_student, e.info_tutor)
-            return None
-        logger.debug("Got job: " + str(job))
-        return job
-    except HTTPError as e:
-        if e.code == 404:
-            logger.debug("Nothing to do.")
-            return None
+    except JobException as e:
+        job.send_fail_result(e.info_student, e.info_tutor)
+        return None
     except URLError as e:
-        logger.error("Error while contacting {0}: {1}".format(url, str(e)))
+        # Also covers HTTPError. Only this job is lost, the others
+        # from the same batch are still prepared.
+        logger.error("Error while fetching the validator from {0}: {1}".format(job.validator_url, str(e)))
+        job.send_fail_result("Internal error while preparing the test machine.",
+                             "Validator download failed: " + str(e))
         return None
+    logger.debug("Got job: " + str(job))
+    return job
 
 
 def fake_fetch_job(config, src_dir):
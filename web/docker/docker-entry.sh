@@ -29,6 +29,18 @@ echo "Database is up."
 # perform relevant database migrations, check file permissions
 opensubmit-web configtest
 
+# Reset executor jobs that got no result in time
+while true; do opensubmit-web expirejobs; sleep 60; done &
+
+# Send queued student notification mails
+while true; do opensubmit-web sendmails; sleep 10; done &
+
+# Compute checksums of new student files
+while true; do opensubmit-web updatechecksums; sleep 60; done &
+
+# Keep course archives up-to-date
+while true; do opensubmit-web buildarchives; sleep 60; done &
+
 # Make sure Apache really loads the new configs
 /etc/init.d/apache2 stop
 /etc/init.d/apache2 start
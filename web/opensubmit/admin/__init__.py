@@ -1,5 +1,5 @@
 from django.contrib.auth.models import User, Permission, Group
-from opensubmit.models import Course, Grading, GradingScheme, Assignment, SubmissionFile, Submission, TestMachine, StudyProgram
+from opensubmit.models import Course, Grading, GradingScheme, Assignment, SubmissionFile, Submission, TestMachine, StudyProgram, MailDispatch
 from django.conf import settings
 from django.contrib.admin.sites import AdminSite
 from django.contrib.auth.views import redirect_to_login
@@ -15,6 +15,7 @@ from .assignment import AssignmentAdmin
 from .submissionfile import SubmissionFileAdmin
 from .submission import SubmissionAdmin
 from .studyprogram import StudyProgramAdmin
+from .maildispatch import MailDispatchAdmin
 
 
 def _social_auth_login(self, request, **kwargs):
@@ -53,3 +54,4 @@ teacher_backend.register(SubmissionFile, SubmissionFileAdmin)
 teacher_backend.register(Submission, SubmissionAdmin)
 teacher_backend.register(Course, CourseAdmin)
 teacher_backend.register(StudyProgram, StudyProgramAdmin)
+teacher_backend.register(MailDispatch, MailDispatchAdmin)
@@ -0,0 +1,37 @@
+from django.contrib.admin import ModelAdmin
+from django.db.models import Case, Count, IntegerField, Sum, When
+
+from opensubmit import mails
+
+
+def sent(dispatch):
+    return dispatch.total - dispatch.num_pending
+
+
+def failed(dispatch):
+    return dispatch.num_failed or 0
+
+
+class MailDispatchAdmin(ModelAdmin):
+    ''' Shows the progress of mails sent in the background.'''
+    list_display = ['__str__', 'sender', 'created', 'total', sent, failed]
+    readonly_fields = ['subject', 'sender', 'created', 'total', sent, failed]
+    list_select_related = ['sender']
+
+    class Media:
+        css = {'all': ('css/teacher.css',)}
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_queryset(self, request):
+        ''' Restrict the listed mail dispatches for the current user.
+            The mail counts are determined in the same query.'''
+        qs = super(MailDispatchAdmin, self).get_queryset(request)
+        qs = qs.annotate(num_pending=Count('mails'),
+                         num_failed=Sum(Case(When(mails__attempts__gte=mails.MAIL_MAX_ATTEMPTS, then=1),
+                                             default=0, output_field=IntegerField())))
+        if request.user.is_superuser:
+            return qs
+        else:
+            return qs.filter(sender=request.user)
@@ -2,17 +2,18 @@
 
 from django.contrib.admin import SimpleListFilter, ModelAdmin
 from django.utils.translation import ugettext_lazy as _
+from django.db import transaction
 from django.db.models import Q
+from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
 from django.utils.safestring import mark_safe
 from django.http import HttpResponse
 from django.utils.html import format_html
-from opensubmit.models import Assignment, Submission, Grading
+from opensubmit.models import Assignment, Submission, Grading, MailDispatch
+from opensubmit.mails import queue_mass_mail, student_mail
+from opensubmit.views.helpers import zip_response
 from django.utils import timesince
 
-import io
-import zipfile
-
 
 def grading_file(submission):
     ''' Determines if the submission has a grading file,
@@ -306,18 +307,20 @@ class SubmissionAdmin(ModelAdmin):
             and inform the student. CLosing only graded submissions is a safeguard,
             since backend users tend to checkbox-mark all submissions without thinking.
         '''
-        mails = []
         qs = queryset.filter(Q(state=Submission.GRADED))
-        for subm in qs:
-            subm.inform_student(request, Submission.CLOSED)
-            mails.append(str(subm.pk))
-        # works in bulk because inform_student never fails
-        qs.update(state=Submission.CLOSED)
-        if len(mails) == 0:
+        qs = qs.select_related('assignment__course__owner').prefetch_related('authors')
+        closed = [str(subm.pk) for subm in qs]
+        if len(closed) == 0:
             self.message_user(request, "Nothing closed, no mails sent.")
-        else:
-            self.message_user(
-                request, "Mail sent for submissions: " + ",".join(mails))
+            return
+        # The mails are sent in the background
+        with transaction.atomic():
+            dispatch = MailDispatch.objects.create(subject="Notification for closed submissions", sender=request.user)
+            queue_mass_mail(dispatch, filter(None, (student_mail(subm, request, Submission.CLOSED) for subm in qs)))
+            Submission.objects.filter(pk__in=closed).update(state=Submission.CLOSED)
+        self.message_user(request, format_html(
+            "Closed submissions {}, {} mail(s) queued for sending (<a href=\"{}\">progress</a>).",
+            ",".join(closed), dispatch.total, reverse('teacher:opensubmit_maildispatch_changelist')))
     closeAndNotifyAction.short_description = "Close + send student notification for selected submissions"
 
     def sendMailAction(self, request, queryset):
@@ -333,19 +336,12 @@ class SubmissionAdmin(ModelAdmin):
         '''
         Download selected submissions as archive, for targeted correction.
         '''
-        output = io.BytesIO()
-        z = zipfile.ZipFile(output, 'w')
-
-        for sub in queryset:
-            sub.add_to_zipfile(z)
-
-        z.close()
-        # go back to start in ZIP file so that Django can deliver it
-        output.seek(0)
-        response = HttpResponse(
-            output, content_type="application/x-zip-compressed")
-        response['Content-Disposition'] = 'attachment; filename=submissions.zip'
-        return response
+        def fill_zip_file(z):
+            subs = queryset.select_related('submitter', 'grading', 'file_upload').prefetch_related('authors')
+            for sub in subs:
+                sub.add_to_zipfile(z)
+                yield
+        return zip_response(fill_zip_file, 'submissions')
     downloadArchiveAction.short_description = "Download selected submissions as ZIP archive"
 
     # ToDo: Must be refactored to consider new performance data storage model
@@ -0,0 +1,499 @@
+'''
+Helper functions for building ZIP archives from student uploads.
+
+The content of uploaded archives is copied member by member into
+the target ZIP file, without unpacking it on disk. Compressed ZIP
+members are copied as they are, without compressing them again.
+Course archives are additionally kept on disk, see CourseArchive.
+They are built in the background, with the student files compressed
+in parallel worker processes.
+'''
+
+from django.conf import settings
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import fcntl
+import hashlib
+import io
+import json
+import os
+import shutil
+import struct
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import logging
+logger = logging.getLogger('OpenSubmit')
+
+# Size of the chunks in which member data is copied
+CHUNK_SIZE = 64 * 1024
+# Oldest timestamp that can be stored in a ZIP file
+ZIP_EPOCH = (1980, 1, 1, 0, 0, 0)
+# Archive members up to this size get a checksum in the manifest
+MANIFEST_MD5_SIZE = 10000
+# Local file header of a ZIP member: signature, version, flags, compression,
+# time, date, CRC, compressed size, size, name length, extra field length
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+def member_name(name):
+    '''
+    Returns the given archive member name as safe relative path,
+    without leading slashes and parent directory references,
+    or None if nothing is left.
+    '''
+    parts = [part for part in name.replace('\\', '/').split('/')
+             if part not in ('', '.', '..')]
+    return '/'.join(parts) or None
+
+
+def member_data(source, info):
+    '''
+    Returns the file object of the source ZIP file, positioned
+    at the compressed data of the given member.
+    '''
+    source.fp.seek(info.header_offset)
+    header = LOCAL_HEADER.unpack(source.fp.read(LOCAL_HEADER.size))
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile("Bad local header for member %s" % info.filename)
+    source.fp.seek(header[-2] + header[-1], os.SEEK_CUR)
+    return source.fp
+
+
+def _copy_raw(z, source, info, arcname):
+    '''
+    Copy the compressed data of a member from the source ZIP file
+    into the target ZIP file, without decompressing it.
+
+    The local header is created from the source member, with the
+    original checksum and sizes. The zipfile module has no interface
+    for this, so the member is appended to the target file directly,
+    and registered for the central directory that ZipFile.close()
+    writes. Only works for ZIP files opened with mode 'w'.
+    '''
+    if z.mode != 'w':
+        raise ValueError("Raw copies need a ZIP file opened for writing")
+    zinfo = zipfile.ZipInfo(arcname, max(info.date_time, ZIP_EPOCH))
+    zinfo.compress_type = info.compress_type
+    # Encryption and compression options, sizes are known up front
+    zinfo.flag_bits = info.flag_bits & 0x07
+    zinfo.external_attr = info.external_attr
+    zinfo.CRC = info.CRC
+    zinfo.file_size = info.file_size
+    zinfo.compress_size = info.compress_size
+    zip64 = max(info.file_size, info.compress_size) > zipfile.ZIP64_LIMIT
+
+    src = member_data(source, info)
+    zinfo.header_offset = z.fp.tell()
+    z.fp.write(zinfo.FileHeader(zip64))
+    remaining = info.compress_size
+    while remaining > 0:
+        data = src.read(min(CHUNK_SIZE, remaining))
+        if not data:
+            raise zipfile.BadZipFile("Truncated member %s" % info.filename)
+        z.fp.write(data)
+        remaining -= len(data)
+    z.start_dir = z.fp.tell()
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+
+
+def _can_copy_raw(info):
+    # Encrypted members with a data descriptor take the check byte
+    # from the time field, which is not kept
+    if info.flag_bits & 0x01:
+        return not info.flag_bits & 0x08
+    return info.compress_type != zipfile.ZIP_STORED
+
+
+def _copy_stream(z, src, arcname, date_time, size, compress_type=zipfile.ZIP_DEFLATED):
+    '''
+    Compress the data from the given file object into the target ZIP file.
+    Python versions before 3.6 cannot write ZIP members from a stream,
+    the data is read into memory there.
+    '''
+    zinfo = zipfile.ZipInfo(arcname, max(date_time, ZIP_EPOCH))
+    zinfo.compress_type = compress_type
+    if sys.version_info >= (3, 6):
+        # Needed for the ZIP64 decision
+        zinfo.file_size = size
+        with z.open(zinfo, 'w') as dest:
+            shutil.copyfileobj(src, dest, CHUNK_SIZE)
+    else:
+        z.writestr(zinfo, src.read())
+
+
+def _copy_zip(z, path, targetdir):
+    with zipfile.ZipFile(path, 'r') as source:
+        for info in source.infolist():
+            name = member_name(info.filename)
+            if info.filename.endswith('/') or not name:
+                continue
+            if _can_copy_raw(info):
+                _copy_raw(z, source, info, targetdir + name)
+            else:
+                with source.open(info) as src:
+                    _copy_stream(z, src, targetdir + name, info.date_time, info.file_size)
+
+
+def _copy_tar(z, path, targetdir):
+    with tarfile.open(path) as source:
+        for info in source:
+            name = member_name(info.name)
+            if not info.isfile() or not name:
+                continue
+            with source.extractfile(info) as src:
+                date_time = tuple(time.localtime(max(info.mtime, 0))[:6])
+                _copy_stream(z, src, targetdir + name, date_time, info.size)
+
+
+def add_archive_content(z, path, targetdir):
+    '''
+    Add the content of the given file to the ZIP file, below the given
+    target directory (with trailing slash). ZIP and TAR archives are copied
+    member by member, other files are added as they are.
+    '''
+    if not os.path.isfile(path):
+        logger.error("I/O exception while accessing %s." % path)
+        return
+    try:
+        if zipfile.is_zipfile(path):
+            _copy_zip(z, path, targetdir)
+            return
+        elif tarfile.is_tarfile(path):
+            _copy_tar(z, path, targetdir)
+            return
+    except (IOError, zipfile.BadZipFile, tarfile.TarError, NotImplementedError, RuntimeError) as e:
+        # Unpacking not possible (e.g. encrypted members), add the file itself
+        logger.error("Error while copying the content of %s, adding it unpacked: %s" % (path, e))
+    z.write(path, targetdir + os.path.basename(path), zipfile.ZIP_DEFLATED)
+
+
+def _text_md5(data):
+    '''
+    MD5 checksum of the given member content, ignoring whitespace.
+    '''
+    text = str(data, errors='ignore')
+    text = text.replace(' ', '').replace('\n', '').replace('\t', '')
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def _file_manifest(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return {'type': 'file',
+            'members': [{'name': os.path.basename(path), 'size': os.path.getsize(path),
+                         'file': True, 'md5': md5.hexdigest()}]}
+
+
+def _member_md5(read, size):
+    if size >= MANIFEST_MD5_SIZE:
+        return None
+    try:
+        return _text_md5(read())
+    except (IOError, zipfile.BadZipFile, tarfile.TarError, NotImplementedError, RuntimeError) as e:
+        # Unsupported compression, encrypted members, ...
+        logger.warning("Cannot read archive member for its checksum: " + str(e))
+        return None
+
+
+def archive_manifest(path):
+    '''
+    Inspects the given upload in one pass, and returns a dictionary
+    with its type ('zip', 'tar' or 'file') and the list of its members.
+    Each member has a name, a size, a 'file' flag for regular files, and
+    the MD5 checksum of its content without whitespace, or None for
+    large members. Single files are described as one member, with
+    the MD5 checksum of the file itself.
+
+    Raises IOError if the file cannot be read.
+    '''
+    try:
+        if zipfile.is_zipfile(path):
+            members = []
+            with zipfile.ZipFile(path, 'r') as zf:
+                for info in zf.infolist():
+                    members.append({'name': info.filename,
+                                    'size': info.file_size,
+                                    'file': not info.filename.endswith('/'),
+                                    'md5': _member_md5(lambda: zf.read(info), info.file_size)})
+            return {'type': 'zip', 'members': members}
+        elif tarfile.is_tarfile(path):
+            members = []
+            with tarfile.open(path, 'r') as tf:
+                for info in tf:
+                    if info.isfile():
+                        md5 = _member_md5(lambda: tf.extractfile(info).read(), info.size)
+                    else:
+                        md5 = None
+                    members.append({'name': info.name,
+                                    'size': info.size,
+                                    'file': info.isfile(),
+                                    'md5': md5})
+            return {'type': 'tar', 'members': members}
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError) as e:
+        logger.warning("Cannot read archive %s, treating it as single file: %s" % (path, e))
+    return _file_manifest(path)
+
+
+def _fingerprint(data):
+    return hashlib.sha256(json.dumps(data, default=str).encode('utf-8')).hexdigest()
+
+
+def copy_member(z, source, info, arcname=None):
+    '''
+    Copy a member from the source ZIP file into the target ZIP file,
+    with the same compression method. Compressed members are copied
+    as they are.
+    '''
+    if _can_copy_raw(info):
+        _copy_raw(z, source, info, arcname or info.filename)
+        return
+    with source.open(info) as src:
+        _copy_stream(z, src, arcname or info.filename, info.date_time,
+                     info.file_size, info.compress_type)
+
+
+def compress_upload(path, targetdir):
+    '''
+    Returns a ZIP file, as bytes, with the compressed content of the
+    given student upload, see add_archive_content(). Runs in a worker
+    process, so it must not access the database. The compressed members
+    are copied raw into the final archive.
+    '''
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', allowZip64=True) as z:
+        add_archive_content(z, path, targetdir)
+    return output.getvalue()
+
+
+def _compressed_result(key, obj, future):
+    if future is None:
+        return key, obj, None
+    try:
+        return key, obj, zipfile.ZipFile(io.BytesIO(future.result()))
+    except Exception as e:
+        logger.error("Compressing the files for %s failed, trying again: %s" % (obj, e))
+        return key, obj, None
+
+
+def add_part(z, obj, compressed):
+    '''
+    Add an assignment or submission from compressed_parts() to the ZIP file.
+    '''
+    if compressed is None:
+        obj.add_to_zipfile(z)
+    else:
+        obj.add_to_zipfile(z, compressed)
+
+
+def compressed_parts(parts, needed=None):
+    '''
+    Generator for archive parts with compressed student files.
+
+    Gets (key, object) tuples for assignments and submissions,
+    and yields them in the same order as (key, object, compressed)
+    tuples. For submissions with a file upload, compressed is a
+    ZipFile with the compressed student files for add_to_zipfile().
+    They are created in ARCHIVE_WORKERS processes, a few parts in
+    advance. The optional needed function tells which keys need
+    the files.
+
+    Only used by the 'buildarchives' command. Web server processes
+    may be multithreaded, and must not fork worker processes.
+    '''
+    from .models import Submission
+    workers = settings.ARCHIVE_WORKERS
+    if workers < 2:
+        for key, obj in parts:
+            yield key, obj, None
+        return
+    pending = deque()
+    with ProcessPoolExecutor(workers) as pool:
+        for key, obj in parts:
+            future = None
+            if isinstance(obj, Submission) and obj.file_upload and (needed is None or needed(key)):
+                future = pool.submit(compress_upload, obj.file_upload.absolute_path(),
+                                     obj.zip_directory() + 'student_files/')
+            pending.append((key, obj, future))
+            # Limits the number of compressed parts in memory
+            if len(pending) > 2 * workers:
+                yield _compressed_result(*pending.popleft())
+        while pending:
+            yield _compressed_result(*pending.popleft())
+
+
+class CourseArchive(object):
+    '''
+    Precomputed ZIP archive with all assignments and submissions of a course,
+    stored below MEDIA_ROOT.
+
+    A manifest next to the archive stores a fingerprint of the data the
+    archive was built from. As long as it matches the current data, the
+    stored archive is delivered. Otherwise, the archive is requested and
+    built again in the background by the 'buildarchives' command. Parts
+    that did not change are copied from the previous archive then, only
+    changed submissions are added again.
+    '''
+
+    def __init__(self, course):
+        self.course = course
+        self.directory = os.path.join(settings.MEDIA_ROOT, 'archives')
+        basename = os.path.join(self.directory, 'course%u' % course.pk)
+        self.path = basename + '.zip'
+        self.manifest_path = basename + '.json'
+        self.request_path = basename + '.requested'
+        self.lock_path = basename + '.lock'
+
+    def _assignments(self):
+        return self.course.assignments.order_by('title', 'pk')
+
+    def _submissions(self, assignment_pk):
+        from .models import Submission
+        return Submission.objects.filter(assignment_id=assignment_pk).order_by('submitter', 'pk')
+
+    def parts(self):
+        '''
+        Generator for the archive parts, in archive order, as (key, object) tuples.
+        '''
+        for ass in self._assignments().select_related('course'):
+            yield 'a%u' % ass.pk, ass
+            subs = self._submissions(ass.pk).select_related(
+                'submitter', 'grading', 'file_upload').prefetch_related('authors')
+            for sub in subs:
+                # Avoids one query per submission
+                sub.assignment = ass
+                yield 's%u' % sub.pk, sub
+
+    def _reuse(self, z, old_zip, members):
+        '''
+        Copy the given members from the previous archive,
+        if all of them are there.
+        '''
+        try:
+            infos = [old_zip.getinfo(name) for name in members]
+        except KeyError:
+            return False
+        for info in infos:
+            copy_member(z, old_zip, info)
+        return True
+
+    def fingerprints(self):
+        '''
+        Returns the fingerprints of the archive parts, as ordered list of
+        (key, fingerprint) tuples. Parts are the assignments and submissions,
+        the fingerprints cover all data that is stored in the archive.
+        '''
+        from .models import Submission
+        authors = {}
+        for subm_pk, user_pk in Submission.authors.through.objects.filter(
+                submission__assignment__course=self.course).values_list('submission_id', 'user_id'):
+            authors.setdefault(subm_pk, []).append(user_pk)
+        result = []
+        for ass in self._assignments().values('pk', 'title', 'description', 'gradingScheme_id', 'publish_at', 'soft_deadline',
+                                              'hard_deadline', 'attachment_test_validity', 'attachment_test_full'):
+            ass_fp = _fingerprint([self.course.title, sorted(ass.items())])
+            result.append(('a%u' % ass['pk'], ass_fp))
+            subs = self._submissions(ass['pk']).values(
+                'pk', 'submitter_id', 'modified', 'state', 'file_upload_id', 'grading_id', 'notes', 'grading_notes')
+            for sub in subs:
+                sub_fp = _fingerprint([ass_fp, sorted(sub.items()), sorted(authors.get(sub['pk'], []))])
+                result.append(('s%u' % sub['pk'], sub_fp))
+        return result
+
+    def _manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def current(self):
+        '''
+        Returns the path of the stored archive if it is up-to-date,
+        otherwise None.
+        '''
+        manifest = self._manifest()
+        if manifest and os.path.exists(self.path):
+            if manifest['fingerprint'] == _fingerprint(self.fingerprints()):
+                return self.path
+        return None
+
+    def request(self):
+        '''
+        Ask for a new build of the archive by the background worker.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        open(self.request_path, 'a').close()
+
+    def requested(self):
+        return os.path.exists(self.request_path)
+
+    def outdated(self):
+        '''
+        Check if there is a stored archive that needs an update.
+        '''
+        return os.path.exists(self.path) and not self.current()
+
+    def build(self):
+        '''
+        Build the archive, reusing the unchanged parts of the previous one.
+
+        Returns the number of parts that were reused, or None if
+        somebody else is building the archive right now.
+        '''
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            # New requests from now on are covered by this build
+            if os.path.exists(self.request_path):
+                os.remove(self.request_path)
+            fingerprints = self.fingerprints()
+            part_fingerprints = dict(fingerprints)
+            old_manifest = self._manifest() or {'parts': {}}
+            try:
+                old_zip = zipfile.ZipFile(self.path, 'r')
+            except (IOError, zipfile.BadZipFile):
+                old_zip = None
+            parts = {}
+            reused = 0
+
+            def changed(key):
+                old = old_manifest['parts'].get(key)
+                return not (old_zip and old and old['fingerprint'] == part_fingerprints.get(key))
+
+            tmp = tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False)
+            try:
+                with tmp, zipfile.ZipFile(tmp, 'w', allowZip64=True) as z:
+                    for key, obj, compressed in compressed_parts(self.parts(), changed):
+                        fp = part_fingerprints.get(key)
+                        start = len(z.filelist)
+                        if not changed(key) and self._reuse(z, old_zip, old_manifest['parts'][key]['members']):
+                            reused += 1
+                        else:
+                            add_part(z, obj, compressed)
+                        parts[key] = {'fingerprint': fp,
+                                      'members': [info.filename for info in z.filelist[start:]]}
+                os.replace(tmp.name, self.path)
+            except Exception:
+                os.remove(tmp.name)
+                raise
+            finally:
+                if old_zip:
+                    old_zip.close()
+            manifest = {'fingerprint': _fingerprint(fingerprints), 'parts': parts}
+            with open(self.manifest_path + '.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(self.manifest_path + '.tmp', self.manifest_path)
+        logger.info("Built archive for course %u, %u of %u parts reused." % (self.course.pk, reused, len(parts)))
+        return reused
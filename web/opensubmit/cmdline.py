@@ -124,17 +124,27 @@ def apache_config(config, outputfile):
     if subdir:
         text += "Alias /%s/static/ %s\n" % (settings.HOST_DIR,
                                             settings.STATIC_ROOT)
-        text += "    WSGIScriptAlias /%s %s/wsgi.py process-group=opensubmit\n" % (
+        text += "    WSGIScriptAlias /%s %s/wsgi.py\n" % (
             settings.HOST_DIR, settings.SCRIPT_ROOT)
+        jobs_path = "/%s/jobs/" % settings.HOST_DIR
     else:
         text += "Alias /static/ %s\n" % (settings.STATIC_ROOT)
-        text += "    WSGIScriptAlias / %s/wsgi.py  process-group=opensubmit" % (
+        text += "    WSGIScriptAlias / %s/wsgi.py" % (
             settings.SCRIPT_ROOT)
+        jobs_path = "/jobs/"
     text += """
     WSGIPassAuthorization On
     WSGIProcessGroup opensubmit
     WSGIDaemonProcess opensubmit threads=1 processes=1
 
+    # Executor requests, which may wait for new jobs (long polling),
+    # are served by their own processes. Some threads stay free
+    # for executors that do not wait.
+    WSGIDaemonProcess opensubmit-jobs threads={jobs_threads} processes=1
+    <Location {jobs_path}>
+         WSGIProcessGroup opensubmit-jobs
+    </Location>
+
     <Directory {static_path}>
          Require all granted
     </Directory>
@@ -143,7 +153,8 @@ def apache_config(config, outputfile):
               Require all granted
          </Files>
     </Directory>
-    """.format(static_path=settings.STATIC_ROOT, install_path=settings.SCRIPT_ROOT)
+    """.format(static_path=settings.STATIC_ROOT, install_path=settings.SCRIPT_ROOT,
+               jobs_path=jobs_path, jobs_threads=settings.JOB_LONG_POLLS + 5)
 
     f.write(text)
     f.close()
@@ -419,6 +430,14 @@ def console_script(fsroot=''):
                           'dumpconfig'], help='Show effective OpenSubmit configuration at run-time.')
     subparsers.add_parser(
         'fixchecksums', help='Re-create all student file checksums (for duplicate detection).')
+    subparsers.add_parser(
+        'expirejobs', help='Reset executor jobs that got no result in time. Should be called periodically.')
+    subparsers.add_parser(
+        'sendmails', help='Send queued student notification mails. Should be called periodically.')
+    subparsers.add_parser(
+        'updatechecksums', help='Compute checksums of new student files (for duplicate detection). Should be called periodically.')
+    subparsers.add_parser(
+        'buildarchives', help='Build requested or outdated course archives. Should be called periodically.')
 
     parser_makeadmin = subparsers.add_parser(
         'makeadmin', help='Make this user an admin with backend rights.')
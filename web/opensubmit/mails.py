@@ -1,11 +1,21 @@
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
 from django.core.urlresolvers import reverse
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F, Q
+
+from datetime import datetime, timedelta
 
 
 import logging
 logger = logging.getLogger('OpenSubmit')
 
 
+# Failed mails are tried again after this time, and given up
+# after the given number of attempts
+MAIL_RETRY_DELAY = timedelta(minutes=5)
+MAIL_MAX_ATTEMPTS = 12
+
 STUDENT_FAILED_SUB = 'Warning - Validation failed'
 
 STUDENT_FAILED_MSG = '''
@@ -38,15 +48,36 @@ Further information can be found at %s.'''
 
 
 def inform_student(submission, request, state):
+    '''
+    Queue an email message for the student,
+    based on the given submission state.
+    '''
+    mail = student_mail(submission, request, state)
+    if mail:
+        queue_mail(*mail)
+
+
+def student_mail(submission, request, state):
     '''
     Create an email message for the student,
     based on the given submission state.
+    Returns subject, message, sender and recipients,
+    or None if there is nothing to tell.
 
     Sending eMails on validation completion does
     not work, since this may have been triggered
     by the admin.
+
+    The request is None when called from a management
+    command, the configured host name is used then.
     '''
-    details_url = request.build_absolute_uri(reverse('details', args=(submission.pk,)))
+    details_url = reverse('details', args=(submission.pk,))
+    if request:
+        details_url = request.build_absolute_uri(details_url)
+    elif len(settings.HOST_DIR) > 0:
+        details_url = settings.HOST + '/' + settings.HOST_DIR + details_url
+    else:
+        details_url = settings.HOST + details_url
 
     if state == submission.TEST_VALIDITY_FAILED:
         subject = STUDENT_FAILED_SUB
@@ -66,15 +97,114 @@ def inform_student(submission, request, state):
                              submission.assignment.course,
                              details_url)
     else:
-        return
+        return None
 
     subject = "[%s] %s" % (submission.assignment.course, subject)
     from_email = submission.assignment.course.owner.email
-    recipients = submission.authors.values_list(
-        'email', flat=True).distinct().order_by('email')
+    # Works with prefetched authors
+    recipients = sorted(set(author.email for author in submission.authors.all()))
     # send student email with BCC to course owner.
     # TODO: This might be configurable later
     # email = EmailMessage(subject, message, from_email, recipients,
     # [self.assignment.course.owner.email])
-    email = EmailMessage(subject, message, from_email, recipients)
-    email.send(fail_silently=True)
+    return subject, message, from_email, recipients
+
+
+def queue_mail(subject, message, from_email, recipients):
+    '''
+    Store an email message for sending by send_pending_mails().
+    Inside a transaction, the mail is only sent if the transaction commits.
+    '''
+    from .models import PendingMail
+    PendingMail.objects.create(subject=subject, message=message, from_email=from_email,
+                               recipients='\n'.join(recipients))
+
+
+def queue_mass_mail(dispatch, mails):
+    '''
+    Store the given email messages for sending by send_pending_mails(),
+    as part of the given MailDispatch object. The messages are
+    (subject, message, sender, recipients) tuples, typically from a
+    generator. They are stored in chunks of the mail batch size.
+
+    Large dispatches are sent in several batches, each of them
+    claimed and finished in its own short transaction.
+    '''
+    from .models import PendingMail
+    chunk = []
+    for subject, message, from_email, recipients in mails:
+        chunk.append(PendingMail(subject=subject, message=message, from_email=from_email,
+                                 recipients='\n'.join(recipients), dispatch=dispatch))
+        dispatch.total += 1
+        if len(chunk) >= settings.MAIL_BATCH_SIZE:
+            PendingMail.objects.bulk_create(chunk)
+            chunk = []
+    PendingMail.objects.bulk_create(chunk)
+    dispatch.save()
+
+
+def _claim_mails(batch_size, now):
+    '''
+    Claim up to the given number of sendable mails for this worker,
+    by setting their last attempt. Other workers skip them until the
+    retry delay is over, so that mails of a crashed worker are sent
+    again later.
+
+    Returns the claimed mails.
+    '''
+    from .models import PendingMail
+    sendable = PendingMail.objects.filter(
+        Q(last_attempt__isnull=True) | Q(last_attempt__lt=now - MAIL_RETRY_DELAY),
+        attempts__lt=MAIL_MAX_ATTEMPTS)
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            # Parallel workers get different mails
+            mails = list(sendable.select_for_update(skip_locked=True).order_by('pk')[:batch_size])
+            PendingMail.objects.filter(pk__in=[mail.pk for mail in mails]).update(last_attempt=now)
+        else:
+            # Only one of the parallel workers updates a mail that is still sendable
+            mails = [mail for mail in sendable.order_by('pk')[:batch_size]
+                     if sendable.filter(pk=mail.pk).update(last_attempt=now)]
+    return mails
+
+
+def send_pending_mails(batch_size=None):
+    '''
+    Send queued email messages, oldest first, up to the given number.
+    All of them use one SMTP connection. Mails that cannot be
+    sent are tried again later.
+
+    The mails are claimed in a short transaction first. Sending
+    happens outside of any transaction, so that a slow mail server
+    does not keep database locks.
+
+    Returns the number of sent mails.
+    '''
+    from .models import PendingMail
+    batch_size = batch_size or settings.MAIL_BATCH_SIZE
+    now = datetime.now()
+    mails = _claim_mails(batch_size, now)
+    if not mails:
+        return 0
+    sent, failed = [], []
+    mail_connection = get_connection()
+    try:
+        mail_connection.open()
+        for mail in mails:
+            email = EmailMessage(mail.subject, mail.message, mail.from_email,
+                                 mail.recipients.splitlines(), connection=mail_connection)
+            try:
+                email.send()
+                sent.append(mail.pk)
+            except Exception as e:
+                logger.error("Could not send mail '%s' to %s: %s" % (mail.subject, mail.recipients, e))
+                failed.append(mail.pk)
+    except Exception as e:
+        logger.error("Could not connect to the mail server: %s" % e)
+        failed = [mail.pk for mail in mails if mail.pk not in sent]
+    finally:
+        mail_connection.close()
+    with transaction.atomic():
+        PendingMail.objects.filter(pk__in=sent).delete()
+        PendingMail.objects.filter(pk__in=failed).update(attempts=F('attempts') + 1, last_attempt=now)
+    return len(sent)
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from opensubmit.archives import CourseArchive
+from opensubmit.models import Course
+
+
+class Command(BaseCommand):
+    help = 'Builds requested or outdated course archives'
+
+    def handle(self, *args, **options):
+        for course in Course.objects.all():
+            archive = CourseArchive(course)
+            # Stored archives of inactive courses are only updated on request
+            if archive.requested() or (course.active and archive.outdated()):
+                reused = archive.build()
+                if reused is not None:
+                    print("Built archive for course '%s'." % course)
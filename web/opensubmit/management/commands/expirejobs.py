@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+from opensubmit.models import Submission
+
+
+class Command(BaseCommand):
+    help = 'Resets executor jobs that got no result within the assignment timeout'
+
+    def handle(self, *args, **options):
+        jobs = Submission.pending_tests.expire()
+        if jobs:
+            print("Reset %u expired executor job(s)." % len(jobs))
@@ -9,8 +9,7 @@ class Command(BaseCommand):
         for f in files:
             print("Updating checksum for %s ..."%(str(f)))
             try:
-                f.md5 = f.attachment_md5()
-                f.save()
+                f.update_checksums()
             except IOError as e:
                 print("Failed: "+str(e))
 
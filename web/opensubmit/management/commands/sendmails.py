@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from opensubmit.mails import send_pending_mails
+
+
+class Command(BaseCommand):
+    help = 'Sends queued student notification mails'
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            count = send_pending_mails()
+            total += count
+            # Stop on problems and when the queue is empty
+            if count < settings.MAIL_BATCH_SIZE:
+                break
+        if total:
+            print("Sent %u queued mail(s)." % total)
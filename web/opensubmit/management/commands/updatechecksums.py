@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from opensubmit.models import SubmissionFile
+
+import logging
+logger = logging.getLogger('OpenSubmit')
+
+
+class Command(BaseCommand):
+    help = 'Computes checksums and similarity signatures for new uploaded files'
+
+    def handle(self, *args, **options):
+        total = 0
+        for f in SubmissionFile.objects.filter(Q(md5=None) | Q(signature=None)).order_by('pk').iterator():
+            try:
+                f.update_checksums()
+            except (IOError, OSError) as e:
+                logger.error("Checksum computation for %s failed: %s" % (f, e))
+                print("Failed for %s: %s" % (f, e))
+                continue
+            total += 1
+        if total:
+            print("Updated checksums for %u file(s)." % total)
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0036_auto_20190305_0911'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submissionfile',
+            name='fetched_by',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='fetched_files', to='opensubmit.TestMachine'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0037_submissionfile_fetched_by'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='submissionfile',
+            name='fetched',
+            field=models.DateTimeField(db_index=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='submission',
+            index=models.Index(fields=['state', 'modified'], name='submission_job_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0038_job_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingMail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('message', models.TextField()),
+                ('from_email', models.CharField(max_length=255)),
+                ('recipients', models.TextField(help_text='One address per line.')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('attempts', models.PositiveIntegerField(default=0, help_text='Number of failed delivery attempts.')),
+                ('last_attempt', models.DateTimeField(blank=True, editable=False, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('opensubmit', '0039_pendingmail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MailDispatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('total', models.PositiveIntegerField(default=0, editable=False, help_text='Number of queued mails.')),
+                ('sender', models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='mail_dispatches', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name': 'Mail dispatch',
+                'verbose_name_plural': 'Mail dispatches',
+            },
+        ),
+        migrations.AddField(
+            model_name='pendingmail',
+            name='dispatch',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='mails', to='opensubmit.MailDispatch'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0040_maildispatch'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='submissionfile',
+            name='md5',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=36, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0041_submissionfile_md5_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submissionfile',
+            name='signature',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
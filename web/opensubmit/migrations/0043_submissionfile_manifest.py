@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0042_submissionfile_signature'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submissionfile',
+            name='manifest',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
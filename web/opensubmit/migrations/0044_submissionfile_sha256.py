@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('opensubmit', '0043_submissionfile_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submissionfile',
+            name='sha256',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True),
+        ),
+    ]
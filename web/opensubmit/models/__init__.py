@@ -10,3 +10,5 @@ from .userprofile import UserProfile
 from .studyprogram import StudyProgram
 from .ltiresult import LtiResult
 
+from .pendingmail import PendingMail
+from .maildispatch import MailDispatch
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Count
 from django.utils import timezone
 from django.conf import settings
 from django.urls import reverse
@@ -6,6 +7,7 @@ from django.urls import reverse
 from .submission import Submission
 from .submissionfile import SubmissionFile
 from .submissiontestresult import SubmissionTestResult
+from opensubmit.similarity import similar_pairs
 
 import os
 from itertools import groupby
@@ -178,23 +180,57 @@ class Assignment(models.Model):
             targetname = os.path.basename(self.description.name)
             z.write(sourcepath, targetpath + os.sep + targetname)
 
+    def similar_submissions(self, threshold):
+        '''
+        Search for pairs of similar submissions in this assignment,
+        with a similarity of at least the given threshold (between 0 and 1).
+        Returns a list of (similarity, submission, submission) tuples,
+        most similar first.
+
+        Signatures are computed in the background by the 'updatechecksums'
+        command, submissions without one are left out.
+        '''
+        subs = self.valid_submissions().exclude(file_upload=None).select_related(
+            'file_upload').prefetch_related('authors')
+        subs = {sub.pk: sub for sub in subs}
+        signatures = {pk: sub.file_upload.similarity_signature() for pk, sub in subs.items()}
+        return [(value, subs[pk1], subs[pk2])
+                for value, pk1, pk2 in similar_pairs(signatures, threshold)]
+
+    def similarity_pending(self):
+        '''
+        Number of submissions in this assignment where the similarity
+        signature was not computed yet.
+        '''
+        return self.valid_submissions().filter(file_upload__isnull=False,
+                                               file_upload__signature=None).count()
+
+    def duplicates_pending(self):
+        '''
+        Number of submission files in this assignment where the checksum
+        was not computed yet.
+        '''
+        return SubmissionFile.valid_ones.filter(submissions__assignment=self,
+                                                md5=None).distinct().count()
+
     def duplicate_files(self):
         '''
         Search for duplicates of submission file uploads for this assignment.
         This includes the search in other course, whether inactive or not.
         Returns a list of lists, where each latter is a set of duplicate submissions
         with at least on of them for this assignment
-        '''
-        result=list()
-        files = SubmissionFile.valid_ones.order_by('md5')
-
-        for key, dup_group in groupby(files, lambda f: f.md5):
-            file_list=[entry for entry in dup_group]
-            if len(file_list)>1:
-                for entry in file_list:
-                    if entry.submissions.filter(assignment=self).count()>0:
-                        result.append([key, file_list])
-                        break
-        return result
+
+        Only checksums of this assignment are grouped in the database,
+        through the index on the md5 column. Checksums are computed in
+        the background by the 'updatechecksums' command, files without
+        one are left out, see duplicates_pending().
+        '''
+        own_md5 = SubmissionFile.valid_ones.filter(submissions__assignment=self).exclude(md5=None).values('md5')
+        dup_md5 = SubmissionFile.valid_ones.filter(md5__in=own_md5).values('md5').annotate(
+            num_files=Count('pk', distinct=True)).filter(num_files__gt=1).values('md5')
+        files = SubmissionFile.valid_ones.filter(md5__in=dup_md5).order_by('md5', 'pk').prefetch_related(
+            'submissions__assignment__course', 'submissions__assignment__gradingScheme',
+            'submissions__authors', 'submissions__grading')
+        return [[key, list(dup_group)] for key, dup_group in groupby(files, lambda f: f.md5)]
 
 
@@ -0,0 +1,36 @@
+from django.db import models
+from django.contrib.auth.models import User
+
+from opensubmit import mails
+
+
+class MailDispatch(models.Model):
+    '''
+    A group of mails sent together from the teacher backend,
+    e.g. to all participants of a course. The mails are queued
+    as PendingMail objects, this object keeps track of the progress.
+    '''
+    subject = models.CharField(max_length=255)
+    sender = models.ForeignKey(User, null=True, editable=False, on_delete=models.SET_NULL, related_name='mail_dispatches')
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    total = models.PositiveIntegerField(default=0, editable=False, help_text="Number of queued mails.")
+
+    class Meta:
+        app_label = 'opensubmit'
+        verbose_name = 'Mail dispatch'
+        verbose_name_plural = 'Mail dispatches'
+
+    def __str__(self):
+        return self.subject
+
+    def failed(self):
+        '''
+        Number of mails that were given up.
+        '''
+        return self.mails.filter(attempts__gte=mails.MAIL_MAX_ATTEMPTS).count()
+
+    def sent(self):
+        '''
+        Number of mails that were sent.
+        '''
+        return self.total - self.mails.count()
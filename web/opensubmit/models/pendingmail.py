@@ -0,0 +1,22 @@
+from django.db import models
+
+
+class PendingMail(models.Model):
+    '''
+    An e-mail waiting for delivery by the 'sendmails' management command.
+    See mails.send_pending_mails().
+    '''
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    from_email = models.CharField(max_length=255)
+    recipients = models.TextField(help_text="One address per line.")
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    attempts = models.PositiveIntegerField(default=0, help_text="Number of failed delivery attempts.")
+    last_attempt = models.DateTimeField(null=True, blank=True, editable=False)
+    dispatch = models.ForeignKey('MailDispatch', null=True, blank=True, on_delete=models.CASCADE, related_name='mails')
+
+    class Meta:
+        app_label = 'opensubmit'
+
+    def __str__(self):
+        return self.subject
@@ -1,14 +1,17 @@
-from django.db import models
+from django.db import models, connection, transaction
+from django.db.models import Q, Min, Count
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.urlresolvers import reverse
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import tempfile
 import zipfile
 import tarfile
 
 from opensubmit import mails
+from opensubmit.archives import add_archive_content, copy_member
+from opensubmit.scheduling import SchedulingPolicy, JobQueue
 
 from .submissionfile import upload_path, SubmissionFile
 from .submissiontestresult import SubmissionTestResult
@@ -42,7 +45,7 @@ class PendingStudentTestsManager(models.Manager):
 
     def get_queryset(self):
         jobs = Submission.objects.filter(
-            state=Submission.TEST_VALIDITY_PENDING).order_by('-modified')
+            state=Submission.TEST_VALIDITY_PENDING).order_by('modified')
         return jobs
 
 
@@ -59,13 +62,14 @@ class PendingFullTestsManager(models.Manager):
         jobs = Submission.objects.filter(
             state__in=[Submission.TEST_FULL_PENDING,
                        Submission.CLOSED_TEST_FULL_PENDING]
-        ).order_by('-state').order_by('-modified')
+        ).order_by('-state', 'modified')
         return jobs
 
 
 class PendingTestsManager(models.Manager):
     '''
         A combination of both, with focus on getting the full tests later than the validity tests.
+        The executors get their jobs according to the scheduling policy (see claim()).
     '''
 
     def get_queryset(self):
@@ -73,7 +77,179 @@ class PendingTestsManager(models.Manager):
             state__in=[Submission.TEST_FULL_PENDING,           # PF
                        Submission.CLOSED_TEST_FULL_PENDING,    # CT
                        Submission.TEST_VALIDITY_PENDING]      # PV
-        ).order_by('-state').order_by('-modified')
+        ).order_by('-state', 'modified')
+        return jobs
+
+    def policy(self):
+        '''
+            The scheduling policy for executor jobs.
+            Student validations win over full tests, which are triggered by
+            successful validations or by teachers. Full test re-runs for
+            closed submissions come last.
+        '''
+        return SchedulingPolicy([Submission.TEST_VALIDITY_PENDING,
+                                 Submission.TEST_FULL_PENDING,
+                                 Submission.CLOSED_TEST_FULL_PENDING])
+
+    def claim(self, machine):
+        '''
+            Hands out the next pending job for the given test machine,
+            by setting the fetch date of its file upload.
+
+            Returns the claimed submission, or None if there is no work.
+        '''
+        subs = self.claim_many(machine, 1)
+        return subs[0] if subs else None
+
+    def claim_many(self, machine, count):
+        '''
+            Hands out up to count pending jobs for the given test machine.
+
+            Returns the list of claimed submissions, which is empty if there is no work.
+
+            Pending jobs are grouped by state and course, the groups are ranked
+            by the scheduling policy. Inside a group, jobs are handed out in FIFO order.
+        '''
+        candidates = self.get_queryset().filter(assignment__in=machine.assignments.all()) \
+                                        .filter(file_upload__isnull=False) \
+                                        .filter(file_upload__fetched__isnull=True)
+        now = datetime.now()
+        queues = [JobQueue(job_class=queue['state'],
+                           course=queue['assignment__course'],
+                           oldest=queue['oldest'] or now)
+                  for queue in candidates.order_by().values('state', 'assignment__course')
+                                         .annotate(oldest=Min('modified'))]
+        running = dict(self.get_queryset().filter(file_upload__fetched__isnull=False)
+                                          .order_by().values_list('assignment__course')
+                                          .annotate(Count('pk')))
+        policy = self.policy()
+        claimed = []
+        while queues and len(claimed) < count:
+            queue = policy.order(queues, running, now)[0]
+            sub = self._claim_first(candidates.filter(state=queue.job_class,
+                                                      assignment__course=queue.course),
+                                    machine)
+            if sub:
+                claimed.append(sub)
+                # The age of the group is not updated, but the fair share is
+                running[queue.course] = running.get(queue.course, 0) + 1
+            else:
+                queues.remove(queue)
+        return claimed
+
+    def _claim_first(self, candidates, machine):
+        '''
+            Claims the first job from the given candidates.
+
+            Parallel executors must never get the same job. The conditional
+            update of the fetch date guarantees this on every database.
+            Where supported, candidates are additionally row-locked with
+            SELECT ... FOR UPDATE SKIP LOCKED, so that parallel executors
+            skip each others candidates instead of competing for the same one.
+        '''
+        while True:
+            if connection.features.has_select_for_update:
+                with transaction.atomic():
+                    # Lock only the submission rows, not the joined tables
+                    locked = Submission.objects.select_for_update(
+                        skip_locked=connection.features.has_select_for_update_skip_locked
+                    ).filter(pk__in=candidates.values('pk')).order_by(*candidates.query.order_by)
+                    sub = locked.first()
+                    if sub is None:
+                        return None
+                    claimed = self._claim_submission(sub, machine)
+            else:
+                sub = candidates.first()
+                if sub is None:
+                    return None
+                claimed = self._claim_submission(sub, machine)
+            if claimed:
+                return sub
+            logger.debug("Submission %u was claimed by another executor, trying next one." % sub.pk)
+
+    def _claim_submission(self, sub, machine):
+        '''
+            Compare-and-set on the fetch date of the file upload.
+            Returns if the claim was successful.
+        '''
+        now = datetime.now()
+        if SubmissionFile.objects.filter(pk=sub.file_upload_id, fetched__isnull=True).update(fetched=now, fetched_by=machine) == 0:
+            return False
+        Submission.objects.filter(pk=sub.pk).update(modified=now)
+        sub.modified = now
+        return True
+
+    def expired(self):
+        '''
+            Returns the fetched jobs where the executor did not deliver
+            a result within the timeout of the assignment.
+
+            The timeout is an assignment setting, so the query gets one
+            fetch date condition per distinct timeout value.
+        '''
+        from .assignment import Assignment
+        now = datetime.now()
+        timeouts = Assignment.objects.order_by().values_list(
+            'attachment_test_timeout', flat=True).distinct()
+        condition = Q()
+        for timeout in timeouts:
+            condition |= Q(assignment__attachment_test_timeout=timeout,
+                           file_upload__fetched__lt=now - timedelta(seconds=timeout))
+        if not condition:
+            return self.none()
+        return self.get_queryset().filter(condition)
+
+    def expire(self):
+        '''
+            Resets all expired jobs in bulk.
+
+            Validity and full tests get a failure result and the according state,
+            students are informed about failed validity tests.
+            Full tests for closed submissions are just given to the
+            next executor again. Late results for failed jobs are
+            ignored, see views.api.apply_result().
+
+            Returns the list of expired submissions.
+        '''
+        with transaction.atomic():
+            jobs = list(self.expired().select_related('file_upload__fetched_by', 'assignment'))
+            if not jobs:
+                return jobs
+            results = []
+            for sub in jobs:
+                logger.debug(
+                    "Resetting executor fetch status for submission %u, due to timeout" % sub.pk)
+                machine = sub.file_upload.fetched_by or sub.assignment.test_machines.first()
+                if sub.state == Submission.TEST_VALIDITY_PENDING:
+                    sub.state = Submission.TEST_VALIDITY_FAILED
+                    text_student = "Killed due to non-reaction. Please check your application for deadlocks or keyboard input."
+                    text_tutor = "Killed due to non-reaction on timeout signals."
+                    kind = SubmissionTestResult.VALIDITY_TEST
+                elif sub.state == Submission.TEST_FULL_PENDING:
+                    sub.state = Submission.TEST_FULL_FAILED
+                    text_student = None
+                    text_tutor = "Killed due to non-reaction on timeout signals. Student not informed, since this was the full test."
+                    kind = SubmissionTestResult.FULL_TEST
+                else:
+                    continue
+                if machine:
+                    results.append(SubmissionTestResult(
+                        result=text_student,
+                        result_tutor=text_tutor,
+                        machine=machine,
+                        kind=kind,
+                        submission_file=sub.file_upload))
+            SubmissionTestResult.objects.bulk_create(results)
+            SubmissionFile.objects.filter(
+                pk__in=[sub.file_upload_id for sub in jobs]).update(fetched=None)
+            for old_state, new_state in ((Submission.TEST_VALIDITY_PENDING, Submission.TEST_VALIDITY_FAILED),
+                                         (Submission.TEST_FULL_PENDING, Submission.TEST_FULL_FAILED)):
+                Submission.objects.filter(
+                    pk__in=[sub.pk for sub in jobs if sub.state == new_state],
+                    state=old_state).update(state=new_state, modified=datetime.now())
+        for sub in jobs:
+            if sub.state == Submission.TEST_VALIDITY_FAILED:
+                sub.inform_student(None, sub.state)
         return jobs
 
 
@@ -215,6 +391,10 @@ class Submission(models.Model):
 
     class Meta:
         app_label = 'opensubmit'
+        indexes = [
+            # Job queue lookups for the executors
+            models.Index(fields=['state', 'modified'], name='submission_job_queue_idx'),
+        ]
 
     @staticmethod
     def qs_valid(qs):
@@ -504,15 +684,17 @@ class Submission(models.Model):
         # this implies that the Apache media serving is disabled
         return reverse('submission_grading_file', args=(self.pk,))
 
-    def _save_test_result(self, machine, text_student, text_tutor, kind, perf_data):
-        result = SubmissionTestResult(
+    def _new_test_result(self, machine, text_student, text_tutor, kind, perf_data):
+        return SubmissionTestResult(
             result=text_student,
             result_tutor=text_tutor,
             machine=machine,
             kind=kind,
             perf_data=perf_data,
             submission_file=self.file_upload)
-        result.save()
+
+    def _save_test_result(self, machine, text_student, text_tutor, kind, perf_data):
+        self._new_test_result(machine, text_student, text_tutor, kind, perf_data).save()
 
     def _get_test_result(self, kind):
         try:
@@ -539,6 +721,20 @@ class Submission(models.Model):
         self._save_test_result(
             machine, None, text_tutor, SubmissionTestResult.FULL_TEST, perf_data)
 
+    def new_validation_result(self, machine, text_student, text_tutor, perf_data=None):
+        '''
+            Return a new, unsaved validity test result object for this submission.
+        '''
+        return self._new_test_result(
+            machine, text_student, text_tutor, SubmissionTestResult.VALIDITY_TEST, perf_data)
+
+    def new_fulltest_result(self, machine, text_tutor, perf_data=None):
+        '''
+            Return a new, unsaved full test result object for this submission.
+        '''
+        return self._new_test_result(
+            machine, None, text_tutor, SubmissionTestResult.FULL_TEST, perf_data)
+
     def get_validation_result(self):
         '''
             Return the most recent validity test result object for this submission.
@@ -558,6 +754,27 @@ class Submission(models.Model):
         '''
         mails.inform_student(self, request, state)
 
+    def info_text(self):
+        '''
+            Returns a text with information about the submission.
+        '''
+        info = "Submission ID:\t%u\n" % self.pk
+        info += "Submitter:\t%s (%u)\n" % (self.submitter.get_full_name(), self.submitter.pk)
+        info += "Authors:\n"
+        for auth in self.authors.all():
+            info += "\t%s (%u)\n" % (auth.get_full_name(), auth.pk)
+        info += "\n"
+        info += "Creation:\t%s\n" % str(self.created)
+        info += "Last modification:\t%s\n" % str(self.modified)
+        info += "Status:\t%s\n" % self.state_for_students()
+        if self.grading:
+            info += "Grading:\t%s\n" % str(self.grading)
+        if self.notes:
+            info += "Author notes:\n-------------\n%s\n\n" % self.notes
+        if self.grading_notes:
+            info += "Grading notes:\n--------------\n%s\n\n" % self.grading_notes
+        return info
+
     def info_file(self, delete=True):
         '''
             Prepares an open temporary file with information about the submission.
@@ -566,24 +783,7 @@ class Submission(models.Model):
         '''
         info = tempfile.NamedTemporaryFile(
             mode='wt', encoding='utf-8', delete=delete)
-        info.write("Submission ID:\t%u\n" % self.pk)
-        info.write("Submitter:\t%s (%u)\n" %
-                   (self.submitter.get_full_name(), self.submitter.pk))
-        info.write("Authors:\n")
-        for auth in self.authors.all():
-            info.write("\t%s (%u)\n" % (auth.get_full_name(), auth.pk))
-        info.write("\n")
-        info.write("Creation:\t%s\n" % str(self.created))
-        info.write("Last modification:\t%s\n" % str(self.modified))
-        info.write("Status:\t%s\n" % self.state_for_students())
-        if self.grading:
-            info.write("Grading:\t%s\n" % str(self.grading))
-        if self.notes:
-            notes = self.notes
-            info.write("Author notes:\n-------------\n%s\n\n" % notes)
-        if self.grading_notes:
-            notes = self.grading_notes
-            info.write("Grading notes:\n--------------\n%s\n\n" % notes)
+        info.write(self.info_text())
         info.flush()    # no closing here, because it disappears then
         return info
 
@@ -593,14 +793,13 @@ class Submission(models.Model):
             If possible, the content is un-archived in the target directory.
         '''
         assert(self.file_upload)
-        # unpack student data to temporary directory
         # os.chroot is not working with tarfile support
-        tempdir = tempfile.mkdtemp()
+        kind = self.file_upload.archive_manifest()['type']
         try:
-            if zipfile.is_zipfile(self.file_upload.absolute_path()):
+            if kind == 'zip':
                 f = zipfile.ZipFile(self.file_upload.absolute_path(), 'r')
                 f.extractall(targetdir)
-            elif tarfile.is_tarfile(self.file_upload.absolute_path()):
+            elif kind == 'tar':
                 tar = tarfile.open(self.file_upload.absolute_path())
                 tar.extractall(targetdir)
                 tar.close()
@@ -618,28 +817,26 @@ class Submission(models.Model):
                             targetdir + "/" + self.file_upload.basename())
             pass
 
-    def add_to_zipfile(self, z):
-        submitter = "user" + str(self.submitter.pk)
+    def zip_directory(self):
+        '''
+            The directory for this submission in archive downloads, with trailing slash.
+        '''
         assdir = self.assignment.directory_name_with_course()
-        if self.modified:
-            modified = self.modified.strftime("%Y_%m_%d_%H_%M_%S")
-        else:
-            modified = self.created.strftime("%Y_%m_%d_%H_%M_%S")
         state = self.state_for_students().replace(" ", "_").lower()
-        submdir = "%s/%u_%s/" % (assdir, self.pk, state)
-        if self.file_upload:
-            # Copy student upload
-            tempdir = tempfile.mkdtemp()
-            self.copy_file_upload(tempdir)
-            # Add content to final ZIP file
-            allfiles = [(subdir, files)
-                        for (subdir, dirs, files) in os.walk(tempdir)]
-            for subdir, files in allfiles:
-                for f in files:
-                    zip_relative_dir = subdir.replace(tempdir, "")
-                    zip_relative_file = '%s/%s' % (zip_relative_dir, f)
-                    z.write(subdir + "/" + f, submdir + 'student_files/%s' %
-                            zip_relative_file, zipfile.ZIP_DEFLATED)
+        return "%s/%u_%s/" % (assdir, self.pk, state)
+
+    def add_to_zipfile(self, z, compressed=None):
+        '''
+            Adds the submission to the given ZIP file.
+            The student files can be given as ZipFile with the
+            compressed members, see archives.compressed_parts().
+        '''
+        submdir = self.zip_directory()
+        if compressed is not None:
+            for info in compressed.infolist():
+                copy_member(z, compressed, info)
+        elif self.file_upload:
+            # Copy student upload, archive content is copied directly
+            add_archive_content(z, self.file_upload.absolute_path(), submdir + 'student_files/')
         # add text file with additional information
-        info = self.info_file()
-        z.write(info.name, submdir + "info.txt")
+        z.writestr(submdir + "info.txt", self.info_text())
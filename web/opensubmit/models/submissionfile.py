@@ -3,7 +3,11 @@ from django.utils import timezone
 from django.core.urlresolvers import reverse
 
 from django.conf import settings
+from django.core.files import File
 
+from opensubmit import archives, similarity
+
+import json
 import zipfile
 import tarfile
 import unicodedata
@@ -13,6 +17,9 @@ import hashlib
 import logging
 logger = logging.getLogger('OpenSubmit')
 
+# Size of one page in the file preview, in bytes
+PREVIEW_PAGE_SIZE = 100000
+
 
 def upload_path(instance, filename):
     '''
@@ -24,6 +31,19 @@ def upload_path(instance, filename):
     return os.path.join(str(timezone.now().date().isoformat()), filename)
 
 
+def is_code(fname):
+    '''
+        Determines if the given file name belongs to source code,
+        which gets syntax highlighting in the preview.
+    '''
+    code_endings = ['.c', '.cpp', 'Makefile',
+                    '.java', '.py', '.rb', '.js']
+    for ending in code_endings:
+        if fname.endswith(ending):
+            return True
+    return False
+
+
 class ValidSubmissionFileManager(models.Manager):
     '''
         A model manager used by SubmissionFile. It returns only submission files
@@ -42,17 +62,26 @@ class SubmissionFile(models.Model):
         The "fetched" field defines the time stamp when the file was fetched for
         checking by some executor. On result retrieval, this timestamp is emptied
         again, which allows to find 'stucked' executor jobs on the server side.
+        The "fetched_by" field keeps the test machine that fetched the file last.
         The "md5" field keeps a checksum of the file upload, for duplicate detection.
+        The "signature" field keeps a summary of the text content, for similarity detection.
+        The "manifest" field keeps the archive type and member list, as JSON.
+        The "sha256" field keeps a checksum of the file itself, for the download check of the executors.
     '''
 
     attachment = models.FileField(
         upload_to=upload_path, verbose_name="File upload")
     original_filename = models.CharField(max_length=255, default='student.upload')
-    fetched = models.DateTimeField(editable=False, null=True)
+    fetched = models.DateTimeField(editable=False, null=True, db_index=True)
+    fetched_by = models.ForeignKey(
+        'TestMachine', null=True, editable=False, on_delete=models.SET_NULL, related_name='fetched_files')
     replaced_by = models.ForeignKey(
         'SubmissionFile', null=True, blank=True, editable=False)
     md5 = models.CharField(max_length=36, null=True,
-                           blank=True, editable=False)
+                           blank=True, editable=False, db_index=True)
+    signature = models.TextField(null=True, blank=True, editable=False)
+    manifest = models.TextField(null=True, blank=True, editable=False)
+    sha256 = models.CharField(max_length=64, null=True, blank=True, editable=False)
 
     class Meta:
         app_label = 'opensubmit'
@@ -60,6 +89,48 @@ class SubmissionFile(models.Model):
     def __str__(self):
         return self.attachment.name
 
+    def save(self, *args, **kwargs):
+        if self.pk is None and self.sha256 is None and self.attachment:
+            # New upload, computed from the uploaded data before it is stored
+            self.sha256 = self._compute_sha256(self.attachment)
+        super(SubmissionFile, self).save(*args, **kwargs)
+
+    def _compute_sha256(self, f):
+        digest = hashlib.sha256()
+        for chunk in f.chunks():
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def attachment_sha256(self):
+        '''
+            Returns the SHA-256 checksum of the file upload itself.
+            It is computed on upload, or on first usage for older files.
+        '''
+        if self.sha256 is None:
+            with open(self.attachment.path, 'rb') as f:
+                self.sha256 = self._compute_sha256(File(f))
+            self.save(update_fields=['sha256'])
+        return self.sha256
+
+    def archive_manifest(self):
+        '''
+            Returns the archive manifest of the file upload, see
+            archives.archive_manifest(). It is computed on first usage and stored,
+            so that the file type and the member list are known without
+            opening the upload again.
+        '''
+        if self.manifest is None:
+            try:
+                manifest = archives.archive_manifest(self.attachment.path)
+            except (IOError, ValueError) as e:
+                # The file behind the given path does not exist, try again later
+                logger.warning("Cannot inspect file upload %s: %s" % (self.attachment.name, e))
+                return {'type': None, 'members': []}
+            self.manifest = json.dumps(manifest)
+            if self.pk:
+                self.save(update_fields=['manifest'])
+        return json.loads(self.manifest)
+
     def attachment_md5(self):
         '''
             Calculate the checksum of the file upload.
@@ -70,51 +141,45 @@ class SubmissionFile(models.Model):
             - Whitespace and tabs are removed before comparison.
             - For MD5, ordering is important, so we compute it on the sorted list of
               file hashes.
-        '''
-        MAX_MD5_FILE_SIZE = 10000
-        md5_set = []
 
-        def md5_add_text(text):
-            try:
-                text = str(text, errors='ignore')
-                text = text.replace(' ', '').replace(
-                    '\n', '').replace('\t', '')
-                hexvalues = hashlib.md5(text.encode('utf-8')).hexdigest()
-                md5_set.append(hexvalues)
-            except Exception as e:
-                # not unicode decodable
-                pass
-
-        def md5_add_file(f):
-            try:
-                md5 = hashlib.md5()
-                for chunk in f.chunks():
-                    md5.update(chunk)
-                md5_set.append(md5.hexdigest())
-            except Exception:
-                pass
+            The member hashes are taken from the archive manifest.
+        '''
+        md5_set = [member['md5'] for member in self.archive_manifest()['members']
+                   if member['md5']]
+        result = hashlib.md5(
+            ''.join(sorted(md5_set)).encode('utf-8')).hexdigest()
+        return result
 
+    def _signature_text(self):
         try:
-            if zipfile.is_zipfile(self.attachment.path):
-                zf = zipfile.ZipFile(self.attachment.path, 'r')
-                for zipinfo in zf.infolist():
-                    if zipinfo.file_size < MAX_MD5_FILE_SIZE:
-                        md5_add_text(zf.read(zipinfo))
-            elif tarfile.is_tarfile(self.attachment.path):
-                tf = tarfile.open(self.attachment.path, 'r')
-                for tarinfo in tf.getmembers():
-                    if tarinfo.isfile():
-                        if tarinfo.size < MAX_MD5_FILE_SIZE:
-                            md5_add_text(tf.extractfile(tarinfo).read())
-            else:
-                md5_add_file(self.attachment)
+            sig = similarity.file_signature(self.absolute_path())
         except Exception as e:
-            logger.warning(
-                "Exception on archive MD5 computation, using file checksum: " + str(e))
+            logger.warning("Exception on similarity signature computation: " + str(e))
+            sig = None
+        # Empty string for 'no signature', to avoid computing it again
+        return json.dumps(sig) if sig else ''
 
-        result = hashlib.md5(
-            ''.join(sorted(md5_set)).encode('utf-8')).hexdigest()
-        return result
+    def similarity_signature(self):
+        '''
+            Returns the signature for similarity detection, see the similarity module.
+            Returns None for files without text content, and for files
+            the 'updatechecksums' command did not process yet.
+        '''
+        return json.loads(self.signature) if self.signature else None
+
+    def update_checksums(self):
+        '''
+            Computes and stores the archive manifest, the MD5 checksum
+            and the similarity signature.
+            For new uploads, this is done in the background by the
+            'updatechecksums' command, and not in the upload request.
+
+            Raises IOError if the file cannot be read.
+        '''
+        self.manifest = json.dumps(archives.archive_manifest(self.attachment.path))
+        self.md5 = self.attachment_md5()
+        self.signature = self._signature_text()
+        self.save(update_fields=['manifest', 'md5', 'signature'])
 
     def basename(self):
         return self.attachment.name[self.attachment.name.rfind('/') + 1:]
@@ -142,70 +207,91 @@ class SubmissionFile(models.Model):
         '''
             Determines if the attachment is an archive.
         '''
-        try:
-            if zipfile.is_zipfile(self.attachment.path) or tarfile.is_tarfile(self.attachment.path):
-                return True
-        except Exception:
-            pass
-        return False
+        return self.archive_manifest()['type'] in ('zip', 'tar')
 
-    def previews(self):
+    def preview_index(self):
         '''
-            Return preview on archive file / single file content as dictionary.
-            In order to avoid browser and web server trashing by the students,
-            there is a size limit for the single files shown.
+            Returns the list of files for the preview page, as dictionaries
+            with the member index, name and size. Archive directories and
+            other special members are left out. The file contents are
+            fetched separately with preview_page().
         '''
-        MAX_PREVIEW_SIZE = 1000000
-
-        def sanitize(bytes):
-            return bytes.decode('utf-8', 'ignore')
+        return [{'index': index, 'name': member['name'], 'size': member['size']}
+                for index, member in enumerate(self.archive_manifest()['members'])
+                if member['file']]
 
-        def is_code(fname):
-            code_endings = ['.c', '.cpp', 'Makefile',
-                            '.java', '.py', '.rb', '.js']
-            for ending in code_endings:
-                if fname.endswith(ending):
-                    return True
-            return False
+    def _read_member(self, kind, index, offset, length):
+        '''
+            Reads up to length bytes of the given archive member,
+            starting at the given offset.
+        '''
+        def skip_and_read(f):
+            remaining = offset
+            while remaining > 0:
+                skipped = len(f.read(min(remaining, archives.CHUNK_SIZE)))
+                if not skipped:
+                    break
+                remaining -= skipped
+            return f.read(length)
+
+        if kind == 'zip':
+            with zipfile.ZipFile(self.attachment.path, 'r') as zf:
+                with zf.open(zf.infolist()[index]) as f:
+                    return skip_and_read(f)
+        elif kind == 'tar':
+            with tarfile.open(self.attachment.path, 'r') as tf:
+                for position, info in enumerate(tf):
+                    if position == index:
+                        return skip_and_read(tf.extractfile(info))
+            raise IndexError(index)
+        else:
+            with open(self.attachment.path, 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
 
-        result = []
-        try:
-            assert(self.attachment.path is not None)
-        except ValueError:
-            # The file behind the given path does not exist
+    def preview_page(self, index, offset=0, length=PREVIEW_PAGE_SIZE):
+        '''
+            Return one page of a file in the preview as dictionary,
+            starting at the given byte offset. The index is taken from
+            preview_index(). Pages end on a line break if possible.
+            'next_offset' is the start of the next page, or None for
+            the last one. 'lines' counts the lines on the page, including
+            an unterminated last line, which 'open_line' tells about.
+
+            Returns None if there is no such file.
+        '''
+        manifest = self.archive_manifest()
+        members = manifest['members']
+        if not 0 <= index < len(members) or not members[index]['file']:
             return None
-        if zipfile.is_zipfile(self.attachment.path):
-            zf = zipfile.ZipFile(self.attachment.path, 'r')
-            for zipinfo in zf.infolist():
-                if zipinfo.file_size < MAX_PREVIEW_SIZE:
-                    try:
-                        result.append({'name': zipinfo.filename, 'is_code': is_code(
-                            zipinfo.filename), 'preview': sanitize(zf.read(zipinfo))})
-                    except NotImplementedError as e:
-                        result.append(
-                                {'name': zipinfo.filename, 'is_code': False, 'preview': '(NotImplementedError: %s)' % (e)})
-
-                    result.append({'name': zipinfo.filename, 'is_code': is_code(
-                        zipinfo.filename), 'preview': sanitize(zf.read(zipinfo))})
-                else:
-                    result.append(
-                        {'name': zipinfo.filename, 'is_code': False, 'preview': '(maximum size exceeded)'})
-        elif tarfile.is_tarfile(self.attachment.path):
-            tf = tarfile.open(self.attachment.path, 'r')
-            for tarinfo in tf.getmembers():
-                if tarinfo.isfile():
-                    if tarinfo.size < MAX_PREVIEW_SIZE:
-                        result.append({'name': tarinfo.name, 'is_code': is_code(
-                            tarinfo.name), 'preview': sanitize(tf.extractfile(tarinfo).read())})
-                    else:
-                        result.append(
-                            {'name': tarinfo.name, 'is_code': False, 'preview': '(maximum size exceeded)'})
-        else:
-            # single file
-            f = open(self.attachment.path, 'rb')
-            fname = f.name[f.name.rfind(os.sep) + 1:]
-            result = [{'name': fname, 'is_code': is_code(
-                fname), 'preview': sanitize(f.read())}, ]
+        member = members[index]
+        offset = max(0, offset)
+        result = {'name': member['name'], 'size': member['size'], 'offset': offset,
+                  'is_code': is_code(member['name']), 'next_offset': None}
+        try:
+            # One more byte tells if there is a next page
+            data = self._read_member(manifest['type'], index, offset, length + 1)
+        except (IOError, IndexError, zipfile.BadZipFile, tarfile.TarError,
+                NotImplementedError, RuntimeError, EOFError) as e:
+            result.update({'is_code': False, 'lines': 1, 'open_line': False,
+                           'preview': '(%s: %s)' % (e.__class__.__name__, e)})
+            return result
+        if len(data) > length:
+            data = data[:length]
+            end = data.rfind(b'\n') + 1
+            if not end:
+                # No line break, at least do not cut UTF-8 characters
+                end = length
+                while end > length - 3 and data[end - 1] & 0xC0 == 0x80:
+                    end -= 1
+                if data[end - 1] & 0xC0 == 0xC0:
+                    end -= 1
+                end = end or length
+            data = data[:end]
+            result['next_offset'] = offset + end
+        result['preview'] = data.decode('utf-8', 'ignore')
+        result['open_line'] = bool(data) and not data.endswith(b'\n')
+        result['lines'] = data.count(b'\n') + (1 if result['open_line'] else 0)
         return result
 
     def test_result_dict(self):
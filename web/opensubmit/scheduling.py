@@ -0,0 +1,141 @@
+'''
+    Scheduling policy for executor jobs.
+
+    Pending jobs are grouped into queues, one per priority class and course.
+    The head of each queue is its oldest job. When an executor asks for work,
+    the queues are ranked by a score, and the head of the best queue is handed out.
+
+    The score combines three aspects, all expressed as waiting time in seconds:
+
+    - Priority classes: Each class step costs CLASS_STEP seconds.
+    - Fair share: Each job of the same course that is currently running
+      costs FAIR_SHARE_STEP seconds.
+    - Aging: The waiting time of the queue head is subtracted,
+      so that low priority jobs cannot starve.
+
+    This module is independent from the database, so that the policy can be
+    tested and simulated in isolation.
+
+    Executor requests waiting for work (long polling) are woken up
+    by announce_jobs() when new jobs are queued. Waiting requests in the
+    same process are notified directly. Other server processes, such as
+    the separate mod_wsgi process group for executor requests, see the
+    announcement file below MEDIA_ROOT grow, which they check every
+    ANNOUNCE_POLL seconds.
+'''
+
+from collections import namedtuple
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger('OpenSubmit')
+
+JobQueue = namedtuple('JobQueue', ['job_class', 'course', 'oldest'])
+
+
+class SchedulingPolicy(object):
+    '''
+        Ranks job queues for the next executor request.
+        The priority classes are given as list, highest priority first.
+    '''
+    CLASS_STEP = 3600
+    FAIR_SHARE_STEP = 60
+
+    def __init__(self, priority_classes, class_step=CLASS_STEP, fair_share_step=FAIR_SHARE_STEP):
+        self.priority_classes = list(priority_classes)
+        self.class_step = class_step
+        self.fair_share_step = fair_share_step
+
+    def score(self, queue, running, now):
+        '''
+            Computes the score of a job queue, lower is better.
+            The running argument is a dictionary of currently
+            executed jobs per course.
+        '''
+        rank = self.priority_classes.index(queue.job_class)
+        waiting = (now - queue.oldest).total_seconds()
+        return rank * self.class_step + running.get(queue.course, 0) * self.fair_share_step - waiting
+
+    def order(self, queues, running, now):
+        '''
+            Returns the given job queues, best candidate first.
+            Ties are broken by the priority class.
+        '''
+        return sorted(queues, key=lambda queue: (self.score(queue, running, now),
+                                                 self.priority_classes.index(queue.job_class)))
+
+
+# Interval for checking the announcement file while waiting, in seconds
+ANNOUNCE_POLL = 0.2
+# The announcement file is emptied again when it reaches this size
+ANNOUNCE_FILE_MAX = 100000
+
+_jobs_announced = threading.Condition()
+_announcements = 0
+
+
+def _announce_path():
+    from django.conf import settings
+    return os.path.join(settings.MEDIA_ROOT, 'jobs.announce')
+
+
+def _announce_file_size():
+    try:
+        return os.path.getsize(_announce_path())
+    except OSError:
+        return None
+
+
+def _announce_to_processes():
+    '''
+        Appends one byte to the announcement file. Appending is atomic,
+        so that several processes can announce at the same time.
+    '''
+    path = _announce_path()
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size >= ANNOUNCE_FILE_MAX:
+                os.ftruncate(fd, 0)
+            os.write(fd, b'.')
+        finally:
+            os.close(fd)
+    except OSError as e:
+        # Other processes find the job with their periodic database check
+        logger.warning("Cannot write the job announcement file %s: %s" % (path, e))
+
+
+def announcements():
+    '''
+        Returns a value for the announce_jobs() calls so far,
+        to be given to wait_for_jobs().
+    '''
+    return (_announcements, _announce_file_size())
+
+
+def announce_jobs():
+    '''
+        Wakes up all executor requests waiting for new jobs,
+        in this and in other server processes.
+    '''
+    global _announcements
+    _announce_to_processes()
+    with _jobs_announced:
+        _announcements += 1
+        _jobs_announced.notify_all()
+
+
+def wait_for_jobs(seen, timeout):
+    '''
+        Blocks until there were announcements after the given
+        announcements() value, or the timeout (in seconds) expired.
+    '''
+    deadline = time.time() + timeout
+    with _jobs_announced:
+        while announcements() == seen:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            _jobs_announced.wait(min(ANNOUNCE_POLL, remaining))
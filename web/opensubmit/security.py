@@ -35,7 +35,8 @@ def check_permission_system():
                    "delete_submission",
                    "add_submissionfile",
                    "change_submissionfile",
-                   "delete_submissionfile")
+                   "delete_submissionfile",
+                   "change_maildispatch")
     owner_perms = ("add_assignment",
                    "change_assignment",
                    "delete_assignment",
@@ -55,7 +56,8 @@ def check_permission_system():
                    "delete_submission",
                    "add_submissionfile",
                    "change_submissionfile",
-                   "delete_submissionfile")
+                   "delete_submissionfile",
+                   "change_maildispatch")
 
     logger.debug("Starting check of permission system ...")
 
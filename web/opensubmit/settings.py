@@ -180,6 +180,16 @@ else:
     PRIVACY_PAGE = None
 
 EMAIL_SUBJECT_PREFIX = '[OpenSubmit] '
+# Number of queued mails sent over one SMTP connection, see 'sendmails'
+MAIL_BATCH_SIZE = int(config.get('server', 'MAIL_BATCH_SIZE') or 100)
+# Number of processes compressing student files for the course archives, see 'buildarchives'
+ARCHIVE_WORKERS = int(config.get('server', 'ARCHIVE_WORKERS') or 2)
+# Number of executor requests that may wait for new jobs at the same time (long polling)
+JOB_LONG_POLLS = int(config.get('server', 'JOB_LONG_POLLS') or 10)
+# Minimal similarity (in percent) of submissions in the duplicate report
+SIMILARITY_THRESHOLD = int(config.get('server', 'SIMILARITY_THRESHOLD') or 80)
+# Seconds a rendered page of the file preview is kept in the cache
+PREVIEW_CACHE_TIMEOUT = int(config.get('server', 'PREVIEW_CACHE_TIMEOUT') or 86400)
 TIME_ZONE = config.get("server", "TIME_ZONE")
 LANGUAGE_CODE = 'en-en'
 USE_I18N = True
@@ -5,7 +5,8 @@ from django.contrib.auth.models import User
 from django.db import transaction
 
 from .security import check_permission_system
-from .models import Submission, Course, SubmissionFile
+from .scheduling import announce_jobs
+from .models import Submission, Course
 
 from opensubmit.models import UserProfile
 
@@ -34,17 +35,6 @@ def post_user_login(sender, request, user, **kwargs):
     check_permission_system()
 
 
-@receiver(post_save, sender=SubmissionFile)
-def submissionfile_post_save(sender, instance, signal, created, **kwargs):
-    '''
-        Update MD5 field for newly uploaded files.
-    '''
-    if created:
-        logger.debug("Running post-processing for new submission file.")
-        instance.md5 = instance.attachment_md5()
-        instance.save()
-
-
 @receiver(post_save, sender=Submission)
 def submission_post_save(sender, instance, **kwargs):
     ''' Several sanity checks after we got a valid submission object.'''
@@ -65,6 +55,11 @@ def submission_post_save(sender, instance, **kwargs):
             for subm in same_author_subm:
                 subm.state = Submission.WITHDRAWN
                 subm.save()
+    # Wake up executors waiting for work, once the job is visible for them
+    if instance.state in [Submission.TEST_VALIDITY_PENDING,
+                          Submission.TEST_FULL_PENDING,
+                          Submission.CLOSED_TEST_FULL_PENDING]:
+        transaction.on_commit(announce_jobs)
 
 
 @receiver(post_save, sender=Course)
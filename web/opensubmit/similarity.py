@@ -0,0 +1,139 @@
+'''
+    Similarity detection for student uploads.
+
+    Each upload gets a signature that summarizes its text files:
+
+    - Whitespace is removed, and all K-grams (substrings of length K)
+      of the remaining text are hashed.
+    - Winnowing keeps the smallest hash of each window of W consecutive
+      K-grams. Matching passages of at least W + K - 1 characters
+      are guaranteed to share a fingerprint, regardless of their position.
+    - MinHash reduces the fingerprint set to NUM_HASHES numbers. The share
+      of equal numbers in two signatures estimates the Jaccard similarity
+      of the fingerprint sets.
+
+    Similar pairs are found with locality-sensitive hashing: The signatures
+    are split into bands, and only signatures with an identical band are
+    compared. This avoids the comparison of all pairs.
+
+    This module is independent from the database, signatures are
+    stored by the SubmissionFile model.
+'''
+
+from itertools import combinations
+import random
+import tarfile
+import zipfile
+import zlib
+
+# Length of the hashed substrings, and number of substrings per window
+K = 20
+W = 20
+# Signature length, split into BANDS bands for the candidate search
+NUM_HASHES = 64
+BANDS = 16
+# Larger files are ignored
+MAX_FILE_SIZE = 1000000
+
+_PRIME = (1 << 61) - 1
+# Fixed seed, signatures are stored
+_random = random.Random(4711)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME))
+                 for i in range(NUM_HASHES)]
+
+
+def _is_text(data):
+    return b'\0' not in data[:8192]
+
+
+def text_files(path):
+    '''
+    Generator for the content of all text files in the given upload,
+    as bytes. Archives are read member by member.
+    '''
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for info in zf.infolist():
+                if not info.filename.endswith('/') and info.file_size < MAX_FILE_SIZE:
+                    data = zf.read(info)
+                    if _is_text(data):
+                        yield data
+    elif tarfile.is_tarfile(path):
+        with tarfile.open(path) as tf:
+            for info in tf:
+                if info.isfile() and info.size < MAX_FILE_SIZE:
+                    data = tf.extractfile(info).read()
+                    if _is_text(data):
+                        yield data
+    else:
+        with open(path, 'rb') as f:
+            data = f.read(MAX_FILE_SIZE)
+        if _is_text(data):
+            yield data
+
+
+def winnow(data):
+    '''
+    Returns the set of winnowing fingerprints for the given bytes.
+    '''
+    text = b''.join(data.split())
+    if 0 < len(text) < K:
+        return set([zlib.crc32(text)])
+    hashes = [zlib.crc32(text[i:i + K]) for i in range(len(text) - K + 1)]
+    if len(hashes) <= W:
+        return set([min(hashes)]) if hashes else set()
+    return set(min(hashes[i:i + W]) for i in range(len(hashes) - W + 1))
+
+
+def signature(fingerprints):
+    '''
+    Returns the MinHash signature of the given fingerprint set,
+    or None if the set is empty.
+    '''
+    if not fingerprints:
+        return None
+    return [min((a * x + b) % _PRIME for x in fingerprints) for a, b in _PERMUTATIONS]
+
+
+def file_signature(path):
+    '''
+    Returns the signature for the text files in the given upload,
+    or None if there is no text.
+    '''
+    fingerprints = set()
+    for data in text_files(path):
+        fingerprints |= winnow(data)
+    return signature(fingerprints)
+
+
+def similarity(sig1, sig2):
+    '''
+    Estimated similarity of two signatures, between 0 and 1.
+    '''
+    return sum(1 for h1, h2 in zip(sig1, sig2) if h1 == h2) / len(sig1)
+
+
+def similar_pairs(signatures, threshold):
+    '''
+    Find similar pairs in the given dictionary of signatures.
+
+    Returns a list of (similarity, key1, key2) tuples for all pairs with
+    a similarity of at least the threshold, most similar first.
+    Pairs far below a threshold of 0.5 may be missed.
+    '''
+    rows = NUM_HASHES // BANDS
+    buckets = {}
+    for key, sig in signatures.items():
+        if sig:
+            for band in range(BANDS):
+                bucket = (band, tuple(sig[band * rows:(band + 1) * rows]))
+                buckets.setdefault(bucket, []).append(key)
+    candidates = set()
+    for keys in buckets.values():
+        candidates.update(combinations(sorted(keys), 2))
+    result = []
+    for key1, key2 in candidates:
+        value = similarity(signatures[key1], signatures[key2])
+        if value >= threshold:
+            result.append((value, key1, key2))
+    return sorted(result, key=lambda pair: (-pair[0], pair[1], pair[2]))
@@ -12,16 +12,23 @@ Missing tests:
 import os
 import os.path
 import sys
+import time
+import tempfile
 import logging
+import threading
+import socketserver
+from datetime import datetime, timedelta
+from http.server import HTTPServer
 
 from django.core import mail
+from django.core.management import call_command
 from django.conf import settings
 from django.test import TestCase
 from django.test.utils import override_settings
 from opensubmit.tests.cases import SubmitStudentScenarioTestCase
 from django.core.urlresolvers import reverse
 
-from opensubmit.models import TestMachine, SubmissionTestResult, Submission
+from opensubmit.models import TestMachine, SubmissionTestResult, Submission, SubmissionFile
 from opensubmit.tests import utils
 
 from .helpers.submission import create_validatable_submission
@@ -63,6 +70,88 @@ class CmdLine(TestCase):
         with locking.ScriptLock(self.config):
             cmdline.console_script()
 
+    def test_exclusive_slot_lock(self):
+        events = []
+
+        def exclusive_job():
+            with locking.SlotLock(self.config) as lock:
+                lock.make_exclusive()
+                events.append('exclusive')
+
+        with locking.SlotLock(self.config):
+            other = threading.Thread(target=exclusive_job)
+            other.start()
+            time.sleep(0.5)
+            # The exclusive job must wait for us
+            events.append('shared')
+        other.join()
+        self.assertEqual(['shared', 'exclusive'], events)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    '''
+    http.server only offers this from Python 3.7 on.
+    '''
+    daemon_threads = True
+
+
+class Connection(TestCase):
+    '''
+    Tests for the persistent HTTP connections of the executor.
+    '''
+    def setUp(self):
+        from http.server import BaseHTTPRequestHandler
+        self.config = config.read_config(
+            os.path.dirname(__file__) + "/executor.cfg")
+        self.connections = []
+        self.drop_next = False
+        testcase = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                testcase.connections.append(self.client_address)
+
+            def do_GET(self):
+                if testcase.drop_next:
+                    testcase.drop_next = False
+                    self.close_connection = True
+                    return
+                body = self.path.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%u' % self.httpd.server_port
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        from opensubmitexec.connection import close_connections
+        close_connections()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_connection_reuse(self):
+        from opensubmitexec.connection import urlopen
+        for i in range(3):
+            with urlopen(self.config, self.url + '/%u' % i) as response:
+                self.assertEqual(('/%u' % i).encode('utf-8'), response.read())
+        self.assertEqual(1, len(self.connections))
+
+    def test_retry(self):
+        from opensubmitexec.connection import urlopen
+        self.drop_next = True
+        with urlopen(self.config, self.url + '/retried') as response:
+            self.assertEqual(b'/retried', response.read())
+        self.assertEqual(2, len(self.connections))
+
 
 class Library(SubmitStudentScenarioTestCase):
     '''
@@ -73,6 +162,8 @@ class Library(SubmitStudentScenarioTestCase):
         self.config = config.read_config(
             os.path.dirname(__file__) + "/executor.cfg",
             override_url=self.live_server_url)
+        # Undelivered results must not leak into other test cases
+        self.config.set("Execution", "outbox_dir", tempfile.mkdtemp())
 
     def _register_executor(self):
         server.send_hostinfo(self.config)
@@ -281,6 +372,8 @@ class Communication(SubmitStudentScenarioTestCase):
         self.config = config.read_config(
             os.path.dirname(__file__) + "/executor.cfg",
             override_url=self.live_server_url)
+        # Undelivered results must not leak into other test cases
+        self.config.set("Execution", "outbox_dir", tempfile.mkdtemp())
 
     def _register_executor(self):
         server.send_hostinfo(self.config)
@@ -343,6 +436,376 @@ class Communication(SubmitStudentScenarioTestCase):
             self.assertEqual(NUM_PARALLEL, len(results))
             self.assertNotEqual(0, len(results[0].result))
 
+    def test_parallel_job_claiming(self):
+        NUM_JOBS = 6
+        NUM_EXECUTORS = 10
+        self.validated_assignment.test_machines.add(self._register_executor())
+        subs = []
+        for i in range(1, NUM_JOBS + 1):
+            stud = create_user(get_student_dict(i))
+            self.course.participants.add(stud.profile)
+            sf = create_submission_file()
+            subs.append(create_validatable_submission(
+                stud, self.validated_assignment, sf))
+
+        # Each simulated executor fetches jobs until the queue is empty
+        def claim_jobs():
+            claimed = []
+            job = server.fetch_job(self.config)
+            while job:
+                claimed.append(int(job.sub_id))
+                job = server.fetch_job(self.config)
+            return claimed
+
+        results = utils.run_parallel(NUM_EXECUTORS, claim_jobs)
+        claimed = [sub_id for result in results for sub_id in result]
+        self.assertEqual(sorted(sub.pk for sub in subs), sorted(claimed))
+
+    def test_batch_job_fetch(self):
+        self.validated_assignment.test_machines.add(self._register_executor())
+        subs = []
+        for i in range(1, 4):
+            stud = create_user(get_student_dict(i))
+            self.course.participants.add(stud.profile)
+            subs.append(create_validatable_submission(
+                stud, self.validated_assignment, create_submission_file()))
+
+        jobs = server.fetch_jobs(self.config, 2)
+        self.assertEqual(2, len(jobs))
+        jobs += server.fetch_jobs(self.config, 5)
+        self.assertEqual(3, len(jobs))
+        self.assertEqual([], server.fetch_jobs(self.config, 5))
+        self.assertEqual(sorted(str(sub.pk) for sub in subs),
+                         sorted(job.sub_id for job in jobs))
+        for job in jobs:
+            self.assertIn('helloworld.c', os.listdir(job.working_dir))
+            self.assertEqual(job.action, 'test_validity')
+        jobs[0].send_pass_result(info_student="Batch job done.")
+        self.assertEqual(1, SubmissionTestResult.objects.filter(
+            kind=SubmissionTestResult.VALIDITY_TEST).count())
+
+    def test_batch_job_fetch_validator_error(self):
+        from opensubmitexec.cache import ValidatorCache
+        from unittest import mock
+        from urllib.error import HTTPError
+
+        self.validated_assignment.test_machines.add(self._register_executor())
+        subs = []
+        for i in range(1, 4):
+            stud = create_user(get_student_dict(i))
+            self.course.participants.add(stud.profile)
+            subs.append(create_validatable_submission(
+                stud, self.validated_assignment, create_submission_file()))
+
+        fetch_unpacked = ValidatorCache.fetch_unpacked
+        calls = []
+
+        def failing_fetch(cache, url, directory):
+            calls.append(url)
+            if len(calls) == 2:
+                raise HTTPError(url, 500, "Server error", {}, None)
+            return fetch_unpacked(cache, url, directory)
+
+        with mock.patch('opensubmitexec.server.ValidatorCache.fetch_unpacked', failing_fetch):
+            jobs = server.fetch_jobs(self.config, 3)
+        # The broken download only affects its own job
+        self.assertEqual(2, len(jobs))
+        result = SubmissionTestResult.objects.get(kind=SubmissionTestResult.VALIDITY_TEST)
+        self.assertIn("Validator download failed", result.result_tutor)
+        self.assertNotIn(result.submission_file.submissions.all()[0].pk,
+                         [int(job.sub_id) for job in jobs])
+
+    def test_batch_download_stream(self):
+        import io
+        import json
+        import tarfile
+
+        self.validated_assignment.test_machines.add(self._register_executor())
+        for i in range(1, 3):
+            stud = create_user(get_student_dict(i))
+            self.course.participants.add(stud.profile)
+            create_validatable_submission(stud, self.validated_assignment, create_submission_file())
+        response = self.c.get('/jobs/?Secret=%s&UUID=%s&Count=2' % (
+            settings.JOB_EXECUTOR_SECRET, self.config.get("Server", "uuid")))
+        self.assertTrue(response.streaming)
+        data = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(data))
+        with tarfile.open(fileobj=io.BytesIO(data), mode='r|') as archive:
+            members = [(member.name, archive.extractfile(member).read()) for member in archive]
+        manifest = json.loads(members[0][1].decode('utf-8'))
+        self.assertEqual(['manifest.json'] + [desc['File'] for desc in manifest],
+                         [name for name, content in members])
+        for desc, (name, content) in zip(manifest, members[1:]):
+            sf = SubmissionFile.objects.get(pk=desc['SubmissionFileId'])
+            self.assertEqual(sf.sha256, desc['SubmissionChecksum'])
+            with open(sf.attachment.path, 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_submission_download_check(self):
+        import io
+        import hashlib
+
+        sub = self._register_test_machine()
+        with open(sub.file_upload.attachment.path, 'rb') as f:
+            original = f.read()
+        response = self.c.get('/jobs/?Secret=%s&UUID=%s' % (
+            settings.JOB_EXECUTOR_SECRET, self.config.get("Server", "uuid")))
+        self.assertEqual(str(len(original)), response['Content-Length'])
+        self.assertEqual(hashlib.sha256(original).hexdigest(), response['SubmissionChecksum'])
+        self.assertEqual(original, b''.join(response.streaming_content))
+
+        data = b'x' * 100000
+        checksum = hashlib.sha256(data).hexdigest()
+        target = tempfile.mkdtemp() + '/received'
+        server.receive_file(io.BytesIO(data), target, len(data), checksum)
+        with self.assertRaises(exceptions.JobException):
+            server.receive_file(io.BytesIO(data[:-1]), target, len(data), checksum)
+        with self.assertRaises(exceptions.JobException):
+            server.receive_file(io.BytesIO(data[:-1] + b'y'), target, len(data), checksum)
+
+    def test_result_outbox(self):
+        from opensubmitexec.outbox import ResultOutbox
+        from unittest import mock
+
+        self.config.set("Server", "retries", "0")
+        sub = self._register_test_machine()
+        job = server.fetch_job(self.config)
+
+        # Server is not reachable
+        live_url = self.config.get("Server", "url")
+        self.config.set("Server", "url", "http://127.0.0.1:1")
+        job.send_pass_result(info_student="Delivered later.")
+        outbox = ResultOutbox(self.config)
+        self.assertEqual(1, outbox.replay())
+        self.assertEqual(0, SubmissionTestResult.objects.count())
+
+        # Next try is not due yet
+        self.config.set("Server", "url", live_url)
+        self.assertEqual(1, outbox.replay())
+        with mock.patch('opensubmitexec.outbox.time.time', return_value=time.time() + 3600):
+            self.assertEqual(0, outbox.replay())
+        self.assertEqual("Delivered later.", SubmissionTestResult.objects.get(
+            submission_file=sub.file_upload).result)
+
+    def test_bulk_result_upload(self):
+        from opensubmitexec.outbox import ResultOutbox
+        from unittest import mock
+
+        self.config.set("Server", "retries", "0")
+        self.validated_assignment.test_machines.add(self._register_executor())
+        subs = []
+        for i in range(1, 4):
+            stud = create_user(get_student_dict(i))
+            self.course.participants.add(stud.profile)
+            subs.append(create_validatable_submission(
+                stud, self.validated_assignment, create_submission_file()))
+        jobs = server.fetch_jobs(self.config, 3)
+        self.assertEqual(3, len(jobs))
+
+        live_url = self.config.get("Server", "url")
+        self.config.set("Server", "url", "http://127.0.0.1:1")
+        jobs[0].send_pass_result(info_student="First")
+        jobs[1].send_fail_result(info_student="Second")
+        self.config.set("Server", "url", live_url)
+        with mock.patch('opensubmitexec.outbox.time.time', return_value=time.time() + 3600):
+            self.assertEqual(0, ResultOutbox(self.config).replay())
+
+        states = {str(sub.pk): Submission.objects.get(pk=sub.pk).state for sub in subs}
+        self.assertEqual(Submission.TEST_FULL_PENDING, states[jobs[0].sub_id])
+        self.assertEqual(Submission.TEST_VALIDITY_FAILED, states[jobs[1].sub_id])
+        self.assertEqual(Submission.TEST_VALIDITY_PENDING, states[jobs[2].sub_id])
+        self.assertEqual(["First", "Second"], sorted(
+            SubmissionTestResult.objects.values_list('result', flat=True)))
+        self.assertEqual(0, SubmissionFile.objects.filter(fetched__isnull=False,
+                                                          pk__in=[job.file_id for job in jobs[:2]]).count())
+
+    def test_bulk_result_upload_invalid(self):
+        machine = self._register_executor()
+        url = reverse('job_results') + '?Secret=%s&UUID=%s' % (settings.JOB_EXECUTOR_SECRET, machine.host)
+        response = self.c.post(url, 'no json', content_type='application/x-ndjson')
+        self.assertEqual(400, response.status_code)
+        for entry in ['{"SubmissionFileId": 1, "ErrorCode": "broken", "Action": "test_validity"}',
+                      '{"SubmissionFileId": 1, "ErrorCode": null}',
+                      '{"SubmissionFileId": 1, "Action": "test_validity"}',
+                      '{"SubmissionFileId": 1, "ErrorCode": 0}',
+                      '{"SubmissionFileId": 1, "ErrorCode": 0, "Action": null}',
+                      '[1, 2]']:
+            response = self.c.post(url, entry, content_type='application/x-ndjson')
+            self.assertEqual(400, response.status_code)
+        response = self.c.post(reverse('job_results') + '?Secret=foo&UUID=%s' % machine.host, '',
+                               content_type='application/x-ndjson')
+        self.assertEqual(403, response.status_code)
+
+    def test_validator_cache(self):
+        from opensubmitexec.cache import ValidatorCache
+        import filecmp
+        import glob
+
+        self.config.set("Execution", "cache_dir", tempfile.mkdtemp())
+        other_assignment = create_validated_assignment(
+            self.course, create_pass_fail_grading(),
+            "/submfiles/validation/d000fff/", "validator_run.py")
+        urls = [self.live_server_url + reverse('validity_script_secret', args=[assignment.pk, settings.JOB_EXECUTOR_SECRET])
+                for assignment in [self.validated_assignment, other_assignment]]
+        target = tempfile.mkdtemp()
+
+        cache_dir = self.config.get("Execution", "cache_dir")
+        cache = ValidatorCache(self.config)
+        first, second = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.assertEqual((None, False, first + "/download.validator"),
+                         cache.fetch_unpacked(urls[1], first))
+        blobs = glob.glob(cache_dir + "/*.blob")
+        self.assertEqual(1, len(blobs))
+        inode = os.stat(blobs[0]).st_ino
+        # Second download is answered with "Not modified"
+        cache.fetch_unpacked(urls[1], second)
+        self.assertEqual(inode, os.stat(blobs[0]).st_ino)
+        self.assertTrue(filecmp.cmp(first + "/download.validator", second + "/download.validator",
+                                    shallow=False))
+        self.assertEqual(other_assignment.attachment_test_validity.size,
+                         os.path.getsize(second + "/download.validator"))
+
+        # Only the most recent validator fits into a tiny cache
+        self.config.set("Execution", "cache_size", "0.0001")
+        cache = ValidatorCache(self.config)
+        cache.fetch_unpacked(urls[0], tempfile.mkdtemp())
+        self.assertEqual(1, len(glob.glob(cache_dir + "/*.blob")))
+        self.assertFalse(os.path.exists(blobs[0]))
+        cache.fetch_unpacked(urls[1], tempfile.mkdtemp())
+        self.assertEqual(blobs, glob.glob(cache_dir + "/*.blob"))
+
+    def test_validator_template(self):
+        from opensubmitexec.cache import ValidatorCache
+        import glob
+
+        self.config.set("Execution", "cache_dir", tempfile.mkdtemp())
+        self.config.set("Execution", "hardlink_validators", "True")
+        url = self.live_server_url + reverse('validity_script_secret', args=[self.validated_assignment.pk, settings.JOB_EXECUTOR_SECRET])
+        cache = ValidatorCache(self.config)
+
+        first, second = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.assertEqual((None, True, None), cache.fetch_unpacked(url, first))
+        self.assertEqual((None, True, None), cache.fetch_unpacked(url, second))
+        templates = glob.glob(self.config.get("Execution", "cache_dir") + "/*.template")
+        self.assertEqual(1, len(templates))
+        template_file = os.path.join(templates[0], 'validator.py')
+        self.assertEqual(os.stat(template_file).st_ino,
+                         os.stat(os.path.join(second, 'validator.py')).st_ino)
+
+        # Modifications through the hardlink lead to a fresh template
+        with open(template_file) as f:
+            original = f.read()
+        with open(os.path.join(second, 'validator.py'), 'a') as f:
+            f.write("# Modified by student code")
+        third = tempfile.mkdtemp()
+        cache.fetch_unpacked(url, third)
+        with open(os.path.join(third, 'validator.py')) as f:
+            self.assertEqual(original, f.read())
+
+    def test_validation_before_full_test(self):
+        self.validated_assignment.test_machines.add(self._register_executor())
+        full_sub = create_validatable_submission(
+            self.user, self.validated_assignment, create_submission_file())
+        full_sub.state = Submission.TEST_FULL_PENDING
+        full_sub.save()
+        stud = create_user(get_student_dict(1))
+        self.course.participants.add(stud.profile)
+        first_sub = create_validatable_submission(
+            stud, self.validated_assignment, create_submission_file())
+        stud = create_user(get_student_dict(2))
+        self.course.participants.add(stud.profile)
+        second_sub = create_validatable_submission(
+            stud, self.validated_assignment, create_submission_file())
+
+        fetched = [server.fetch_job(self.config).sub_id for i in range(3)]
+        self.assertEqual([str(first_sub.pk), str(second_sub.pk), str(full_sub.pk)], fetched)
+
+    def test_long_poll_without_jobs(self):
+        self.validated_assignment.test_machines.add(self._register_executor())
+        started = time.time()
+        self.assertIsNone(server.fetch_job(self.config, wait=1))
+        self.assertGreaterEqual(time.time() - started, 1)
+
+    def test_long_poll_dispatch(self):
+        self.validated_assignment.test_machines.add(self._register_executor())
+        fetched = []
+
+        def long_poll():
+            started = time.time()
+            job = server.fetch_job(self.config, wait=30)
+            fetched.append((job, time.time() - started))
+
+        executor = threading.Thread(target=long_poll)
+        executor.start()
+        time.sleep(1)
+        sub = create_validatable_submission(
+            self.user, self.validated_assignment, create_submission_file())
+        executor.join()
+        job, duration = fetched[0]
+        self.assertEqual(str(sub.pk), job.sub_id)
+        # Woken up by the new submission, not by the periodic database check
+        self.assertLess(duration, 4)
+
+    def test_long_poll_dispatch_other_process(self):
+        from unittest import mock
+        from opensubmit import scheduling
+        self.validated_assignment.test_machines.add(self._register_executor())
+        fetched = []
+
+        def long_poll():
+            started = time.time()
+            job = server.fetch_job(self.config, wait=30)
+            fetched.append((job, time.time() - started))
+
+        executor = threading.Thread(target=long_poll)
+        executor.start()
+        time.sleep(1)
+        # The submission is announced by another process,
+        # only the announcement file tells about it
+        with mock.patch('opensubmit.signalhandlers.announce_jobs',
+                        scheduling._announce_to_processes):
+            sub = create_validatable_submission(
+                self.user, self.validated_assignment, create_submission_file())
+        executor.join()
+        job, duration = fetched[0]
+        self.assertEqual(str(sub.pk), job.sub_id)
+        # Faster than the periodic database check
+        self.assertLess(duration, 3)
+
+    def test_daemon_drains_queue(self):
+        NUM_JOBS = 3
+        self.validated_assignment.test_machines.add(self._register_executor())
+        subs = []
+        for i in range(1, NUM_JOBS + 1):
+            stud = create_user(get_student_dict(i))
+            self.course.participants.add(stud.profile)
+            sf = create_submission_file()
+            subs.append(create_validatable_submission(
+                stud, self.validated_assignment, sf))
+
+        self.config.set("Execution", "poll_min", "0.1")
+        self.config.set("Execution", "poll_max", "0.5")
+        self.config.set("Execution", "slots", "2")
+        self.config.set("Execution", "long_poll", "1")
+        stop_event = threading.Event()
+        daemon = threading.Thread(target=cmdline.run_daemon,
+                                  args=(self.config, stop_event))
+        daemon.start()
+        try:
+            for attempt in range(100):
+                pending = Submission.pending_student_tests.filter(
+                    pk__in=[sub.pk for sub in subs]).count()
+                if pending == 0:
+                    break
+                time.sleep(0.2)
+        finally:
+            stop_event.set()
+            daemon.join()
+        self.assertEqual(0, pending)
+        results = SubmissionTestResult.objects.filter(
+            kind=SubmissionTestResult.VALIDITY_TEST)
+        self.assertEqual(NUM_JOBS, len(results))
+
     def test_too_long_validation(self):
         from django.core import mail
 
@@ -364,6 +827,7 @@ class Communication(SubmitStudentScenarioTestCase):
         self.assertEqual(sub.state, Submission.TEST_VALIDITY_FAILED)
         text = sub.get_validation_result().result
         self.assertIn("took too long", text)
+        call_command('sendmails')
         # Check mail outbox for student information
         self.assertEqual(1, len(mail.outbox))
         for email in mail.outbox:
@@ -371,6 +835,46 @@ class Communication(SubmitStudentScenarioTestCase):
             self.assertIn("failed", email.body)
             self.assertIn("localhost", email.body)
 
+    def test_expire_jobs_without_result(self):
+        sub = self._register_test_machine()
+        fresh_sub = create_validatable_submission(
+            create_user(get_student_dict(1)), self.validated_assignment, create_submission_file())
+        late_job = server.fetch_job(self.config)
+        self.assertIsNotNone(late_job)
+        self.assertIsNotNone(server.fetch_job(self.config))
+        # Let the first executor job exceed its timeout
+        timeout = timedelta(seconds=self.validated_assignment.attachment_test_timeout + 1)
+        SubmissionFile.objects.filter(pk=sub.file_upload.pk).update(
+            fetched=datetime.now() - timeout)
+
+        call_command('expirejobs')
+
+        sub = Submission.objects.get(pk=sub.pk)
+        self.assertEqual(sub.state, Submission.TEST_VALIDITY_FAILED)
+        self.assertIsNone(sub.get_fetch_date())
+        self.assertIn("non-reaction", sub.get_validation_result().result)
+        self.assertEqual(sub.get_validation_result().machine,
+                         sub.assignment.test_machines.get())
+        call_command('sendmails')
+        self.assertEqual(1, len(mail.outbox))
+        self.assertIn("Validation failed", mail.outbox[0].subject)
+        # The job still in time is left alone
+        fresh_sub = Submission.objects.get(pk=fresh_sub.pk)
+        self.assertEqual(fresh_sub.state, Submission.TEST_VALIDITY_PENDING)
+        self.assertIsNotNone(fresh_sub.get_fetch_date())
+        # A late result does not overwrite the timeout result
+        late_job.send_pass_result(info_student="Too late.")
+        sub = Submission.objects.get(pk=sub.pk)
+        self.assertEqual(sub.state, Submission.TEST_VALIDITY_FAILED)
+        self.assertIn("non-reaction", sub.get_validation_result().result)
+        # Same for full tests, without bothering the administrators
+        from opensubmit.views.api import apply_result
+        sub.state = Submission.TEST_FULL_FAILED
+        self.assertEqual((None, []), apply_result(sub, sub.assignment.test_machines.get(),
+                                                  'test_full', 0, "Too late.", None))
+        self.assertEqual(Submission.TEST_FULL_FAILED, sub.state)
+        self.assertEqual(1, len(mail.outbox))
+
     def test_broken_validator_feedback(self):
         from django.core import mail
 
@@ -390,6 +894,7 @@ class Communication(SubmitStudentScenarioTestCase):
         self.assertEqual(sub.state, Submission.TEST_VALIDITY_FAILED)
         text = sub.get_validation_result().result
         self.assertIn("Internal error", text)
+        call_command('sendmails')
         # Check mail outbox for student information
         self.assertEqual(1, len(mail.outbox))
         for email in mail.outbox:
@@ -439,6 +944,7 @@ class Communication(SubmitStudentScenarioTestCase):
         sub.refresh_from_db()
         self.assertEqual(sub.state, Submission.TEST_FULL_FAILED)
         assert("timeout" in sub.get_fulltest_result().result_tutor)
+        call_command('sendmails')
         # Failed full tests shall not be reported
         self.assertEqual(0, len(mail.outbox))
 
@@ -459,6 +965,7 @@ class Communication(SubmitStudentScenarioTestCase):
         )
         self.assertEqual(1, len(results))
         self.assertNotEqual(0, len(results[0].result))
+        call_command('sendmails')
         # Graded assignment, so no mail at this stage
         self.assertEqual(0, len(mail.outbox))
 
@@ -479,6 +986,7 @@ class Communication(SubmitStudentScenarioTestCase):
         # Fire up the executor for full test
         self.assertEqual(True, self._run_executor())
 
+        call_command('sendmails')
         # Check mail outbox for student information
         self.assertEqual(1, len(mail.outbox))
         for email in mail.outbox:
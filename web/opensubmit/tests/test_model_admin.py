@@ -8,6 +8,7 @@ from .helpers.course import create_course
 from .helpers.user import create_user, admin_dict
 from .cases import SubmitTutorTestCase
 from django.test.utils import override_settings
+from django.core.management import call_command
 
 
 from opensubmit.admin.course import CourseAdmin
@@ -93,6 +94,7 @@ class SubmissionModelAdminTestCase(SubmitTutorTestCase):
         # Everything in status 'SUBMITTED', so no mail should be sent
         self.submadm.closeAndNotifyAction(
             self.request, Submission.objects.all())
+        call_command('sendmails')
         self.assertEqual(0, len(mail.outbox))
         # One mail should be sent
         self.sub1.state = Submission.GRADED
@@ -101,12 +103,95 @@ class SubmissionModelAdminTestCase(SubmitTutorTestCase):
         self.sub2.save()
         self.submadm.closeAndNotifyAction(
             self.request, Submission.objects.all())
+        # Mails are queued, and sent by the background worker
+        self.assertEqual(0, len(mail.outbox))
+        call_command('sendmails')
         self.assertEqual(2, len(mail.outbox))
         for email in mail.outbox:
             self.assertIn("Grading", email.subject)
             self.assertIn("grading", email.body)
             self.assertIn("http://testserver/details/", email.body)
 
+    def test_close_and_notify_progress(self):
+        from opensubmit.models import MailDispatch
+        from opensubmit.admin.maildispatch import MailDispatchAdmin
+        self.sub1.state = Submission.GRADED
+        self.sub1.save()
+        self.sub2.state = Submission.GRADED
+        self.sub2.save()
+        self.submadm.closeAndNotifyAction(
+            self.request, Submission.objects.all())
+        dispatch = MailDispatch.objects.get()
+        self.assertEqual(self.request.user, dispatch.sender)
+        self.assertEqual(2, dispatch.total)
+        self.assertEqual(0, dispatch.sent())
+        call_command('sendmails')
+        self.assertEqual(2, dispatch.sent())
+        self.assertEqual(0, dispatch.failed())
+        dispadm = MailDispatchAdmin(MailDispatch, AdminSite())
+        self.assertEqual(1, dispadm.get_queryset(self.request).count())
+
+    def test_mail_retry(self):
+        from django.core import mail
+        from unittest import mock
+        from opensubmit.models import PendingMail
+        self.sub1.state = Submission.GRADED
+        self.sub1.save()
+        self.submadm.closeAndNotifyAction(
+            self.request, Submission.objects.all())
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=ConnectionRefusedError):
+            call_command('sendmails')
+        self.assertEqual(0, len(mail.outbox))
+        self.assertEqual(1, PendingMail.objects.get().attempts)
+        # Not tried again before the retry delay
+        call_command('sendmails')
+        self.assertEqual(0, len(mail.outbox))
+        PendingMail.objects.update(last_attempt=None)
+        call_command('sendmails')
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(0, PendingMail.objects.count())
+
+    def test_mail_claimed_before_sending(self):
+        from django.core import mail
+        from django.core.mail.backends.locmem import EmailBackend
+        from unittest import mock
+        from opensubmit.mails import send_pending_mails
+        from opensubmit.models import PendingMail
+        self.sub1.state = Submission.GRADED
+        self.sub1.save()
+        self.submadm.closeAndNotifyAction(
+            self.request, Submission.objects.all())
+        parallel = []
+        original = EmailBackend.send_messages
+
+        def send_messages(backend, messages):
+            # The claim is visible, a parallel worker gets nothing
+            self.assertIsNotNone(PendingMail.objects.get().last_attempt)
+            parallel.append(send_pending_mails())
+            return original(backend, messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        autospec=True, side_effect=send_messages):
+            call_command('sendmails')
+        self.assertEqual([0], parallel)
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(0, PendingMail.objects.count())
+
+    def test_mail_claim_without_skip_locked(self):
+        from django.core import mail
+        from django.db import connection
+        from unittest import mock
+        self.sub1.state = Submission.GRADED
+        self.sub1.save()
+        self.sub2.state = Submission.GRADED
+        self.sub2.save()
+        self.submadm.closeAndNotifyAction(
+            self.request, Submission.objects.all())
+        with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', False):
+            call_command('sendmails')
+        self.assertEqual(2, len(mail.outbox))
+
     def test_email_link(self):
         from django.core import mail
         # One mail should be sent
@@ -114,11 +199,24 @@ class SubmissionModelAdminTestCase(SubmitTutorTestCase):
         self.sub1.save()
         self.submadm.closeAndNotifyAction(
             self.request, Submission.objects.all())
+        call_command('sendmails')
+        self.assertEqual(1, len(mail.outbox))
         for email in mail.outbox:
             self.assertIn("Grading", email.subject)
             self.assertIn("grading", email.body)
             self.assertIn("http://testserver/details/", email.body)
 
+    def test_download_archive(self):
+        import io
+        import zipfile
+        response = self.submadm.downloadArchiveAction(
+            self.request, Submission.objects.filter(pk__in=[self.sub1.pk, self.sub3.pk]))
+        f = io.BytesIO(b''.join(response.streaming_content))
+        with zipfile.ZipFile(f, 'r') as zipped_file:
+            self.assertIsNone(zipped_file.testzip())
+            infos = [name for name in zipped_file.namelist() if name.endswith('info.txt')]
+            self.assertEqual(2, len(infos))
+
     def test_set_full_pending_all(self):
         # Only one of the submission assignments has validation configured
         self.submadm.setFullPendingStateAction(
@@ -3,9 +3,17 @@
 '''
 
 from opensubmit.tests.cases import SubmitStudentScenarioTestCase
-from opensubmit.models import Submission
+from opensubmit.tests.helpers.djangofiles import create_submission_file
+from opensubmit.models import Submission, SubmissionFile
+from opensubmit.archives import copy_member, member_data
 
+from django.core.files import File as DjangoFile
+from unittest import mock
+
+import io
 import os
+import tempfile
+import zipfile
 import logging
 
 logger = logging.getLogger('opensubmitexec')
@@ -25,6 +33,112 @@ class SubmissionModel(SubmitStudentScenarioTestCase):
         os.remove(info_file.name)
         self.assertIn(sub.submitter.get_full_name(), content)
 
+    def _archive_members(self, sub):
+        output = io.BytesIO()
+        # Nothing is unpacked on disk
+        with mock.patch('tempfile.mkdtemp', side_effect=AssertionError):
+            with zipfile.ZipFile(output, 'w') as z:
+                sub.add_to_zipfile(z)
+        z = zipfile.ZipFile(output)
+        self.assertIsNone(z.testzip())
+        # Names relative to the submission directory, student files without prefix
+        submdir = [name for name in z.namelist() if name.endswith('/info.txt')][0][:-len('info.txt')]
+        return {info.filename[len(submdir):].replace('student_files/', '', 1): info
+                for info in z.infolist()}, z
+
+    def test_add_zip_to_zipfile(self):
+        self.create_submissions()
+        sub = self.hard_deadline_passed_assignment_sub
+        upload = io.BytesIO()
+        with zipfile.ZipFile(upload, 'w') as z:
+            z.writestr('src/', b'')
+            z.writestr('src/main.c', b'int main() {}\n' * 100, zipfile.ZIP_DEFLATED)
+            z.writestr('README', b'Read me', zipfile.ZIP_STORED)
+            z.writestr('../escape.txt', b'Escaped', zipfile.ZIP_DEFLATED)
+        upload.seek(0)
+        sub.file_upload = SubmissionFile.objects.create(
+            attachment=DjangoFile(upload, 'upload.zip'), original_filename='upload.zip')
+        members, z = self._archive_members(sub)
+        self.assertEqual(['README', 'escape.txt', 'info.txt', 'src/main.c'], sorted(members))
+        # Compressed members are copied, stored ones get compressed
+        self.assertEqual(zipfile.ZIP_DEFLATED, members['src/main.c'].compress_type)
+        self.assertEqual(zipfile.ZIP_DEFLATED, members['README'].compress_type)
+        self.assertEqual(b'int main() {}\n' * 100, z.read(members['src/main.c']))
+        self.assertEqual(b'Read me', z.read(members['README']))
+        self.assertIn(sub.submitter.get_full_name(), z.read(members['info.txt']).decode('utf-8'))
+        # The compressed data is not touched
+        with zipfile.ZipFile(sub.file_upload.absolute_path()) as source:
+            info = source.getinfo('src/main.c')
+            original = member_data(source, info).read(info.compress_size)
+        copied = members['src/main.c']
+        self.assertEqual((info.CRC, info.compress_size, info.file_size),
+                         (copied.CRC, copied.compress_size, copied.file_size))
+        self.assertEqual(original, member_data(z, copied).read(copied.compress_size))
+
+    def test_copy_member_raw(self):
+        source = io.BytesIO()
+        with zipfile.ZipFile(source, 'w') as z:
+            z.writestr('deflated.txt', b'Deflated ' * 1000, zipfile.ZIP_DEFLATED)
+            z.writestr('stored.txt', b'Stored', zipfile.ZIP_STORED)
+        target = io.BytesIO()
+        with zipfile.ZipFile(source) as src, zipfile.ZipFile(target, 'w') as z:
+            # Mixed with members written by the zipfile module
+            z.writestr('first.txt', b'First')
+            for info in src.infolist():
+                copy_member(z, src, info, 'copy/' + info.filename)
+            z.writestr('last.txt', b'Last', zipfile.ZIP_DEFLATED)
+        with zipfile.ZipFile(source) as src, zipfile.ZipFile(target) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(['first.txt', 'copy/deflated.txt', 'copy/stored.txt', 'last.txt'],
+                             z.namelist())
+            for info in src.infolist():
+                copied = z.getinfo('copy/' + info.filename)
+                self.assertEqual(info.compress_type, copied.compress_type)
+                self.assertEqual(src.read(info), z.read(copied))
+                self.assertEqual(member_data(src, info).read(info.compress_size),
+                                 member_data(z, copied).read(copied.compress_size))
+            self.assertEqual(b'Last', z.read('last.txt'))
+
+    def test_copy_member_raw_streaming(self):
+        from opensubmit.views.helpers import stream_zip
+        source = io.BytesIO()
+        with zipfile.ZipFile(source, 'w') as z:
+            z.writestr('deflated.txt', b'Deflated ' * 1000, zipfile.ZIP_DEFLATED)
+
+        def fill(z):
+            with zipfile.ZipFile(source) as src:
+                copy_member(z, src, src.getinfo('deflated.txt'))
+            yield
+            z.writestr('after.txt', b'After')
+            yield
+        with zipfile.ZipFile(io.BytesIO(b''.join(stream_zip(fill)))) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(b'Deflated ' * 1000, z.read('deflated.txt'))
+            self.assertEqual(b'After', z.read('after.txt'))
+
+    def test_add_tar_to_zipfile_old_python(self):
+        # Python 3.5 has no streaming write of ZIP members
+        with mock.patch('opensubmit.archives.sys.version_info', (3, 5, 0)):
+            self.test_add_tar_to_zipfile()
+
+    def test_add_tar_to_zipfile(self):
+        self.create_submissions()
+        sub = self.hard_deadline_passed_assignment_sub
+        sub.file_upload = create_submission_file()
+        members, z = self._archive_members(sub)
+        self.assertIn('info.txt', members)
+        self.assertTrue(any(name.startswith('subdir/') for name in members))
+
+    def test_add_broken_archive_to_zipfile(self):
+        self.create_submissions()
+        sub = self.hard_deadline_passed_assignment_sub
+        sub.file_upload = SubmissionFile.objects.create(
+            attachment=DjangoFile(io.BytesIO(b'PK\x03\x04 broken'), 'broken.zip'),
+            original_filename='broken.zip')
+        members, z = self._archive_members(sub)
+        # The upload itself is added
+        self.assertEqual(2, len(members))
+
     def test_can_create_submission(self):
         self.assertEqual(
             self.open_assignment.can_create_submission(
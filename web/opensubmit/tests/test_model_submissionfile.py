@@ -2,6 +2,11 @@
     Tets cases focusing on the SubmissionFile model class methods.
 '''
 
+from django.core.management import call_command
+
+import os
+
+from opensubmit.models import SubmissionFile as SubmissionFileModel
 from opensubmit.tests.cases import SubmitStudentTestCase
 
 from .helpers.djangofiles import create_submission_file
@@ -10,7 +15,7 @@ from .helpers.assignment import create_pass_fail_grading
 from .helpers.course import create_course
 from .helpers.submission import create_validatable_submission
 from .helpers.submission import create_validated_submission
-from .helpers.user import create_user, admin_dict
+from .helpers.user import create_user, admin_dict, get_student_dict
 
 
 class SubmissionFile(SubmitStudentTestCase):
@@ -33,11 +38,19 @@ class SubmissionFile(SubmitStudentTestCase):
         f2 = create_submission_file(fname2)
         sub1 = create_validatable_submission(self.user, self.assign, f1)
         sub2 = create_validatable_submission(self.user, self.assign, f2)
+        self.update_checksums(sub1, sub2)
         return sub1, sub2
 
+    def update_checksums(self, *subs):
+        call_command('updatechecksums')
+        for sub in subs:
+            sub.file_upload.refresh_from_db()
+
     def test_md5_equal_archive_file(self):
         sub1 = create_validated_submission(self.user, self.assign)
         sub2 = create_validated_submission(self.user, self.assign)
+        self.update_checksums(sub1, sub2)
+        self.assertIsNotNone(sub1.file_upload.md5)
         self.assertEqual(sub1.file_upload.md5, sub2.file_upload.md5)
 
     def test_md5_equal_non_archive_file(self):
@@ -63,3 +76,154 @@ class SubmissionFile(SubmitStudentTestCase):
             "submfiles/duplicates/duplicate_copy.zip",
             "submfiles/validation/1000ttt/packed.tgz")
         self.assertNotEqual(sub1.file_upload.md5, sub2.file_upload.md5)
+
+    def test_sha256_on_upload(self):
+        import hashlib
+
+        sf = create_submission_file()
+        with open(sf.attachment.path, 'rb') as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        sf.refresh_from_db()
+        self.assertEqual(expected, sf.sha256)
+        # Older files get it on first usage
+        SubmissionFileModel.objects.filter(pk=sf.pk).update(sha256=None)
+        sf.refresh_from_db()
+        self.assertEqual(expected, sf.attachment_sha256())
+        sf.refresh_from_db()
+        self.assertEqual(expected, sf.sha256)
+
+    def test_archive_manifest(self):
+        tgz = create_submission_file()
+        manifest = tgz.archive_manifest()
+        self.assertEqual('tar', manifest['type'])
+        self.assertEqual(['subdir', 'subdir/helloworld.c'],
+                         [member['name'] for member in manifest['members']])
+        self.assertEqual([False, True], [member['file'] for member in manifest['members']])
+        self.assertEqual(91, manifest['members'][1]['size'])
+        self.assertIsNotNone(manifest['members'][1]['md5'])
+
+        zipped = create_submission_file("submfiles/duplicates/duplicate_orig.zip")
+        self.assertEqual('zip', zipped.archive_manifest()['type'])
+        self.assertEqual(2, len(zipped.archive_manifest()['members']))
+
+        with_dirs = create_submission_file("submfiles/validation/1000ttf/packed.zip")
+        self.assertEqual([False, True], [member['file'] for member in with_dirs.archive_manifest()['members']])
+
+        single = create_submission_file("submfiles/validation/1100ttf/validator.py")
+        manifest = single.archive_manifest()
+        self.assertEqual('file', manifest['type'])
+        self.assertEqual(1, len(manifest['members']))
+        self.assertFalse(single.is_archive())
+
+    def test_archive_manifest_stored(self):
+        sf = create_submission_file()
+        self.assertTrue(sf.is_archive())
+        sf.refresh_from_db()
+        self.assertIsNotNone(sf.manifest)
+        # The upload is not opened again for stored manifests
+        path = sf.attachment.path
+        os.rename(path, path + '.moved')
+        try:
+            self.assertTrue(sf.is_archive())
+            md5 = sf.attachment_md5()
+        finally:
+            os.rename(path + '.moved', path)
+        self.assertEqual(md5, sf.attachment_md5())
+
+    def test_preview_pages(self):
+        sf = create_submission_file()
+        self.assertEqual([{'index': 1, 'name': 'subdir/helloworld.c', 'size': 91}],
+                         sf.preview_index())
+        self.assertIsNone(sf.preview_page(0))
+        self.assertIsNone(sf.preview_page(2))
+        page = sf.preview_page(1)
+        self.assertEqual(91, len(page['preview']))
+        self.assertIsNone(page['next_offset'])
+        self.assertTrue(page['is_code'])
+        self.assertEqual(page['preview'].count('\n'), page['lines'])
+        self.assertFalse(page['open_line'])
+        # Small pages end after a line break
+        pages = []
+        offset = 0
+        while offset is not None:
+            page = sf.preview_page(1, offset, length=40)
+            self.assertLessEqual(len(page['preview']), 40)
+            pages.append(page['preview'])
+            offset = page['next_offset']
+        self.assertTrue(all(text.endswith('\n') for text in pages[:-1]))
+        self.assertEqual(sf.preview_page(1)['preview'], ''.join(pages))
+
+    def test_preview_page_utf8(self):
+        sf = create_submission_file("submfiles/validation/1100ttf/validator.py")
+        with open(sf.attachment.path, 'wb') as f:
+            f.write(('\u00e4' * 40).encode('utf-8'))
+        # No line break, the page must not end within a character
+        page = sf.preview_page(0, 0, length=25)
+        self.assertEqual('\u00e4' * 12, page['preview'])
+        self.assertEqual(24, page['next_offset'])
+        # The unterminated line is counted
+        self.assertEqual(1, page['lines'])
+        self.assertTrue(page['open_line'])
+        page = sf.preview_page(0, 24, length=25)
+        self.assertEqual('\u00e4' * 12, page['preview'])
+
+    def test_duplicate_files(self):
+        students = [create_user(get_student_dict(i)) for i in range(1, 6)]
+
+        def submit(student, assignment, fname):
+            return create_validatable_submission(student, assignment, create_submission_file(fname))
+        other_assign = create_validated_assignment_with_archive(
+            self.course, self.grading_scheme)
+        sub1 = submit(students[0], self.assign, "submfiles/duplicates/duplicate_copy.zip")
+        sub2 = submit(students[1], self.assign, "submfiles/duplicates/duplicate_orig.zip")
+        # Duplicate in another assignment
+        sub3 = submit(students[2], other_assign, "submfiles/duplicates/duplicate_orig.zip")
+        # Duplicates that do not touch this assignment
+        submit(students[3], other_assign, "submfiles/validation/1000ttt/packed.tgz")
+        submit(students[4], other_assign, "submfiles/validation/1000ttt/packed.tgz")
+        # No duplicate
+        submit(students[3], self.assign, "submfiles/validation/1100ttf/validator.py")
+        # Withdrawn duplicate
+        withdrawn = submit(students[4], self.assign, "submfiles/validation/1100ttf/validator.py")
+        withdrawn.state = withdrawn.WITHDRAWN
+        withdrawn.save()
+        self.update_checksums(sub1, sub2, sub3)
+        # One query for the files, the rest for the template data
+        with self.assertNumQueries(7):
+            dups = self.assign.duplicate_files()
+        self.assertEqual(1, len(dups))
+        key, file_list = dups[0]
+        self.assertEqual(sub1.file_upload.md5, key)
+        self.assertEqual([sub1.file_upload, sub2.file_upload, sub3.file_upload], file_list)
+
+    def test_duplicate_files_without_checksums(self):
+        # Not processed by the background worker yet
+        sub1 = create_validatable_submission(
+            create_user(get_student_dict(1)), self.assign,
+            create_submission_file("submfiles/duplicates/duplicate_orig.zip"))
+        sub2 = create_validatable_submission(
+            create_user(get_student_dict(2)), self.assign,
+            create_submission_file("submfiles/duplicates/duplicate_copy.zip"))
+        # Not computed in the request
+        self.assertEqual([], self.assign.duplicate_files())
+        self.assertEqual(2, self.assign.duplicates_pending())
+        call_command('updatechecksums')
+        sub1.file_upload.refresh_from_db()
+        self.assertEqual(0, self.assign.duplicates_pending())
+        self.assertEqual([[sub1.file_upload.md5, [sub1.file_upload, sub2.file_upload]]],
+                         [[key, file_list] for key, file_list in self.assign.duplicate_files()])
+
+    def test_update_checksums_missing_file(self):
+        sub1 = create_validatable_submission(
+            create_user(get_student_dict(1)), self.assign,
+            create_submission_file("submfiles/duplicates/duplicate_orig.zip"))
+        sub2 = create_validatable_submission(
+            create_user(get_student_dict(2)), self.assign,
+            create_submission_file("submfiles/duplicates/duplicate_copy.zip"))
+        os.remove(sub1.file_upload.absolute_path())
+        # The other files are still processed
+        call_command('updatechecksums')
+        sub1.file_upload.refresh_from_db()
+        sub2.file_upload.refresh_from_db()
+        self.assertIsNone(sub1.file_upload.md5)
+        self.assertIsNotNone(sub2.file_upload.md5)
@@ -0,0 +1,154 @@
+'''
+    Tests for the executor job scheduling policy.
+
+    The simulation runs a synthetic workload against the policy,
+    without database, and checks the waiting times per job class.
+'''
+
+import heapq
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from django.test import SimpleTestCase
+
+from opensubmit.models import Submission
+from opensubmit.scheduling import SchedulingPolicy, JobQueue
+
+import logging
+logger = logging.getLogger('OpenSubmit')
+
+VALIDATION = Submission.TEST_VALIDITY_PENDING
+FULL_TEST = Submission.TEST_FULL_PENDING
+CLOSED_FULL_TEST = Submission.CLOSED_TEST_FULL_PENDING
+CLASSES = [VALIDATION, FULL_TEST, CLOSED_FULL_TEST]
+
+
+def simulate(policy, jobs, executors):
+    '''
+        Runs the given jobs on a number of executors.
+        Jobs are tuples of (arrival second, job class, course, duration in seconds).
+        Returns the waiting times per job class and course.
+    '''
+    start = datetime(2019, 1, 1)
+    jobs = sorted(jobs)
+    pending = []
+    running = []
+    waits = defaultdict(list)
+    now = 0
+    while jobs or pending or running:
+        # Advance to the next arrival or completion
+        next_times = [jobs[0][0]] if jobs else []
+        if running:
+            next_times.append(running[0][0])
+        if pending and len(running) < executors:
+            next_times.append(now)
+        now = max(now, min(next_times))
+        while jobs and jobs[0][0] <= now:
+            pending.append(jobs.pop(0))
+        while running and running[0][0] <= now:
+            heapq.heappop(running)
+        # Hand out work to all free executors
+        while pending and len(running) < executors:
+            heads = {}
+            for job in pending:
+                key = (job[1], job[2])
+                if key not in heads or job[0] < heads[key][0]:
+                    heads[key] = job
+            queues = [JobQueue(job_class=job_class, course=course,
+                               oldest=start + timedelta(seconds=heads[(job_class, course)][0]))
+                      for job_class, course in heads]
+            per_course = defaultdict(int)
+            for end, course in running:
+                per_course[course] += 1
+            best = policy.order(queues, per_course, start + timedelta(seconds=now))[0]
+            job = heads[(best.job_class, best.course)]
+            pending.remove(job)
+            waits[(job[1], job[2])].append(now - job[0])
+            heapq.heappush(running, (now + job[3], job[2]))
+    return waits
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def workload():
+    '''
+        One hour of steady student validations in two courses, a teacher in course 1
+        re-running the full test for 200 closed submissions after five minutes, some
+        full tests following successful validations, and a deadline rush of
+        100 validations in course 1 after half an hour.
+    '''
+    jobs = []
+    for second in range(0, 3600, 20):
+        jobs.append((second, VALIDATION, 1, 30))
+        jobs.append((second + 10, VALIDATION, 2, 30))
+    for second in range(0, 3600, 60):
+        jobs.append((second + 5, FULL_TEST, 2, 60))
+    for number in range(200):
+        jobs.append((300, CLOSED_FULL_TEST, 1, 60))
+        if number < 100:
+            jobs.append((1800, VALIDATION, 1, 30))
+    return jobs
+
+
+class SchedulingPolicyTestCase(SimpleTestCase):
+    def setUp(self):
+        self.policy = SchedulingPolicy(CLASSES)
+        self.now = datetime(2019, 1, 1, 12, 0, 0)
+
+    def _queue(self, job_class, course=1, waiting=0):
+        return JobQueue(job_class=job_class, course=course,
+                        oldest=self.now - timedelta(seconds=waiting))
+
+    def test_priority_classes(self):
+        queues = [self._queue(CLOSED_FULL_TEST), self._queue(FULL_TEST), self._queue(VALIDATION)]
+        ordered = self.policy.order(queues, {}, self.now)
+        self.assertEqual(CLASSES, [queue.job_class for queue in ordered])
+
+    def test_fifo_inside_class(self):
+        queues = [self._queue(VALIDATION, course=1, waiting=10), self._queue(VALIDATION, course=2, waiting=20)]
+        ordered = self.policy.order(queues, {}, self.now)
+        self.assertEqual(2, ordered[0].course)
+
+    def test_aging(self):
+        queues = [self._queue(VALIDATION), self._queue(CLOSED_FULL_TEST, waiting=3 * SchedulingPolicy.CLASS_STEP)]
+        ordered = self.policy.order(queues, {}, self.now)
+        self.assertEqual(CLOSED_FULL_TEST, ordered[0].job_class)
+
+    def test_fair_share(self):
+        queues = [self._queue(VALIDATION, course=1, waiting=30), self._queue(VALIDATION, course=2)]
+        ordered = self.policy.order(queues, {1: 5}, self.now)
+        self.assertEqual(2, ordered[0].course)
+
+    def test_simulated_tail_latency(self):
+        executors = 6
+        fifo = SchedulingPolicy(CLASSES, class_step=0, fair_share_step=0)
+        unfair = SchedulingPolicy(CLASSES, fair_share_step=0)
+        results = {'fifo': simulate(fifo, workload(), executors),
+                   'unfair': simulate(unfair, workload(), executors),
+                   'policy': simulate(self.policy, workload(), executors)}
+
+        logger.debug("Waiting time in seconds (p50 / p95 / max) with %u executors:" % executors)
+        for name, waits in sorted(results.items()):
+            for (job_class, course), values in sorted(waits.items()):
+                logger.debug("%8s %3s course %u: %5u / %5u / %5u" % (
+                    name, job_class, course, percentile(values, 0.5),
+                    percentile(values, 0.95), max(values)))
+
+        def tail(name, job_class, course):
+            return percentile(results[name][(job_class, course)], 0.95)
+
+        def longest(name, job_class, course):
+            return max(results[name][(job_class, course)])
+
+        # Student validations no longer wait behind the teacher's batch re-run
+        for course in [1, 2]:
+            self.assertLess(tail('policy', VALIDATION, course), tail('fifo', VALIDATION, course))
+            self.assertLess(longest('policy', VALIDATION, course), longest('fifo', VALIDATION, course))
+        # The deadline rush in course 1 does not block the other course
+        self.assertLess(tail('policy', VALIDATION, 2), tail('unfair', VALIDATION, 2))
+        self.assertLess(longest('policy', VALIDATION, 2), longest('unfair', VALIDATION, 2))
+        # The batch re-run still finishes
+        self.assertEqual(200, len(results['policy'][(CLOSED_FULL_TEST, 1)]))
@@ -0,0 +1,58 @@
+'''
+    Tests for the similarity detection of student uploads.
+'''
+
+import random
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from opensubmit import similarity
+
+
+def random_code(rnd, lines):
+    words = ['int', 'for', 'while', 'return', 'x', 'y', 'count', 'i', '=', '+', ';', '(', ')', '{', '}']
+    return '\n'.join(' '.join(rnd.choice(words) for j in range(10)) for i in range(lines)).encode('utf-8')
+
+
+class Similarity(SimpleTestCase):
+
+    def test_whitespace_ignored(self):
+        code = b'int main() {\n    return 0;\n}\n' * 5
+        self.assertEqual(similarity.winnow(code),
+                         similarity.winnow(code.replace(b'    ', b'\t').replace(b' ', b'')))
+
+    def test_short_text(self):
+        self.assertEqual(set(), similarity.winnow(b'  '))
+        self.assertEqual(1, len(similarity.winnow(b'int main() {}')))
+        self.assertIsNone(similarity.signature(set()))
+
+    def test_similar_pairs(self):
+        rnd = random.Random(1)
+        original = random_code(rnd, 200)
+        lines = original.split(b'\n')
+        # Some lines changed
+        modified = b'\n'.join(lines[:180] + [b'// changed'] * 20)
+        signatures = {
+            'original': similarity.signature(similarity.winnow(original)),
+            'modified': similarity.signature(similarity.winnow(modified)),
+            'other': similarity.signature(similarity.winnow(random_code(rnd, 200))),
+            'empty': None,
+        }
+        pairs = similarity.similar_pairs(signatures, 0.7)
+        self.assertEqual(1, len(pairs))
+        value, key1, key2 = pairs[0]
+        self.assertEqual(('modified', 'original'), (key1, key2))
+        self.assertGreater(value, 0.7)
+        self.assertLess(value, 1.0)
+        self.assertEqual([], similarity.similar_pairs(signatures, 0.99))
+
+    def test_no_full_comparison(self):
+        rnd = random.Random(2)
+        signatures = {i: similarity.signature(similarity.winnow(random_code(rnd, 20))) for i in range(200)}
+        signatures[1000] = signatures[0]
+        with mock.patch('opensubmit.similarity.similarity', side_effect=similarity.similarity) as compared:
+            pairs = similarity.similar_pairs(signatures, 0.8)
+        self.assertEqual([(1.0, 0, 1000)], pairs)
+        # Far less than the 20100 pairs
+        self.assertLess(compared.call_count, 1000)
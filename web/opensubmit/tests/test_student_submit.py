@@ -3,6 +3,8 @@
     update operations of students.
 '''
 
+from django.core.management import call_command
+
 from opensubmit.models import Submission
 from opensubmit.tests.cases import SubmitStudentScenarioTestCase
 from opensubmit.tests import rootdir
@@ -53,7 +55,12 @@ class Student(SubmitStudentScenarioTestCase):
 
         assert(sub)
         assert(sub.file_upload)
+        # Computed in the background
+        self.assertIsNone(sub.file_upload.md5)
+        call_command('updatechecksums')
+        sub.file_upload.refresh_from_db()
         assert(sub.file_upload.md5)
+        self.assertIsNotNone(sub.file_upload.signature)
 
     def test_md5_on_submit_generation(self):
         with open(rootdir + 'submfiles/validation/0100fff/python.pdf', 'rb') as f:
@@ -66,6 +73,8 @@ class Student(SubmitStudentScenarioTestCase):
         sub = Submission.objects.get(
             assignment=self.open_file_assignment,
             submitter=self.user)
+        call_command('updatechecksums')
+        sub.file_upload.refresh_from_db()
         md5_1 = sub.file_upload.md5
 
         self.create_and_login_user(get_student_dict(1))
@@ -81,6 +90,8 @@ class Student(SubmitStudentScenarioTestCase):
         sub = Submission.objects.get(
             assignment__exact=self.open_file_assignment,
             submitter__exact=self.user)
+        call_command('updatechecksums')
+        sub.file_upload.refresh_from_db()
         md5_2 = sub.file_upload.md5
 
         self.assertNotEqual(md5_1, md5_2)
@@ -7,6 +7,7 @@ import io
 import zipfile
 
 from django.contrib.auth.models import User
+from django.test.utils import override_settings
 
 from opensubmit.models import Submission
 from .cases import SubmitTeacherTestCase
@@ -82,13 +83,88 @@ class Teacher(SubmitTeacherTestCase):
         response = self.c.get('/mail/receivers=%u' % self.student.pk)
         self.assertEqual(response.status_code, 200)
 
+    def test_mail_send_students(self):
+        from django.core import mail
+        from django.core.management import call_command
+        from formtools.utils import form_hmac
+        from opensubmit.forms import MailForm
+        from opensubmit.models import MailDispatch
+        data = {'subject': 'Hello', 'message': 'Dear #FIRSTNAME#'}
+        data['hash'] = form_hmac(MailForm(data))
+        data['stage'] = '2'
+        response = self.c.post('/mail/receivers=%u' % self.student.pk, data)
+        self.assertEqual(response.status_code, 302)
+        dispatch = MailDispatch.objects.get()
+        self.assertEqual(1, dispatch.total)
+        # Sent in the background
+        self.assertEqual(0, len(mail.outbox))
+        call_command('sendmails')
+        self.assertEqual(1, dispatch.sent())
+        self.assertEqual([self.student.email], mail.outbox[0].to)
+        self.assertIn(self.student.first_name, mail.outbox[0].body)
+
+    @override_settings(MAIL_BATCH_SIZE=2)
+    def test_mail_dispatch_batches(self):
+        from django.core import mail
+        from django.core.mail.backends.locmem import EmailBackend
+        from django.core.management import call_command
+        from unittest import mock
+        from opensubmit import mails
+        from opensubmit.models import MailDispatch, PendingMail
+        dispatch = MailDispatch.objects.create(subject="Test", sender=self.user)
+        mails.queue_mass_mail(dispatch, (("Test", "Test", "a@b.c", ["%u@e.f" % i]) for i in range(5)))
+        self.assertEqual(5, dispatch.total)
+        claimed = []
+        original = EmailBackend.send_messages
+
+        def send_messages(backend, messages):
+            # Only the current batch is claimed while sending
+            claimed.append(PendingMail.objects.exclude(last_attempt=None).count())
+            return original(backend, messages)
+
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        autospec=True, side_effect=send_messages):
+            call_command('sendmails')
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual([2, 2, 2, 2, 1], claimed)
+        self.assertEqual(5, dispatch.sent())
+        self.assertEqual(0, dispatch.failed())
+
+    def test_mail_dispatch_list_view(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from opensubmit import mails
+        from opensubmit.models import MailDispatch, PendingMail
+
+        def add_dispatch():
+            dispatch = MailDispatch.objects.create(subject="Test", sender=self.user, total=5)
+            for attempts in [0, 0, mails.MAIL_MAX_ATTEMPTS]:
+                PendingMail.objects.create(subject="Test", message="Test", from_email="a@b.c",
+                                           recipients="d@e.f", dispatch=dispatch, attempts=attempts)
+            return dispatch
+
+        dispatch = add_dispatch()
+        with CaptureQueriesContext(connection) as single:
+            response = self.c.get('/teacher/opensubmit/maildispatch/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<td class="field-sent">2</td>', html=True)
+        self.assertContains(response, '<td class="field-failed">1</td>', html=True)
+        # No extra queries per row
+        add_dispatch()
+        add_dispatch()
+        with CaptureQueriesContext(connection) as multiple:
+            response = self.c.get('/teacher/opensubmit/maildispatch/')
+        self.assertEqual(len(single), len(multiple))
+        response = self.c.get('/teacher/opensubmit/maildispatch/%u/change/' % dispatch.pk)
+        self.assertEqual(response.status_code, 200)
+
     def test_course_archive_view(self):
         # add some student upload to be stored in the archive
         create_validated_submission(self.user, self.assignment)
         response = self.c.get('/course/%u/archive/' % self.course.pk)
         self.assertEqual(response.status_code, 200)
         # Test if the download is really a ZIP file
-        f = io.BytesIO(response.getvalue())
+        f = io.BytesIO(b''.join(response.streaming_content))
         zipped_file = zipfile.ZipFile(f, 'r')
         try:
             # Check ZIP file validity
@@ -112,6 +188,9 @@ class Teacher(SubmitTeacherTestCase):
             self.user, self.assignment, non_zip)
         response = self.c.get('/course/%u/archive/' % self.course.pk)
         self.assertEqual(response.status_code, 200)
+        f = io.BytesIO(b''.join(response.streaming_content))
+        with zipfile.ZipFile(f, 'r') as zipped_file:
+            self.assertTrue(any('/student_files/' in name for name in zipped_file.namelist()))
 
     def test_assignment_archive_view(self):
         # add some student upload to be stored in the archive
@@ -123,7 +202,7 @@ class Teacher(SubmitTeacherTestCase):
                               self.assignment.pk)
         self.assertEqual(response.status_code, 200)
         # Test if the download is really a ZIP file
-        f = io.BytesIO(response.getvalue())
+        f = io.BytesIO(b''.join(response.streaming_content))
         zipped_file = zipfile.ZipFile(f, 'r')
         try:
             # Check ZIP file validity
@@ -141,6 +220,98 @@ class Teacher(SubmitTeacherTestCase):
         response = self.c.get('/assignments/%u/archive/' %
                               self.assignment.pk)
         self.assertEqual(response.status_code, 200)
+        f = io.BytesIO(b''.join(response.streaming_content))
+        with zipfile.ZipFile(f, 'r') as zipped_file:
+            self.assertTrue(any('/student_files/' in name for name in zipped_file.namelist()))
+
+    @override_settings(ARCHIVE_WORKERS=2)
+    def test_course_archive_cached(self):
+        import os
+        from unittest import mock
+        from django.core.management import call_command
+        from django.http import FileResponse
+        from opensubmit.archives import CourseArchive
+        archive = CourseArchive(self.course)
+        for path in (archive.path, archive.manifest_path, archive.request_path):
+            if os.path.exists(path):
+                os.remove(path)
+            self.addCleanup(lambda path=path: os.path.exists(path) and os.remove(path))
+        sub1 = create_validated_submission(self.user, self.assignment)
+        create_validated_submission(self.user, self.assignment)
+        # Created on the fly, and requested for the background build
+        response = self.c.get('/course/%u/archive/' % self.course.pk)
+        live = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertTrue(archive.requested())
+        call_command('buildarchives')
+        self.assertFalse(archive.requested())
+        # Served from disk
+        response = self.c.get('/course/%u/archive/' % self.course.pk)
+        self.assertIsInstance(response, FileResponse)
+        stored = zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertIsNone(stored.testzip())
+        self.assertEqual(live.namelist(), stored.namelist())
+        # Only the changed submission is added again
+        sub1.notes = 'Changed'
+        sub1.save()
+        self.assertIsNone(archive.current())
+        with mock.patch('opensubmit.models.Submission.add_to_zipfile', autospec=True,
+                        side_effect=Submission.add_to_zipfile) as add_to_zipfile:
+            call_command('buildarchives')
+        self.assertEqual(1, add_to_zipfile.call_count)
+        self.assertIsNotNone(archive.current())
+        with zipfile.ZipFile(archive.current()) as updated:
+            self.assertIsNone(updated.testzip())
+            self.assertEqual(live.namelist(), updated.namelist())
+            info = [name for name in updated.namelist()
+                    if '/%u_' % sub1.pk in name and name.endswith('/info.txt')][0]
+            self.assertIn('Changed', updated.read(info).decode('utf-8'))
+
+    def test_assignment_archive_parallel(self):
+        for relpath in ("/submfiles/validation/1000tff/packed.zip",
+                        "/submfiles/validation/1000fff/helloworld.c",
+                        "/submfiles/validation/1000ttt/packed.tgz"):
+            create_validatable_submission(
+                self.user, self.assignment, create_submission_file(relpath=relpath))
+        from opensubmit.archives import add_part, compressed_parts
+        subs = Submission.objects.filter(assignment=self.assignment).order_by('pk')
+        archives = []
+        for workers in (1, 3):
+            output = io.BytesIO()
+            with self.settings(ARCHIVE_WORKERS=workers):
+                with zipfile.ZipFile(output, 'w') as z:
+                    for key, sub, compressed in compressed_parts((sub.pk, sub) for sub in subs):
+                        add_part(z, sub, compressed)
+            archives.append(zipfile.ZipFile(output))
+        serial, parallel = archives
+        self.assertIsNone(parallel.testzip())
+        self.assertEqual(serial.namelist(), parallel.namelist())
+        for info in serial.infolist():
+            self.assertEqual(serial.read(info), parallel.read(info.filename))
+            if '/student_files/' in info.filename:
+                self.assertEqual(zipfile.ZIP_DEFLATED, parallel.getinfo(info.filename).compress_type)
+        # Compressed in the worker, copied raw in the parent
+        from unittest import mock
+        from opensubmit.archives import compress_upload
+        for sub in subs:
+            compressed = zipfile.ZipFile(io.BytesIO(compress_upload(
+                sub.file_upload.absolute_path(), sub.zip_directory() + 'student_files/')))
+            with zipfile.ZipFile(io.BytesIO(), 'w') as z:
+                with mock.patch('opensubmit.archives._copy_stream', side_effect=AssertionError):
+                    sub.add_to_zipfile(z, compressed)
+
+    def test_archive_streaming(self):
+        from opensubmit.views.helpers import stream_zip
+
+        def fill(z):
+            for i in range(3):
+                z.writestr('file%u.txt' % i, b'x' * 100000, zipfile.ZIP_DEFLATED)
+                yield
+        # One chunk per part, plus the central directory
+        chunks = list(stream_zip(fill))
+        self.assertEqual(4, len(chunks))
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks)), 'r') as zipped_file:
+            self.assertIsNone(zipped_file.testzip())
+            self.assertEqual(b'x' * 100000, zipped_file.read('file2.txt'))
 
     def test_change_course_owner_signal_handler(self):
         # Get a course with some owner
@@ -13,8 +13,11 @@ from .helpers.course import create_course
 from .helpers.assignment import create_pass_fail_grading
 from .helpers.assignment import create_open_file_assignment
 
+from django.core.management import call_command
 from django.contrib.admin.sites import AdminSite
 
+import os
+
 
 class Tutor(SubmitTutorTestCase):
 
@@ -65,19 +68,73 @@ class Tutor(SubmitTutorTestCase):
             create_submission_file())
         sub3.state = Submission.WITHDRAWN
         sub3.save()
+        call_command('updatechecksums')
         response = self.c.get('/assignments/%u/duplicates/' %
                               self.assignment.pk)
         self.assertEqual(response.status_code, 200)
+        self.assertEqual(0, response.context['duplicates_pending'])
         # expect both submissions to be in the report
         self.assertIn('submission/%u/change' % sub1.pk, str(response.content))
         self.assertIn('submission/%u/change' % sub2.pk, str(response.content))
         # expect withdrawn submissions to be left out
         self.assertNotIn('#%u' % sub3.pk, str(response))
 
+    def test_similarity_report_view(self):
+        sub1 = create_validatable_submission(
+            create_user(get_student_dict(0)),
+            self.assignment,
+            create_submission_file("/submfiles/duplicates/duplicate_orig.zip"))
+        sub2 = create_validatable_submission(
+            create_user(get_student_dict(1)),
+            self.assignment,
+            create_submission_file("/submfiles/duplicates/duplicate_copy.zip"))
+        create_validatable_submission(
+            create_user(get_student_dict(2)),
+            self.assignment,
+            create_submission_file("/submfiles/validation/1000fff/helloworld.c"))
+        # Signatures are not computed in the request
+        response = self.c.get('/assignments/%u/duplicates/?threshold=90' %
+                              self.assignment.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([], response.context['similar'])
+        self.assertEqual(3, response.context['similar_pending'])
+        call_command('updatechecksums')
+        response = self.c.get('/assignments/%u/duplicates/?threshold=90' %
+                              self.assignment.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(90, response.context['threshold'])
+        similar = response.context['similar']
+        self.assertEqual([(1.0, sub1, sub2)], similar)
+        self.assertEqual(0, response.context['similar_pending'])
+
     def test_preview_view(self):
         sub1 = create_validated_submission(self.user, self.assignment)
         response = self.c.get('/preview/%u/' % sub1.pk)
         self.assertEqual(response.status_code, 200)
+        files = response.context['files']
+        self.assertEqual(['subdir/helloworld.c'], [f['name'] for f in files])
+        # File content is only delivered on request
+        self.assertNotContains(response, 'printf')
+        response = self.c.get('/preview/%u/file/%u/' % (sub1.pk, files[0]['index']))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'printf')
+        self.assertNotContains(response, 'preview-more')
+        response = self.c.get('/preview/%u/file/0/' % sub1.pk)
+        self.assertEqual(response.status_code, 404)
+
+    def test_preview_file_cached(self):
+        sub1 = create_validated_submission(self.user, self.assignment)
+        url = '/preview/%u/file/1/?offset=10' % sub1.pk
+        first = self.c.get(url)
+        self.assertEqual(first.status_code, 200)
+        # Rendered pages are served without reading the upload
+        path = sub1.file_upload.attachment.path
+        os.rename(path, path + '.moved')
+        try:
+            second = self.c.get(url)
+        finally:
+            os.rename(path + '.moved', path)
+        self.assertEqual(first.content, second.content)
 
     def test_preview_broken_view(self):
         '''
@@ -94,6 +151,9 @@ class Tutor(SubmitTutorTestCase):
             sub1.save()
             response = self.c.get('/preview/%u/' % sub1.pk)
             self.assertEqual(response.status_code, 200)
+            for f in response.context['files']:
+                response = self.c.get('/preview/%u/file/%u/' % (sub1.pk, f['index']))
+                self.assertEqual(response.status_code, 200)
 
     def test_add_course_tutor_signal_handler(self):
         # Add another user who had no backend rights before
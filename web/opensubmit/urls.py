@@ -36,6 +36,7 @@ urlpatterns = [
     url(r'^teacher/', include(admin.teacher_backend.urls)),
     url(r'^grappelli/', include('grappelli.urls')),
     url(r'^preview/(?P<pk>\d+)/$', backend.PreviewView.as_view(), name='preview'),
+    url(r'^preview/(?P<pk>\d+)/file/(?P<index>\d+)/$', backend.PreviewFileView.as_view(), name='preview_file'),
     url(r'^assignments/(?P<pk>\d+)/duplicates/$', backend.DuplicatesView.as_view(), name='duplicates'),
     url(r'^assignments/(?P<pk>\d+)/archive/$', backend.AssignmentArchiveView.as_view(), name='assarchive'),
     url(r'^course/(?P<pk>\d+)/archive/$', backend.CourseArchiveView.as_view(), name='coursearchive'),
@@ -47,6 +48,7 @@ urlpatterns = [
     url(r'^download/(?P<pk>\d+)/validity_testscript/secret=(?P<secret>\w+)$', api.ValidityScriptView.as_view(), name='validity_script_secret'),
     url(r'^download/(?P<pk>\d+)/full_testscript/secret=(?P<secret>\w+)$', api.FullScriptView.as_view(), name='full_testscript_secret'),
     url(r'^jobs/$', api.jobs, name='jobs'),
+    url(r'^jobs/results/$', api.job_results, name='job_results'),
     url(r'^machines/$', api.MachinesView.as_view(), name='machines'),
     # Error pages
     url(r'^403/$', TemplateView.as_view(template_name='403.html')),
@@ -5,24 +5,44 @@
     We therefore assume that executors come from a trusted network.
 '''
 
-from datetime import datetime, timedelta
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+import io
+import json
 import os
+import threading
+import time
 
 from django.core.exceptions import PermissionDenied
 from django.core.mail import mail_managers
-from django.http import Http404, HttpResponse
+from django.db import transaction
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, FileResponse
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import DetailView, View
 from django.utils.decorators import method_decorator
 
 from django.conf import settings
-from opensubmit.models import Assignment, Submission, TestMachine, SubmissionFile
-from opensubmit.views.helpers import BinaryDownloadMixin
+from opensubmit.models import Assignment, Submission, TestMachine, SubmissionFile, SubmissionTestResult
+from opensubmit.views.helpers import BinaryDownloadMixin, stream_tar
+from opensubmit.scheduling import announcements, announce_jobs, wait_for_jobs
 
 import logging
 logger = logging.getLogger('OpenSubmit')
 
+# Upper limit for the waiting time of long polling executors, in seconds.
+LONG_POLL_MAX = 60
+# Interval for looking into the database while waiting. New jobs are
+# normally announced within scheduling.ANNOUNCE_POLL seconds, this catches
+# jobs where the announcement got lost (e.g. unwritable MEDIA_ROOT).
+LONG_POLL_RECHECK = 5
+# Number of executor requests that may wait at the same time per process.
+# Further executors get an immediate answer.
+_long_polls = threading.BoundedSemaphore(settings.JOB_LONG_POLLS)
+# Upper limit for the number of jobs in one executor request.
+BATCH_MAX = 20
+
 
 class ValidityScriptView(BinaryDownloadMixin, DetailView):
     '''
@@ -83,6 +103,176 @@ class MachinesView(View):
         return HttpResponse(status=201)
 
 
+def file_available(sub):
+    '''
+        Checks if the file upload of a submission is on the storage.
+        On dev server, we sometimes have stale database entries.
+    '''
+    f = sub.file_upload.attachment
+    if not os.access(f.path, os.F_OK):
+        mail_managers('Warning: Missing file',
+                      'Missing file on storage for submission file entry %u: %s' % (
+                          sub.file_upload.pk, str(sub.file_upload.attachment)), fail_silently=True)
+        return False
+    return True
+
+
+def job_description(request, sub):
+    '''
+        The job information for the executor, delivered as HTTP headers
+        for single jobs and as manifest entry for batches.
+    '''
+    desc = OrderedDict()
+    desc['SubmissionFileId'] = str(sub.file_upload.pk)
+    desc['SubmissionOriginalFilename'] = sub.file_upload.original_filename
+    desc['SubmissionId'] = str(sub.pk)
+    desc['SubmitterName'] = sub.submitter.get_full_name()
+    desc['SubmitterStudentId'] = str(sub.submitter.profile.student_id)
+    desc['AuthorNames'] = str(sub.authors.all())
+    desc['SubmitterStudyProgram'] = str(sub.submitter.profile.study_program)
+    desc['Course'] = str(sub.assignment.course)
+    desc['Assignment'] = str(sub.assignment)
+    desc['Timeout'] = str(sub.assignment.attachment_test_timeout)
+    desc['SubmissionSize'] = str(sub.file_upload.attachment.size)
+    desc['SubmissionChecksum'] = sub.file_upload.attachment_sha256()
+    if sub.state == Submission.TEST_VALIDITY_PENDING:
+        desc['Action'] = 'test_validity'
+        desc['PostRunValidation'] = sub.assignment.validity_test_url(request)
+    elif sub.state == Submission.TEST_FULL_PENDING or sub.state == Submission.CLOSED_TEST_FULL_PENDING:
+        desc['Action'] = 'test_full'
+        desc['PostRunValidation'] = sub.assignment.full_test_url(request)
+    else:
+        assert (False)
+    return desc
+
+
+def batch_response(request, subs):
+    '''
+        Delivers several jobs as uncompressed TAR archive.
+        The archive is created while it is sent, see stream_tar().
+
+        The first archive member is 'manifest.json', a list of job
+        descriptions. The 'File' entry of each description names
+        the archive member with the submission file.
+    '''
+    manifest = []
+    paths = []
+    for sub in subs:
+        if file_available(sub):
+            desc = job_description(request, sub)
+            desc['File'] = '%s/%s' % (sub.file_upload.pk, sub.file_upload.basename())
+            manifest.append(desc)
+            paths.append(sub.file_upload.attachment.path)
+            logger.debug("Delivering submission %u as new %s job in batch" %
+                         (sub.pk, desc['Action']))
+    if not manifest:
+        raise Http404
+
+    data = json.dumps(manifest).encode('utf-8')
+    members = [('manifest.json', len(data), lambda: io.BytesIO(data))]
+    for path, desc in zip(paths, manifest):
+        members.append((desc['File'], int(desc['SubmissionSize']),
+                        lambda path=path: open(path, 'rb')))
+    size, content = stream_tar(members)
+    response = StreamingHttpResponse(content, content_type='application/x-tar')
+    response['Content-Length'] = str(size)
+    response['APIVersion'] = '1.0.0'  # semantic versioning
+    response['JobCount'] = str(len(manifest))
+    return response
+
+
+def apply_result(sub, machine, action, error_code, message, message_tutor):
+    '''
+        Applies a job result from an executor to the submission.
+
+        The submission state is changed, but not saved. Returns the new
+        SubmissionTestResult object (unsaved) or None, and the list of
+        states the student must be informed about.
+    '''
+    result = None
+    notifications = []
+    # Job state: Waiting for validity test
+    # Possible with + without full test
+    # Possible with + without grading
+    if action == 'test_validity' and sub.state == Submission.TEST_VALIDITY_PENDING:
+        result = sub.new_validation_result(machine, message, message_tutor)
+        if error_code == 0:
+            # We have a full test
+            if sub.assignment.attachment_test_full:
+                logger.debug(
+                    "Validity test working, setting state to pending full test")
+                sub.state = Submission.TEST_FULL_PENDING
+            # We have no full test
+            else:
+                logger.debug(
+                    "Validity test working, setting state to tested")
+                sub.state = Submission.SUBMITTED_TESTED
+                if not sub.assignment.is_graded():
+                    # Assignment is not graded. We are done here.
+                    sub.state = Submission.CLOSED
+                    notifications.append(Submission.CLOSED)
+        else:
+            logger.debug(
+                "Validity test not working, setting state to failed")
+            sub.state = Submission.TEST_VALIDITY_FAILED
+        notifications.append(sub.state)
+    # Job state: Waiting for full test
+    # Possible with + without grading
+    elif action == 'test_full' and sub.state == Submission.TEST_FULL_PENDING:
+        result = sub.new_fulltest_result(machine, message_tutor)
+        if error_code == 0:
+            if sub.assignment.is_graded():
+                logger.debug("Full test working, setting state to tested (since graded)")
+                sub.state = Submission.SUBMITTED_TESTED
+            else:
+                logger.debug("Full test working, setting state to closed (since not graded)")
+                sub.state = Submission.CLOSED
+                notifications.append(Submission.CLOSED)
+        else:
+            logger.debug("Full test not working, setting state to failed")
+            sub.state = Submission.TEST_FULL_FAILED
+            # full tests may be performed several times and are meant to be a silent activity
+            # therefore, we send no mail to the student here
+    # Job state: Waiting for full test of already closed jobs ("re-test")
+    # Grading is already done
+    elif action == 'test_full' and sub.state == Submission.CLOSED_TEST_FULL_PENDING:
+        logger.debug(
+            "Closed full test done, setting state to closed again")
+        result = sub.new_fulltest_result(machine, message_tutor)
+        sub.state = Submission.CLOSED
+        # full tests may be performed several times and are meant to be a silent activity
+        # therefore, we send no mail to the student here
+    elif (action, sub.state) in (('test_validity', Submission.TEST_VALIDITY_FAILED),
+                                 ('test_full', Submission.TEST_FULL_FAILED)):
+        # Can happen if the test is set to failed due to timeout, but the executor delivers the late result.
+        # Happens in reality only with >= 2 executors, since the second one is pulling for new jobs and triggers
+        # the timeout check while the first one is still stucked with the big job.
+        # Can be ignored.
+        logger.debug(
+            "Ignoring executor result, since the submission is already marked as failed.")
+    else:
+        msg = '''
+            Dear OpenSubmit administrator,
+
+            the executors returned some result, but this does not fit to the current submission state.
+            This is a strong indication for a bug in OpenSubmit - sorry for that.
+            The system will ignore the report from executor and mark the job as to be repeated.
+            Please report this on the project GitHub page for further investigation.
+
+            Submission ID: %u
+            Submission File ID reported by the executor: %u
+            Action reported by the executor: %s
+            Current state of the submission: %s (%s)
+            Message from the executor: %s
+            Error code from the executor: %u
+            ''' % (sub.pk, sub.file_upload.pk, action,
+                   sub.state_for_tutors(), sub.state,
+                   message, error_code)
+        mail_managers('Warning: Inconsistent job state',
+                      msg, fail_silently=True)
+    return result, notifications
+
+
 @csrf_exempt
 def jobs(request):
     ''' This is the view used by the executor.py scripts for getting / putting the test results.
@@ -111,11 +301,27 @@ def jobs(request):
                     'Secret',
                     'UUID'
 
+        GET requests may contain the following parameters:
+                    'Wait'
+
+        With 'Wait', the answer is delayed by up to this number of
+        seconds if no job is available, until a new job shows up
+        (long polling).
+
+        With 'Count', up to this number of jobs is delivered as
+        uncompressed TAR archive (see batch_response()).
+
         GET reponses deliver the following elements in the header:
                     'SubmissionFileId',
+                    'SubmissionSize',
+                    'SubmissionChecksum',
                     'Timeout',
                     'Action',
                     'PostRunValidation'
+
+        The submission file is streamed as response body. 'SubmissionChecksum'
+        is the SHA-256 hex digest of the file, so that the executor can verify
+        the download.
     '''
     try:
         if request.method == 'GET':
@@ -150,74 +356,46 @@ def jobs(request):
         raise Http404
 
     if request.method == "GET":
-        # Clean up submissions where the answer from the executors took too long
-        pending_submissions = Submission.pending_tests.filter(
-            file_upload__fetched__isnull=False)
-        #logger.debug("%u pending submission(s)"%(len(pending_submissions)))
-        for sub in pending_submissions:
-            max_delay = timedelta(
-                seconds=sub.assignment.attachment_test_timeout)
-            # There is a small chance that meanwhile the result was delivered, so fetched became NULL
-            if sub.file_upload.fetched and sub.file_upload.fetched + max_delay < datetime.now():
-                logger.debug(
-                    "Resetting executor fetch status for submission %u, due to timeout" % sub.pk)
-                # TODO:  Late delivery for such a submission by the executor may lead to result overwriting. Check this.
-                sub.clean_fetch_date()
-                if sub.state == Submission.TEST_VALIDITY_PENDING:
-                    sub.save_validation_result(
-                        machine, "Killed due to non-reaction. Please check your application for deadlocks or keyboard input.", "Killed due to non-reaction on timeout signals.")
-                    sub.state = Submission.TEST_VALIDITY_FAILED
-                    sub.inform_student(request, sub.state)
-                if sub.state == Submission.TEST_FULL_PENDING:
-                    sub.save_fulltest_result(
-                        machine, "Killed due to non-reaction on timeout signals. Student not informed, since this was the full test.")
-                    sub.state = Submission.TEST_FULL_FAILED
-                sub.save()
-
-        # Now get an appropriate submission.
-        submissions = Submission.pending_tests
-        submissions = submissions.filter(assignment__in=machine.assignments.all()) \
-                                 .filter(file_upload__isnull=False) \
-                                 .filter(file_upload__fetched__isnull=True)
-        if len(submissions) == 0:
+        try:
+            wait = min(float(request.GET.get('Wait', 0)), LONG_POLL_MAX)
+        except ValueError:
+            wait = 0
+        try:
+            count = min(int(request.GET.get('Count', 0)), BATCH_MAX)
+        except ValueError:
+            count = 0
+        # Now get appropriate submissions.
+        seen = announcements()
+        subs = Submission.pending_tests.claim_many(machine, max(count, 1))
+        if not subs and wait > 0 and _long_polls.acquire(blocking=False):
+            try:
+                deadline = time.time() + wait
+                while not subs and time.time() < deadline:
+                    wait_for_jobs(seen, max(0, min(LONG_POLL_RECHECK, deadline - time.time())))
+                    seen = announcements()
+                    subs = Submission.pending_tests.claim_many(machine, max(count, 1))
+            finally:
+                _long_polls.release()
+        if not subs:
             # Nothing found to be fetchable
             #logger.debug("No pending work for executors")
             raise Http404
-        else:
-            sub = submissions[0]
-        sub.save_fetch_date()
-        sub.modified = datetime.now()
-        sub.save()
+        if count > 0:
+            return batch_response(request, subs)
 
         # create HTTP response with file download
-        f = sub.file_upload.attachment
-        # on dev server, we sometimes have stale database entries
-        if not os.access(f.path, os.F_OK):
-            mail_managers('Warning: Missing file',
-                          'Missing file on storage for submission file entry %u: %s' % (
-                              sub.file_upload.pk, str(sub.file_upload.attachment)), fail_silently=True)
+        sub = subs[0]
+        if not file_available(sub):
             raise Http404
-        response = HttpResponse(f, content_type='application/binary')
+        desc = job_description(request, sub)
+        # Delivered in chunks, or by the web server's file wrapper if available
+        response = FileResponse(open(sub.file_upload.attachment.path, 'rb'),
+                                content_type='application/binary')
         response['APIVersion'] = '1.0.0'  # semantic versioning
         response['Content-Disposition'] = 'attachment; filename="%s"' % sub.file_upload.basename()
-        response['SubmissionFileId'] = str(sub.file_upload.pk)
-        response['SubmissionOriginalFilename'] = sub.file_upload.original_filename
-        response['SubmissionId'] = str(sub.pk)
-        response['SubmitterName'] = sub.submitter.get_full_name()
-        response['SubmitterStudentId'] = sub.submitter.profile.student_id
-        response['AuthorNames'] = sub.authors.all()
-        response['SubmitterStudyProgram'] = str(sub.submitter.profile.study_program)
-        response['Course'] = str(sub.assignment.course)
-        response['Assignment'] = str(sub.assignment)
-        response['Timeout'] = sub.assignment.attachment_test_timeout
-        if sub.state == Submission.TEST_VALIDITY_PENDING:
-            response['Action'] = 'test_validity'
-            response['PostRunValidation'] = sub.assignment.validity_test_url(request)
-        elif sub.state == Submission.TEST_FULL_PENDING or sub.state == Submission.CLOSED_TEST_FULL_PENDING:
-            response['Action'] = 'test_full'
-            response['PostRunValidation'] = sub.assignment.full_test_url(request)
-        else:
-            assert (False)
+        response['Content-Length'] = desc['SubmissionSize']
+        for key, value in desc.items():
+            response[key] = value
         logger.debug("Delivering submission %u as new %s job" %
                      (sub.pk, response['Action']))
         return response
@@ -233,93 +411,100 @@ def jobs(request):
 
         # executor.py is providing the results as POST parameters
         sid = request.POST['SubmissionFileId']
-        submission_file = get_object_or_404(SubmissionFile, pk=sid)
-        sub = submission_file.submissions.all()[0]
+        sub = Submission.objects.filter(file_upload=sid).select_related('file_upload', 'assignment').first()
+        if not sub:
+            raise Http404
         logger.debug("Storing executor results for submission %u" % (sub.pk))
-        error_code = int(request.POST['ErrorCode'])
-        # Job state: Waiting for validity test
-        # Possible with + without full test
-        # Possible with + without grading
-        if request.POST['Action'] == 'test_validity' and sub.state == Submission.TEST_VALIDITY_PENDING:
-            sub.save_validation_result(
-                machine, request.POST['Message'], request.POST['MessageTutor'])
-            if error_code == 0:
-                # We have a full test
-                if sub.assignment.attachment_test_full:
-                    logger.debug(
-                        "Validity test working, setting state to pending full test")
-                    sub.state = Submission.TEST_FULL_PENDING
-                # We have no full test
-                else:
-                    logger.debug(
-                        "Validity test working, setting state to tested")
-                    sub.state = Submission.SUBMITTED_TESTED
-                    if not sub.assignment.is_graded():
-                        # Assignment is not graded. We are done here.
-                        sub.state = Submission.CLOSED
-                        sub.inform_student(request, Submission.CLOSED)
-            else:
-                logger.debug(
-                    "Validity test not working, setting state to failed")
-                sub.state = Submission.TEST_VALIDITY_FAILED
-            sub.inform_student(request, sub.state)
-        # Job state: Waiting for full test
-        # Possible with + without grading
-        elif request.POST['Action'] == 'test_full' and sub.state == Submission.TEST_FULL_PENDING:
-            sub.save_fulltest_result(
-                machine, request.POST['MessageTutor'])
-            if error_code == 0:
-                if sub.assignment.is_graded():
-                    logger.debug("Full test working, setting state to tested (since graded)")
-                    sub.state = Submission.SUBMITTED_TESTED
-                else:
-                    logger.debug("Full test working, setting state to closed (since not graded)")
-                    sub.state = Submission.CLOSED
-                    sub.inform_student(request, Submission.CLOSED)
-            else:
-                logger.debug("Full test not working, setting state to failed")
-                sub.state = Submission.TEST_FULL_FAILED
-                # full tests may be performed several times and are meant to be a silent activity
-                # therefore, we send no mail to the student here
-        # Job state: Waiting for full test of already closed jobs ("re-test")
-        # Grading is already done
-        elif request.POST['Action'] == 'test_full' and sub.state == Submission.CLOSED_TEST_FULL_PENDING:
-            logger.debug(
-                "Closed full test done, setting state to closed again")
-            sub.save_fulltest_result(
-                machine, request.POST['MessageTutor'])
-            sub.state = Submission.CLOSED
-            # full tests may be performed several times and are meant to be a silent activity
-            # therefore, we send no mail to the student here
-        elif request.POST['Action'] == 'test_validity' and sub.state == Submission.TEST_VALIDITY_FAILED:
-            # Can happen if the validation is set to failed due to timeout, but the executor delivers the late result.
-            # Happens in reality only with >= 2 executors, since the second one is pulling for new jobs and triggers
-            # the timeout check while the first one is still stucked with the big job.
-            # Can be ignored.
-            logger.debug(
-                "Ignoring executor result, since the submission is already marked as failed.")
-        else:
-            msg = '''
-                Dear OpenSubmit administrator,
-
-                the executors returned some result, but this does not fit to the current submission state.
-                This is a strong indication for a bug in OpenSubmit - sorry for that.
-                The system will ignore the report from executor and mark the job as to be repeated.
-                Please report this on the project GitHub page for further investigation.
-
-                Submission ID: %u
-                Submission File ID reported by the executor: %u
-                Action reported by the executor: %s
-                Current state of the submission: %s (%s)
-                Message from the executor: %s
-                Error code from the executor: %u
-                ''' % (sub.pk, submission_file.pk, request.POST['Action'],
-                       sub.state_for_tutors(), sub.state,
-                       request.POST['Message'], error_code)
-            mail_managers('Warning: Inconsistent job state',
-                          msg, fail_silently=True)
+        result, notifications = apply_result(sub, machine, request.POST['Action'],
+                                             int(request.POST['ErrorCode']),
+                                             request.POST['Message'],
+                                             request.POST.get('MessageTutor'))
+        if result:
+            result.save()
         # Mark work as done
         sub.save()
         sub.clean_fetch_date()
+        for state in notifications:
+            sub.inform_student(request, state)
         return HttpResponse(status=201)
 
+
+@csrf_exempt
+def job_results(request):
+    ''' Bulk upload of job results by an executor.
+
+        POST requests are expected to contain the following parameters in the URL:
+                    'Secret',
+                    'UUID'
+
+        The request body has one JSON object per line, with the same
+        fields as the result POST request for jobs():
+                    'SubmissionFileId',
+                    'Message',
+                    'MessageTutor',
+                    'ErrorCode',
+                    'Action'
+
+        All results are stored in one transaction. Uploads with malformed
+        entries, or entries without 'ErrorCode' or 'Action', are rejected
+        as a whole, before anything is stored.
+    '''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if request.GET.get('Secret') != settings.JOB_EXECUTOR_SECRET:
+        raise PermissionDenied
+    machine = get_object_or_404(TestMachine, host=request.GET.get('UUID'))
+    if not machine.enabled:
+        raise Http404
+    TestMachine.objects.filter(pk=machine.pk).update(last_contact=datetime.now())
+
+    try:
+        entries = [json.loads(line) for line in request.body.decode('utf-8').splitlines() if line.strip()]
+        file_ids = [int(entry['SubmissionFileId']) for entry in entries]
+        error_codes = [int(entry['ErrorCode']) for entry in entries]
+        actions = [entry['Action'] for entry in entries]
+        if not all(isinstance(action, str) for action in actions):
+            raise TypeError("Action must be a string")
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.error("Invalid result upload from executor: " + str(e))
+        return HttpResponseBadRequest()
+
+    subs = {}
+    for sub in Submission.objects.filter(file_upload__in=file_ids).select_related('file_upload', 'assignment'):
+        subs.setdefault(sub.file_upload_id, sub)
+
+    notifications = []
+    with transaction.atomic():
+        results = []
+        changed = {}
+        for file_id, error_code, action, entry in zip(file_ids, error_codes, actions, entries):
+            sub = subs.get(file_id)
+            if not sub:
+                logger.error("Ignoring executor result for unknown submission file %u" % file_id)
+                continue
+            logger.debug("Storing executor results for submission %u" % (sub.pk))
+            result, states = apply_result(sub, machine, action,
+                                          error_code,
+                                          entry.get('Message'),
+                                          entry.get('MessageTutor'))
+            if result:
+                results.append(result)
+            changed[sub.pk] = sub
+            notifications += [(sub, state) for state in states]
+        SubmissionTestResult.objects.bulk_create(results)
+        # Mark work as done
+        now = datetime.now()
+        by_state = defaultdict(list)
+        for sub in changed.values():
+            by_state[sub.state].append(sub.pk)
+        for state, pks in by_state.items():
+            Submission.objects.filter(pk__in=pks).update(state=state, modified=now)
+        SubmissionFile.objects.filter(pk__in=file_ids).update(fetched=None)
+        # Bulk updates do not trigger the signal handler for this
+        if set(by_state) & {Submission.TEST_VALIDITY_PENDING, Submission.TEST_FULL_PENDING,
+                            Submission.CLOSED_TEST_FULL_PENDING}:
+            transaction.on_commit(announce_jobs)
+
+    for sub, state in notifications:
+        sub.inform_student(request, state)
+    return HttpResponse(status=201)
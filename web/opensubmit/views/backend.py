@@ -2,56 +2,154 @@
 OpenSubmit backend views that are not realized with Django admin.
 '''
 
+import hashlib
+import os
+
 from django.views.generic import TemplateView, DetailView
 from django.shortcuts import get_object_or_404
 from django.contrib.auth.models import User
 from django.contrib import messages
 from django.shortcuts import redirect
-from django.core.mail import send_mass_mail
+from django.http import FileResponse, HttpResponse, Http404
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.utils.html import format_html
 from django.core.exceptions import ViewDoesNotExist
 
 from formtools.preview import FormPreview
 
-from opensubmit.models import Submission, Assignment, Course
+from opensubmit.models import Submission, Assignment, Course, MailDispatch
+from opensubmit.mails import queue_mass_mail
+from opensubmit.archives import CourseArchive
 from opensubmit.models.userprofile import move_user_data
 from opensubmit.views.helpers import StaffRequiredMixin, ZipDownloadDetailView
 
 
 class AssignmentArchiveView(StaffRequiredMixin, ZipDownloadDetailView):
+    '''
+    Assignment archives are created on the fly, in the request thread.
+    There is no worker pool here, the web server process may be
+    multithreaded and must not fork. Compressed ZIP members are
+    copied raw, so only TAR and single file uploads are compressed.
+    '''
     model = Assignment
 
+    def zip_file_name(self):
+        return self.object.directory_name()
+
     def fill_zip_file(self, z):
         assignment = self.object
         assignment.add_to_zipfile(z)
+        yield
         subs = Submission.valid_ones.filter(assignment=assignment).order_by('submitter')
+        subs = subs.select_related('submitter', 'grading', 'file_upload').prefetch_related('authors')
         for sub in subs:
             sub.add_to_zipfile(z)
-        return assignment.directory_name()
+            yield
 
 
 class CourseArchiveView(StaffRequiredMixin, ZipDownloadDetailView):
+    '''
+    Course archives are served from disk when they are up-to-date,
+    otherwise a new build is requested and the archive is created
+    on the fly.
+    '''
     model = Course
 
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        archive = CourseArchive(self.object)
+        path = archive.current()
+        if path is None:
+            archive.request()
+            return super().get(request, *args, **kwargs)
+        response = FileResponse(open(path, 'rb'), content_type="application/x-zip-compressed")
+        response['Content-Length'] = os.path.getsize(path)
+        response['Content-Disposition'] = 'attachment; filename=%s.zip' % self.zip_file_name()
+        return response
+
+    def zip_file_name(self):
+        return self.object.directory_name()
+
     def fill_zip_file(self, z):
-        course = self.object
-        assignments = course.assignments.order_by('title')
-        for ass in assignments:
-            ass.add_to_zipfile(z)
-            subs = ass.submissions.all().order_by('submitter')
-            for sub in subs:
-                sub.add_to_zipfile(z)
-        return course.directory_name()
+        for key, part in CourseArchive(self.object).parts():
+            part.add_to_zipfile(z)
+            yield
 
 
 class PreviewView(StaffRequiredMixin, DetailView):
+    '''
+    Lists the files of the student upload. Their content is
+    fetched page by page from PreviewFileView, when opened.
+    '''
     template_name = 'file_preview.html'
     model = Submission
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if self.object.file_upload:
+            context['files'] = self.object.file_upload.preview_index()
+        else:
+            context['files'] = []
+        return context
+
+
+class PreviewFileView(StaffRequiredMixin, DetailView):
+    '''
+    One page of a file in the student upload, as HTML snippet.
+    The byte offset of the page can be given as 'offset' parameter.
+    Rendered pages are cached, since uploads never change.
+    '''
+    template_name = 'file_preview_page.html'
+    model = Submission
+
+    def get(self, request, *args, **kwargs):
+        self.object = self.get_object()
+        f = self.object.file_upload
+        if not f:
+            raise Http404
+        try:
+            offset = max(0, int(request.GET.get('offset', 0)))
+        except ValueError:
+            offset = 0
+        index = int(kwargs['index'])
+        # The upload name is part of the key, since primary keys can be reused
+        name_hash = hashlib.md5(f.attachment.name.encode('utf-8')).hexdigest()
+        key = 'opensubmit-preview-%u-%s-%u-%u' % (f.pk, name_hash, index, offset)
+        html = cache.get(key)
+        if html is None:
+            page = f.preview_page(index, offset)
+            if page is None:
+                raise Http404
+            html = render_to_string(self.template_name, {'page': page}, request)
+            cache.set(key, html, settings.PREVIEW_CACHE_TIMEOUT)
+        return HttpResponse(html)
+
 
 class DuplicatesView(StaffRequiredMixin, DetailView):
+    '''
+    Exact duplicates of the student files, and similar submissions.
+    The similarity threshold can be given in percent as 'threshold' parameter.
+    '''
     template_name = 'duplicates.html'
     model = Assignment
 
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        try:
+            threshold = int(self.request.GET['threshold'])
+        except (KeyError, ValueError):
+            threshold = settings.SIMILARITY_THRESHOLD
+        threshold = max(50, min(100, threshold))
+        context['threshold'] = threshold
+        context['duplicates_pending'] = self.object.duplicates_pending()
+        context['similar'] = self.object.similar_submissions(threshold / 100)
+        context['similar_pending'] = self.object.similarity_pending()
+        return context
+
 
 class GradingTableView(StaffRequiredMixin, DetailView):
     template_name = 'gradingtable.html'
@@ -165,11 +263,17 @@ class MailFormPreview(StaffRequiredMixin, FormPreview):
     def done(self, request, cleaned_data):
         from opensubmit.templatetags.projecttags import replace_macros
 
-        tosend = [[replace_macros(cleaned_data['subject'], {'first_name': recv.first_name, 'last_name': recv.last_name}),
-                   replace_macros(cleaned_data['message'], {'first_name': recv.first_name, 'last_name': recv.last_name}),
+        receivers = self.state['receivers'].order_by('email').distinct().values('first_name', 'last_name', 'email')
+        tosend = ((replace_macros(cleaned_data['subject'], {'first_name': recv['first_name'], 'last_name': recv['last_name']}),
+                   replace_macros(cleaned_data['message'], {'first_name': recv['first_name'], 'last_name': recv['last_name']}),
                    request.user.email,
-                   [recv.email]] for recv in self.state['receivers']]
-        sent = send_mass_mail(tosend, fail_silently=True)
-        messages.add_message(request, messages.INFO, '%u message(s) sent.' % sent)
+                   [recv['email']]) for recv in receivers.iterator())
+        # Sent in the background, the dispatch shows the progress
+        with transaction.atomic():
+            dispatch = MailDispatch.objects.create(subject=cleaned_data['subject'], sender=request.user)
+            queue_mass_mail(dispatch, tosend)
+        messages.add_message(request, messages.INFO, format_html(
+            '{} message(s) queued for sending, see the <a href="{}">progress</a>.',
+            dispatch.total, reverse('teacher:opensubmit_maildispatch_changelist')))
         return redirect('teacher:index')
 
@@ -2,12 +2,16 @@
 Helper functions for the view implementations.
 '''
 
-import io
+import hashlib
+import os
+import tarfile
 import zipfile
 
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.views.generic import DetailView
-from django.http import FileResponse, HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 
 
 class StaffRequiredMixin(LoginRequiredMixin, UserPassesTestMixin):
@@ -19,6 +23,14 @@ class StaffRequiredMixin(LoginRequiredMixin, UserPassesTestMixin):
 
 
 class BinaryDownloadMixin(object):
+    '''
+    Download of the file given by the view.
+
+    Supports conditional requests with If-None-Match and If-Modified-Since,
+    so that clients with a cached copy (e.g. executors) get a 304 answer
+    instead of the file content. The ETag is derived from file name,
+    size and modification time.
+    '''
     f = None
     fname = None
 
@@ -26,38 +38,138 @@ class BinaryDownloadMixin(object):
         super().get(request, *args, **kwargs)
         assert(self.f is not None)
         assert(self.fname is not None)
-        response = HttpResponse(self.f, content_type='application/binary')
-        response['Content-Disposition'] = 'attachment; filename="%s"' % self.fname
+        last_modified = int(os.path.getmtime(self.f.path))
+        name_hash = hashlib.md5(self.f.name.encode('utf-8')).hexdigest()[:8]
+        etag = quote_etag('%s-%x-%x' % (name_hash, self.f.size, last_modified))
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = HttpResponse(self.f, content_type='application/binary')
+            response['Content-Disposition'] = 'attachment; filename="%s"' % self.fname
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
         return response
 
 
+class ZipStream(object):
+    '''
+    Write-only file object for zipfile.ZipFile, which keeps the written
+    data only until it is fetched with pop(). ZipFile notices that the
+    stream is not seekable, and stores the member sizes behind the data.
+    '''
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(fill):
+    '''
+    Generator for the content of a new ZIP file, to be used with
+    StreamingHttpResponse.
+
+    The fill function gets the ZipFile instance and must be a generator
+    itself, which yields after each added part (e.g. one submission).
+    The data written so far is sent then, so only the current part
+    is kept in memory. ZIP64 is used for large archives.
+    '''
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, 'w', allowZip64=True) as z:
+        for _ in fill(z):
+            data = stream.pop()
+            if data:
+                yield data
+    # Central directory
+    yield stream.pop()
+
+
+def zip_response(fill, file_name):
+    '''
+    Streaming download of a ZIP file, see stream_zip().
+    '''
+    response = StreamingHttpResponse(stream_zip(fill), content_type="application/x-zip-compressed")
+    response['Content-Disposition'] = 'attachment; filename=%s.zip' % file_name
+    return response
+
+
+def stream_tar(members):
+    '''
+    Creates an uncompressed TAR archive while it is sent.
+
+    The members are given as list of (name, size, open function) tuples.
+    The open function must return a file object with at least size bytes,
+    it is called when the member is sent.
+
+    Returns the size of the archive, and a generator for its content,
+    to be used with StreamingHttpResponse. Only one chunk of data is kept
+    in memory.
+    '''
+    headers = []
+    size = 0
+    for name, member_size, opener in members:
+        info = tarfile.TarInfo(name)
+        info.size = member_size
+        header = info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+        headers.append(header)
+        blocks = -(-member_size // tarfile.BLOCKSIZE)
+        size += len(header) + blocks * tarfile.BLOCKSIZE
+    # End-of-archive marker, and padding to full records, as tarfile does it
+    size += 2 * tarfile.BLOCKSIZE
+    size += -size % tarfile.RECORDSIZE
+    total = size
+
+    def generate():
+        written = 0
+        for header, (name, member_size, opener) in zip(headers, members):
+            yield header
+            with opener() as f:
+                remaining = member_size
+                while remaining > 0:
+                    chunk = f.read(min(64 * 1024, remaining))
+                    if not chunk:
+                        raise IOError("%s is shorter than expected" % name)
+                    remaining -= len(chunk)
+                    yield chunk
+            yield tarfile.NUL * (-member_size % tarfile.BLOCKSIZE)
+            written += len(header) + member_size + (-member_size % tarfile.BLOCKSIZE)
+        yield tarfile.NUL * (total - written)
+
+    return total, generate()
+
+
 class ZipDownloadDetailView(DetailView):
     '''
     Specialized DetailView base class for ZIP downloads.
+    The archive is created while it is sent.
 
     Only intended as base class.
     '''
     def get(self, request, *args, **kwargs):
         super().get(request, *args, **kwargs)
-        output = io.BytesIO()
-        z = zipfile.ZipFile(output, 'w')
-        file_name = self.fill_zip_file(z)
-        z.close()
-        # go back to start in ZIP file so that Django can deliver it
-        output.seek(0)
-        response = FileResponse(
-            output, content_type="application/x-zip-compressed")
-        response['Content-Disposition'] = 'attachment; filename=%s.zip' % file_name
-        return response
+        return zip_response(self.fill_zip_file, self.zip_file_name())
 
-    def fill_zip_file(self, z):
+    def zip_file_name(self):
         '''
-        Function that fills the given ZIP file instance with data.
+        File name for the download, without extension.
         To be implemented by derived class.
+        '''
+        raise NotImplementedError
+
+    def fill_zip_file(self, z):
+        '''
+        Generator function that fills the given ZIP file instance with data,
+        and yields after each part. To be implemented by derived class.
 
         Parameters:
             z:  ZIP file instance
-
-        Returns:   File name for the download
         '''
         raise NotImplementedError